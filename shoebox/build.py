@@ -1,28 +1,308 @@
+import json
 import logging
+import multiprocessing
 import os
+import tempfile
 
+from shoebox.build_cache import BuildCache, write_snapshot
+from shoebox.build_manifest import BuildManifest, diff_entries, is_local_copy, scan_copy
+from shoebox.build_session import BuildSession
+from shoebox.catalog import Catalog
 from shoebox.container import Container
-from shoebox.dockerfile import ExecContext
+from shoebox.dockerfile import ExecContext, find_stage
+from shoebox.exec_commands import run_extractor
+from shoebox.mount_namespace import FilesystemNamespace
 from shoebox.namespaces import ContainerNamespace
+from shoebox.prefetch import Prefetcher, stage_archive
+from shoebox.rm import remove_containers
+from shoebox.tar import ExtractTarFile, SyncFiles
 
 
 logger = logging.getLogger('shoebox.build')
 
 
-def build_container(base_dir, force, dockerfile, repo, shoebox_dir, userns):
-    container_id = os.urandom(32).encode('hex')
-    container = Container(shoebox_dir, container_id)
-    repo.unpack(container.target_base, dockerfile.base_image_id, force)
-    # noinspection PyProtectedMember
-    dockerfile = dockerfile._replace(hostname='h' + container_id[:8])
-    container.save_metadata(dockerfile)
+def new_container_id():
+    return os.urandom(32).encode('hex')
 
-    namespace = ContainerNamespace(container.build_filesystem(), userns)
-    exec_context = ExecContext(namespace=namespace, basedir=base_dir)
+
+def copy_stage_tree(src_dir, namespace, shoebox_dir):
+    """Copy a whole build stage filesystem, preserving ownership"""
+    src_namespace = ContainerNamespace(FilesystemNamespace(src_dir), namespace.user_namespace)
+    fd, snapshot = tempfile.mkstemp(prefix='.stage', dir=shoebox_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            src_namespace.run(write_snapshot, fp)
+        ExtractTarFile(namespace, '/', snapshot).run()
+    finally:
+        os.unlink(snapshot)
+
+
+def stage_parent_key(dockerfile, stage_keys):
+    if dockerfile.base_stage is not None:
+        return stage_keys[dockerfile.base_stage]
+    return dockerfile.base_image_id
+
+
+def manifest_key(cmd, base_dir, stage_keys, previous):
+    """Return (key, files) identifying cmd in the build manifest"""
+    if base_dir is not None and is_local_copy(cmd):
+        previous_files = previous['files'] if previous else None
+        root, files = scan_copy(base_dir, cmd.src_paths, cmd.dst_path, previous_files)
+        key = [type(cmd).__name__, cmd.src_paths, cmd.dst_path, root]
+    else:
+        key, files = cmd.cache_key(base_dir, stage_keys), None
+    # compare like it was loaded from json
+    return json.loads(json.dumps(key)), files
+
+
+def sync_copy(exec_context, cmd, previous_files, files):
+    """Transfer only what changed since the last COPY, return True if anything did"""
+    changed, removed = diff_entries(previous_files, files)
+    if not changed and not removed:
+        logger.info('Unchanged {0!r}'.format(cmd))
+        return False
+    logger.info('Syncing {0} changed and {1} removed paths -> {2}'.format(len(changed), len(removed), cmd.dst_path))
+    dest_dir = os.path.split(cmd.dst_path)[0]
+    transfer = [(files[arcname][5], arcname) for arcname in changed]
+    run_extractor(exec_context, SyncFiles(exec_context.namespace, dest_dir, exec_context.basedir, transfer, removed))
+    return True
+
+
+def execute_step(exec_context, profiler, stage, i, cmd, func, *args):
+    try:
+        if profiler:
+            return profiler.profile(exec_context.session, stage, i, cmd, func, *args)
+        return func(*args)
+    except NotImplementedError:
+        logger.error("Don't know how to run {0!r} yet".format(cmd))
+
+
+def step_prefetcher(exec_context, run_commands, shoebox_dir):
+    """Return a Prefetcher staging the archives of COPY/ADD in run_commands"""
+    extractors = []
+    for cmd in run_commands:
+        if hasattr(cmd, 'prefetch_extractors'):
+            extractors.extend(cmd.prefetch_extractors(exec_context))
+    if not extractors:
+        return Prefetcher([])
+    staging_dir = tempfile.mkdtemp(prefix='.prefetch', dir=shoebox_dir)
+    jobs = [(extractor.staging_key(), stage_archive, (extractor, staging_dir)) for extractor in extractors]
+    return Prefetcher(jobs, staging_dir=staging_dir)
+
+
+def build_stage(container, base_dir, force, dockerfile, repo, shoebox_dir, userns, use_cache=True,
+                stage_dirs=None, stage_keys=None, profiler=None, stage='final', into=False, cgroup=None):
+    """Build one stage of dockerfile in container
+
+    With into, container already holds an earlier build: COPY steps only
+    transfer changed files and RUN steps are skipped while nothing before
+    them changed.
+    """
+    namespace = ContainerNamespace(container.build_filesystem(), userns, cgroup=cgroup)
+    stage_keys = stage_keys or {}
+
+    # only the final stage is kept, so only it can be built into later
+    manifest = BuildManifest(container) if stage == 'final' else None
+    if into and not manifest.load():
+        raise RuntimeError('No build manifest in {0}, cannot build into it'.format(container.container_id))
+
+    run_commands = dockerfile.run_commands
+    cache = BuildCache(shoebox_dir)
+    if use_cache and run_commands and not into:
+        parent_key = stage_parent_key(dockerfile, stage_keys)
+        cache_keys = cache.step_keys(parent_key, run_commands, base_dir, stage_keys)
+        cached_steps = cache.cached_prefix(cache_keys)
+    else:
+        cache_keys = []
+        cached_steps = 0
+
+    exec_context = ExecContext(
+        namespace=namespace, basedir=base_dir, stage_dirs=stage_dirs or {}, session=None,
+        shoebox_dir=shoebox_dir, prefetcher=None)
+    # files for later COPY/ADD steps are staged while the base is unpacked
+    # and earlier steps run; into builds only transfer what changed instead
+    pending = [] if into else run_commands[cached_steps:]
+    with step_prefetcher(exec_context, pending, shoebox_dir) as prefetcher:
+        if into:
+            logger.info('Building into {0}'.format(container.container_id))
+        elif dockerfile.base_stage is not None:
+            os.makedirs(container.target_base, mode=0o755)
+            copy_stage_tree(stage_dirs[dockerfile.base_stage], namespace, shoebox_dir)
+        else:
+            repo.unpack(container.target_base, dockerfile.base_image_id, force)
+        if cached_steps:
+            for i, (cmd, key) in enumerate(zip(run_commands, cache_keys)[:cached_steps]):
+                logger.info('Using cache {0} for {1!r}'.format(key[:12], cmd))
+                if profiler:
+                    profiler.record_cached(stage, i, cmd)
+                if manifest:
+                    manifest.record(i, *manifest_key(cmd, base_dir, stage_keys, None))
+            # every snapshot only holds the changes of its step
+            cache.restore(namespace, cache_keys[:cached_steps])
+
+        # noinspection PyProtectedMember
+        dockerfile = dockerfile._replace(hostname='h' + container.container_id[:8])
+        container.save_metadata(dockerfile)
+        Catalog(shoebox_dir).add_container(container.container_id, dockerfile.base_image_id)
+
+        done_steps = cached_steps
+        try:
+            if cached_steps < len(run_commands):
+                # set up the namespace once and let every step reuse it
+                with BuildSession(namespace) as session:
+                    # noinspection PyProtectedMember
+                    exec_context = exec_context._replace(session=session, prefetcher=prefetcher)
+                    if profiler:
+                        profiler.start_session(session)
+                    if cache_keys:
+                        session.mark_snapshot()
+                    dirty = False
+                    for i in range(cached_steps, len(run_commands)):
+                        cmd = run_commands[i]
+                        key = files = None
+                        if manifest:
+                            previous = manifest.step(i) if into else None
+                            key, files = manifest_key(cmd, base_dir, stage_keys, previous)
+                        if into and files is not None and previous and previous['files'] is not None and \
+                                previous['key'][:3] == key[:3]:
+                            # same COPY as last time, send the difference
+                            if execute_step(exec_context, profiler, stage, i, cmd,
+                                            sync_copy, exec_context, cmd, previous['files'], files):
+                                dirty = True
+                        elif into and not dirty and previous and previous['key'] == key:
+                            logger.info('Unchanged, skipping {0!r}'.format(cmd))
+                        else:
+                            execute_step(exec_context, profiler, stage, i, cmd, cmd.execute, exec_context)
+                            dirty = True
+                        if cache_keys:
+                            cache.store(cache_keys[i], session)
+                        if manifest:
+                            manifest.record(i, key, files)
+                        done_steps = i + 1
+        finally:
+            if manifest:
+                # steps after a failure have to run again next time
+                manifest.steps = manifest.steps[:done_steps]
+                manifest.save()
+
+    if use_cache and run_commands and not into:
+        logger.info('Build cache: {0} of {1} steps cached'.format(cached_steps, len(run_commands)))
+        # whatever else goes, the steps just built stay
+        cache.prune(keep=cache_keys)
+
+    return container
+
+
+def stage_dependencies(stages, dockerfile):
+    """Return indices of earlier stages a stage reads from"""
+    deps = set()
+    names = []
+    if dockerfile.base_stage is not None:
+        names.append(dockerfile.base_stage)
     for cmd in dockerfile.run_commands:
+        if getattr(cmd, 'from_stage', None) is not None:
+            names.append(cmd.from_stage)
+    for name in names:
         try:
-            cmd.execute(exec_context)
-        except NotImplementedError:
-            logger.error("Don't know how to run {0!r} yet".format(cmd))
+            deps.add(find_stage(stages, name))
+        except KeyError:
+            raise RuntimeError('Unknown build stage {0}'.format(name))
+    return deps
+
+
+def run_stages(stages, dependencies, build_one, jobs, names=None):
+    """Build stages in forked children, as many at once as dependencies allow"""
+    names = names or ['stage {0}'.format(i) for i in range(len(stages))]
+    pending = set(range(len(stages)))
+    running = {}
+    done = set()
+    try:
+        while pending or running:
+            for i in sorted(pending):
+                if len(running) >= jobs:
+                    break
+                if not dependencies[i] <= done:
+                    continue
+                pid = os.fork()
+                if pid == 0:
+                    exitcode = 1
+                    # noinspection PyBroadException
+                    try:
+                        build_one(i)
+                        exitcode = 0
+                    except:
+                        logger.exception('Build {0} failed'.format(names[i]))
+                    finally:
+                        # noinspection PyProtectedMember
+                        os._exit(exitcode)
+                running[pid] = i
+                pending.discard(i)
+
+            pid, ret = os.waitpid(-1, 0)
+            i = running.pop(pid)
+            if ret:
+                raise RuntimeError('Build {0} failed'.format(names[i]))
+            logger.info('Build {0} done'.format(names[i]))
+            done.add(i)
+    finally:
+        for pid in running:
+            os.waitpid(pid, 0)
+
+
+def build_container(base_dir, force, dockerfile, repo, shoebox_dir, userns, use_cache=True, profiler=None,
+                    into=None, cgroup=None):
+    """Build dockerfile in a new container, or into an existing one with into=container_id
+
+    With cgroup, all build steps share its resource limits.
+    """
+    if into is not None:
+        # resolve tags, the container id ends up in the hostname
+        container = Container(shoebox_dir, Catalog(shoebox_dir).resolve(into))
+        if not os.path.exists(container.target_base):
+            raise RuntimeError('Cannot find container named {0}'.format(into))
+    else:
+        container = Container(shoebox_dir, new_container_id())
+    # once, before stages fork, so they all share it
+    userns.start_holder()
+    stages = list(dockerfile.stages or [])
+    if not stages:
+        return build_stage(container, base_dir, force, dockerfile, repo, shoebox_dir, userns, use_cache,
+                           profiler=profiler, into=into is not None, cgroup=cgroup)
+
+    # every stage gets its own container, only the last one is kept
+    stage_containers = [Container(shoebox_dir, new_container_id()) for _ in stages]
+    stage_dirs = {}
+    for i, stage in enumerate(stages):
+        stage_dirs[str(i)] = stage_containers[i].target_base
+        if stage.stage_name:
+            stage_dirs[stage.stage_name] = stage_containers[i].target_base
+
+    # also needed without the cache to tell if COPY --from sources changed
+    stage_keys = {}
+    cache = BuildCache(shoebox_dir)
+    for i, stage in enumerate(stages):
+        parent_key = stage_parent_key(stage, stage_keys)
+        keys = cache.step_keys(parent_key, stage.run_commands, base_dir, stage_keys)
+        stage_key = keys[-1] if keys else parent_key
+        stage_keys[str(i)] = stage_key
+        if stage.stage_name:
+            stage_keys[stage.stage_name] = stage_key
+
+    dependencies = [stage_dependencies(stages, stage) for stage in stages]
+    # fail early on unknown stages in the final one too
+    stage_dependencies(stages, dockerfile)
+
+    def build_one(i):
+        build_stage(stage_containers[i], base_dir, force, stages[i], repo, shoebox_dir, userns, use_cache,
+                    stage_dirs, stage_keys, profiler, stages[i].stage_name or str(i), cgroup=cgroup)
+
+    try:
+        run_stages(stages, dependencies, build_one, multiprocessing.cpu_count())
+        build_stage(container, base_dir, force, dockerfile, repo, shoebox_dir, userns, use_cache,
+                    stage_dirs, stage_keys, profiler, into=into is not None, cgroup=cgroup)
+    finally:
+        # deleted in the background, nothing waits for them
+        remove_containers(shoebox_dir, [stage_container.container_id for stage_container in stage_containers
+                                        if os.path.exists(stage_container.runtime_dir)], userns, background=True)
 
     return container
@@ -0,0 +1,201 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import stat
+import tarfile
+import time
+
+from shoebox.tar import ContainerTarFile, ExtractTarFile
+
+
+logger = logging.getLogger('shoebox.build_cache')
+
+# snapshots are pruned, least recently used first, past any of these
+CACHE_MAX_SIZE = 10 << 30
+CACHE_MAX_AGE = 30 * 86400
+
+
+def hash_file(digest, path):
+    with open(path, 'rb') as fp:
+        while True:
+            buf = fp.read(1 << 16)
+            if not buf:
+                break
+            digest.update(buf)
+
+
+def content_hash(basedir, paths):
+    """Hash names, modes and contents of build context paths
+
+    URLs are hashed by name only as we cannot know their content
+    without downloading them.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update('\0{0}\0'.format(path))
+        if basedir is None or path.startswith('http://') or path.startswith('https://'):
+            continue
+        root = os.path.join(basedir, path)
+        if not os.path.isdir(root):
+            entries = [(root, path)]
+        else:
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for name in sorted(dirnames + filenames):
+                    full_path = os.path.join(dirpath, name)
+                    entries.append((full_path, os.path.relpath(full_path, basedir)))
+        for full_path, rel_path in entries:
+            st = os.lstat(full_path)
+            digest.update('{0}\0{1:o}\0'.format(rel_path, st.st_mode))
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(os.readlink(full_path))
+            elif stat.S_ISREG(st.st_mode):
+                hash_file(digest, full_path)
+    return digest.hexdigest()
+
+
+class SnapshotTarFile(ContainerTarFile):
+    """Tar file preserving ownership, unlike copies into containers"""
+
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        return tarfile.TarFile.gettarinfo(self, name, arcname, fileobj)
+
+
+def write_snapshot(fp):
+    tar = SnapshotTarFile.open(fileobj=fp, mode='w|')
+    tar.add('/', arcname='.')
+    tar.close()
+    fp.close()
+
+
+def write_delta(fp, old_tree, new_tree, root='/'):
+    """Write what changed between two scan_tree() results as a tar
+
+    Removed paths become whiteouts, like in image layers. So do changed
+    non-directories, so their replacement never lands on top of them.
+    """
+    tar = SnapshotTarFile.open(fileobj=fp, mode='w|')
+    changed = sorted(path for path, entry in new_tree.iteritems() if old_tree.get(path) != entry)
+    gone = set(path for path in old_tree if path not in new_tree)
+    gone.update(path for path in changed if path in old_tree and
+                not (stat.S_ISDIR(old_tree[path][0]) and stat.S_ISDIR(new_tree[path][0])))
+    for path in sorted(gone):
+        if os.path.dirname(path) in gone:
+            continue
+        directory, base = os.path.split(os.path.relpath(path, root))
+        tar.addfile(tarfile.TarInfo(os.path.join(directory, '.wh.' + base)))
+    for path in changed:
+        try:
+            tar.add(path, arcname=os.path.relpath(path, root), recursive=False)
+        except (IOError, OSError):
+            # removed since the scan, by a daemon a RUN step left behind
+            logger.debug('Cannot snapshot {0}'.format(path), exc_info=True)
+    tar.close()
+    fp.close()
+
+
+class BuildCache(object):
+    """Snapshots of build steps, keyed by everything that led to them
+
+    Each snapshot only holds what its step changed, so restoring a step
+    replays the snapshots of all steps before it over the base.
+    """
+
+    def __init__(self, shoebox_dir):
+        self.cache_dir = os.path.join(shoebox_dir, 'cache')
+
+    def step_keys(self, parent_key, run_commands, basedir, stage_keys=None):
+        """Return cache keys for every step, each one chained to the previous
+
+        stage_keys maps build stage names to the keys of their final state.
+        """
+        keys = []
+        parent = parent_key or ''
+        for cmd in run_commands:
+            step = json.dumps([parent, cmd.cache_key(basedir, stage_keys or {})], sort_keys=True)
+            parent = hashlib.sha256(step).hexdigest()
+            keys.append(parent)
+        return keys
+
+    def snapshot_path(self, key):
+        return os.path.join(self.cache_dir, key + '.tar.gz')
+
+    def has_snapshot(self, key):
+        return os.path.exists(self.snapshot_path(key))
+
+    def cached_prefix(self, keys):
+        """Return the number of leading steps that can be restored from cache"""
+        for i, key in enumerate(keys):
+            if not self.has_snapshot(key):
+                return i
+        return len(keys)
+
+    def restore(self, namespace, keys):
+        """Replay the snapshots of keys, in order, over the base of the container"""
+        for key in keys:
+            path = self.snapshot_path(key)
+            # mark as used, for prune()
+            os.utime(path, None)
+            ExtractTarFile(namespace, '/', path).run()
+
+    def store(self, key, session):
+        """Snapshot what changed since the session's last snapshot (or mark_snapshot)"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, mode=0o755)
+        path = self.snapshot_path(key)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fp:
+                # fast, snapshots are written after every step
+                gz = gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=1)
+                session.snapshot(gz)
+                gz.close()
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        logger.debug('Stored build snapshot {0}'.format(key))
+
+    def prune(self, max_size=CACHE_MAX_SIZE, max_age=CACHE_MAX_AGE, keep=()):
+        """Delete snapshots unused for max_age seconds, then the oldest until max_size bytes are left
+
+        Snapshots of keys in keep, e.g. those of the build that just ran,
+        stay. Returns the number of snapshots and bytes deleted.
+        """
+        if not os.path.exists(self.cache_dir):
+            return 0, 0
+        keep = set(self.snapshot_path(key) for key in keep)
+        snapshots = []
+        for name in os.listdir(self.cache_dir):
+            # .tar are whole container snapshots of older versions
+            if not name.endswith('.tar.gz') and not name.endswith('.tar'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            if path in keep:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshots.append((st.st_mtime, st.st_size, path))
+        snapshots.sort()
+        total = sum(size for _, size, _ in snapshots)
+        cutoff = time.time() - max_age
+        removed = removed_size = 0
+        for mtime, size, path in snapshots:
+            if mtime >= cutoff and total <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            removed_size += size
+        if removed:
+            logger.info('Pruned {0} build cache snapshots'.format(removed))
+        return removed, removed_size
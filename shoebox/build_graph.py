@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import sys
+
+from shoebox.build import build_container, copy_stage_tree, run_stages
+from shoebox.catalog import Catalog
+from shoebox.container import Container, is_container_id
+from shoebox.dockerfile import dockerfile_base_images, parse_dockerfile
+from shoebox.mount_namespace import FilesystemNamespace
+from shoebox.namespaces import ContainerNamespace
+from shoebox.utils import tag_container
+
+
+logger = logging.getLogger('shoebox.build_graph')
+
+
+class LocalImageRepository(object):
+    """Image repository that also offers local containers as base images
+
+    FROM <tag> with one of local_tags uses the container with that tag,
+    anything else goes to the wrapped repository.
+    """
+
+    def __init__(self, repo, shoebox_dir, userns, local_tags):
+        self.repo = repo
+        self.shoebox_dir = shoebox_dir
+        self.userns = userns
+        self.local_tags = local_tags
+
+    def __getattr__(self, item):
+        return getattr(self.repo, item)
+
+    def local_container(self, image_id):
+        container = Container(self.shoebox_dir, image_id)
+        if is_container_id(image_id) and os.path.exists(container.target_base):
+            return container
+
+    def metadata(self, image, tag='latest', use_cache=True):
+        if image in self.local_tags and tag == 'latest':
+            container_id = Catalog(self.shoebox_dir).resolve(image)
+            with open(Container(self.shoebox_dir, container_id).metadata_file) as fp:
+                return json.load(fp)
+        return self.repo.metadata(image, tag, use_cache)
+
+    def unpack(self, target_dir, image_id, force_download=False):
+        container = self.local_container(image_id)
+        if container is None:
+            return self.repo.unpack(target_dir, image_id, force_download)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir, mode=0o755)
+        namespace = ContainerNamespace(FilesystemNamespace(target_dir), self.userns)
+        copy_stage_tree(container.target_base, namespace, self.shoebox_dir)
+        return target_dir
+
+
+def parse_build_dir(spec):
+    """Split DIR[:TAG], the tag defaults to the directory name"""
+    base_dir, sep, tag = spec.rpartition(':')
+    if not sep:
+        base_dir, tag = spec, None
+    base_dir = os.path.abspath(base_dir)
+    return base_dir, tag or os.path.basename(base_dir)
+
+
+def graph_dependencies(nodes):
+    """Return indices of the nodes each node is built FROM
+
+    nodes is a list of (base_dir, tag).
+    """
+    tags = dict((tag, i) for i, (_, tag) in enumerate(nodes))
+    if len(tags) != len(nodes):
+        raise RuntimeError('Duplicate tags in build graph')
+    dependencies = []
+    for base_dir, tag in nodes:
+        path = os.path.join(base_dir, 'Dockerfile')
+        try:
+            with open(path) as fp:
+                images = dockerfile_base_images(fp.read())
+        except IOError as exc:
+            raise RuntimeError('Cannot read Dockerfile of {0} at {1}: {2}'.format(tag, path, exc.strerror))
+        dependencies.append(set(tags[image] for image, image_tag in images
+                                if image in tags and image_tag == 'latest'))
+
+    # refuse cycles, they would never get built
+    done = set()
+    while len(done) < len(nodes):
+        ready = [i for i in range(len(nodes)) if i not in done and dependencies[i] <= done]
+        if not ready:
+            raise RuntimeError('Dependency cycle between {0}'.format(
+                ', '.join(nodes[i][1] for i in range(len(nodes)) if i not in done)))
+        done.update(ready)
+    return dependencies
+
+
+def build_graph(specs, force, repo, shoebox_dir, userns, jobs, use_cache=True, cgroup=None):
+    """Build DIR[:TAG] specs concurrently, each after the ones it's built FROM
+
+    Every build is tagged as soon as it succeeds.
+    """
+    nodes = [parse_build_dir(spec) for spec in specs]
+    dependencies = graph_dependencies(nodes)
+    local_repo = LocalImageRepository(repo, shoebox_dir, userns, set(tag for _, tag in nodes))
+
+    def build_one(i):
+        base_dir, tag = nodes[i]
+        logger.info('Building {0} from {1}'.format(tag, base_dir))
+        os.chdir(base_dir)
+        dockerfile = parse_dockerfile(open('Dockerfile').read(), repo=local_repo)
+        container = build_container(base_dir, force, dockerfile, local_repo, shoebox_dir, userns, use_cache,
+                                    cgroup=cgroup)
+        tag_container(shoebox_dir, container.container_id, tag, force=True)
+        print tag, container.container_id
+        sys.stdout.flush()
+
+    run_stages(nodes, dependencies, build_one, jobs, [tag for _, tag in nodes])
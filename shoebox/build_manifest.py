@@ -0,0 +1,138 @@
+"""Record what every COPY put into a build container
+
+The manifest maps each copied path (relative to the COPY destination)
+to [mode, size, mtime, inode, hash, source path]. Directory hashes are
+built from their children, so comparing the root hash tells whether
+anything changed, and unchanged size/mtime/inode lets us reuse the old
+hash instead of reading the file again.
+"""
+import hashlib
+import json
+import logging
+import os
+import stat
+
+from shoebox.build_cache import hash_file
+from shoebox.exec_commands import AddCommand, CopyCommand, src_type
+
+
+logger = logging.getLogger('shoebox.build_manifest')
+
+MANIFEST_VERSION = 1
+
+
+def is_local_copy(cmd):
+    """Does cmd only copy files from the build context?"""
+    if isinstance(cmd, CopyCommand):
+        return cmd.from_stage is None
+    if isinstance(cmd, AddCommand):
+        return all(src_type(src) == 'file' for src in cmd.src_paths)
+    return False
+
+
+def scan_entry(entries, basedir, src, arcname, previous):
+    path = os.path.join(basedir, src)
+    st = os.lstat(path)
+    if stat.S_ISDIR(st.st_mode):
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(path)):
+            child = scan_entry(
+                entries, basedir, os.path.join(src, name), os.path.normpath(os.path.join(arcname, name)), previous)
+            digest.update('{0}\0{1:o}\0{2}\0'.format(name, child[0], child[4]))
+        file_hash = digest.hexdigest()
+    else:
+        old = previous.get(arcname)
+        if old is not None and old[:4] == [st.st_mode, st.st_size, st.st_mtime, st.st_ino] and old[5] == src:
+            file_hash = old[4]
+        elif stat.S_ISLNK(st.st_mode):
+            file_hash = hashlib.sha256(os.readlink(path)).hexdigest()
+        elif stat.S_ISREG(st.st_mode):
+            digest = hashlib.sha256()
+            hash_file(digest, path)
+            file_hash = digest.hexdigest()
+        else:
+            file_hash = ''
+    entry = [st.st_mode, st.st_size, st.st_mtime, st.st_ino, file_hash, src]
+    entries[arcname] = entry
+    return entry
+
+
+def scan_copy(basedir, src_paths, dst_path, previous=None):
+    """Return (root hash, entries) for the files a COPY would transfer
+
+    Archive names follow CopyFiles: directories are copied by content,
+    a destination not ending in / renames the single source.
+    """
+    _, target_basename = os.path.split(dst_path)
+    entries = {}
+    digest = hashlib.sha256()
+    for src in src_paths:
+        if target_basename:
+            arcname = target_basename
+        elif os.path.isdir(os.path.join(basedir, src)):
+            arcname = '.'
+        else:
+            arcname = os.path.basename(src)
+        entry = scan_entry(entries, basedir, src, arcname, previous or {})
+        digest.update('{0}\0{1:o}\0{2}\0'.format(arcname, entry[0], entry[4]))
+    return digest.hexdigest(), entries
+
+
+def diff_entries(old, new):
+    """Return (changed, removed) archive names, parents before children
+
+    Only the topmost of removed trees is listed.
+    """
+    changed = []
+    removed = []
+    for arcname in sorted(new):
+        entry = new[arcname]
+        prev = old.get(arcname)
+        if prev is None:
+            changed.append(arcname)
+        elif stat.S_IFMT(prev[0]) != stat.S_IFMT(entry[0]):
+            removed.append(arcname)
+            changed.append(arcname)
+        elif prev[0] != entry[0] or (not stat.S_ISDIR(entry[0]) and prev[4] != entry[4]):
+            changed.append(arcname)
+    gone = set(old) - set(new)
+    for arcname in sorted(gone):
+        if os.path.dirname(arcname) not in gone:
+            removed.append(arcname)
+    return changed, removed
+
+
+class BuildManifest(object):
+    """Per-step record of the last build into a container"""
+
+    def __init__(self, container):
+        self.path = container.build_manifest_file
+        self.steps = []
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                manifest = json.load(fp)
+        except (IOError, ValueError):
+            return False
+        if manifest.get('version') != MANIFEST_VERSION:
+            return False
+        self.steps = manifest['steps']
+        return True
+
+    def save(self):
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump({'version': MANIFEST_VERSION, 'steps': self.steps}, fp)
+        os.rename(tmp_path, self.path)
+
+    def step(self, index):
+        if index < len(self.steps):
+            return self.steps[index]
+
+    def record(self, index, key, files=None):
+        step = {'key': key, 'files': files}
+        if index < len(self.steps):
+            self.steps[index] = step
+        else:
+            self.steps.append(step)
@@ -0,0 +1,100 @@
+from collections import namedtuple
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+
+
+logger = logging.getLogger('shoebox.build_profile')
+
+
+StepProfile = namedtuple(
+    'StepProfile',
+    'stage step instruction cached wall_time cpu_user cpu_system files_written bytes_written bytes_transferred')
+
+
+def describe(cmd):
+    name = type(cmd).__name__
+    if name.endswith('Command'):
+        name = name[:-len('Command')]
+    args = [repr(value) for field, value in zip(cmd._fields, cmd) if field != 'context' and value is not None]
+    return ' '.join([name.upper()] + args)
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime, usage.ru_stime
+
+
+class BuildProfiler(object):
+    """Collect per-instruction resource usage of a build
+
+    Steps are appended as JSON lines to a scratch file so that build
+    stages running in forked children end up in the same report.
+    """
+
+    def __init__(self, shoebox_dir):
+        fd, self.path = tempfile.mkstemp(prefix='.profile', dir=shoebox_dir)
+        os.close(fd)
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def record(self, step):
+        line = json.dumps(step._asdict(), sort_keys=True) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def record_cached(self, stage, step, cmd):
+        self.record(StepProfile(stage, step, describe(cmd), True, 0.0, 0.0, 0.0, 0, 0, 0))
+
+    def start_session(self, session):
+        # first scan of the container tree, later ones report differences
+        session.tree_usage()
+
+    def profile(self, session, stage, step, cmd, func, *args):
+        """Run func(*args) as build step cmd and record what it cost"""
+        session.reset_usage()
+        start_cpu = children_cpu()
+        start = time.time()
+        result = func(*args)
+        wall_time = time.time() - start
+        end_cpu = children_cpu()
+        files_written, bytes_written = session.tree_usage()
+        self.record(StepProfile(
+            stage, step, describe(cmd), False, wall_time,
+            end_cpu[0] - start_cpu[0] + session.cpu_user,
+            end_cpu[1] - start_cpu[1] + session.cpu_system,
+            files_written, bytes_written, session.bytes_transferred))
+        return result
+
+    def steps(self):
+        with open(self.path) as fp:
+            return [StepProfile(**json.loads(line)) for line in fp]
+
+    def report(self):
+        steps = self.steps()
+        return {
+            'steps': [step._asdict() for step in steps],
+            'total_wall_time': sum(step.wall_time for step in steps),
+            'total_cpu_time': sum(step.cpu_user + step.cpu_system for step in steps),
+        }
+
+    def log_summary(self):
+        steps = sorted(self.steps(), key=lambda s: s.wall_time, reverse=True)
+        logger.info('Build profile (slowest first):')
+        logger.info('{0:>9} {1:>9} {2:>8} {3:>11} {4:>11}  {5}'.format(
+            'wall', 'cpu', 'files', 'written', 'copied', 'instruction'))
+        for step in steps:
+            instruction = step.instruction
+            if step.cached:
+                instruction += ' (cached)'
+            logger.info('{0:>8.2f}s {1:>8.2f}s {2:>8} {3:>11} {4:>11}  {5}'.format(
+                step.wall_time, step.cpu_user + step.cpu_system, step.files_written,
+                step.bytes_written, step.bytes_transferred, instruction))
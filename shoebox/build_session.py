@@ -0,0 +1,365 @@
+import cPickle as pickle
+import errno
+import fcntl
+import logging
+import os
+import socket
+import stat
+import struct
+import tarfile
+import threading
+
+from shoebox.build_cache import write_delta
+from shoebox.exec_commands import exec_in_namespace
+from shoebox.tar import ContainerTarFile
+
+
+logger = logging.getLogger('shoebox.build_session')
+
+HEADER = struct.Struct('!I')
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            if chunks:
+                raise EOFError('Build session closed mid-message')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def send_frame(sock, data):
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if not size:
+        return ''
+    return recv_exactly(sock, size)
+
+
+def send_message(sock, message):
+    send_frame(sock, pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+
+def recv_message(sock):
+    frame = recv_frame(sock)
+    if frame is None:
+        return None
+    return pickle.loads(frame)
+
+
+class StreamReader(object):
+    """File-like object over data frames, ending at an empty frame"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            frame = recv_frame(self.sock)
+            if not frame:
+                self.eof = True
+            else:
+                self.buf += frame
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def drain(self):
+        while not self.eof:
+            self.buf = ''
+            self.read(1 << 16)
+
+
+class FrameWriter(object):
+    """File-like object sending writes as data frames, the reader ends at an empty one"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            send_frame(self.sock, data)
+
+    def close(self):
+        self.closed = True
+
+
+def send_snapshot(sock, old_tree, new_tree):
+    try:
+        write_delta(FrameWriter(sock), old_tree, new_tree)
+    finally:
+        send_frame(sock, '')
+
+
+def extract_stream(sock, dest_dir):
+    stream = StreamReader(sock)
+    try:
+        try:
+            tar = ContainerTarFile.open(fileobj=stream, mode='r|*')
+        except tarfile.ReadError as exc:
+            if exc.message == 'empty file':
+                return
+            raise
+        tar.extractall(dest_dir)
+    finally:
+        # keep the session in sync even if extraction failed
+        stream.drain()
+
+
+def fork_and_wait(func, *args):
+    """Run func in a child, return its exit status and CPU times"""
+    pid = os.fork()
+    if pid == 0:
+        exitcode = 1
+        # noinspection PyBroadException
+        try:
+            func(*args)
+            exitcode = 0
+        except:
+            logger.exception('Build job failed')
+        finally:
+            # noinspection PyProtectedMember
+            os._exit(exitcode)
+    _, ret, usage = os.wait4(pid, 0)
+    return ret, usage.ru_utime, usage.ru_stime
+
+
+def scan_tree(root='/'):
+    tree = {}
+    root_dev = os.lstat(root).st_dev
+
+    def add(path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return
+        tree[path] = (st.st_mode, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+        return st
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            add(os.path.join(dirpath, name))
+        subdirs = []
+        for name in dirnames:
+            st = add(os.path.join(dirpath, name))
+            # stay on the container filesystem
+            if st is not None and st.st_dev == root_dev:
+                subdirs.append(name)
+        dirnames[:] = subdirs
+    return tree
+
+
+def tree_changes(old, new):
+    """Return the number of new/changed entries and bytes in new/changed files"""
+    files = 0
+    size = 0
+    for path, entry in new.iteritems():
+        if old.get(path) != entry:
+            files += 1
+            if stat.S_ISREG(entry[0]):
+                size += entry[2]
+    return files, size
+
+
+def reap_orphans():
+    """The agent is pid 1, daemons left behind by RUN steps are reparented to it"""
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as exc:
+            if exc.errno == errno.ECHILD:
+                return
+            raise
+        if not pid:
+            return
+
+
+def agent_loop(sock):
+    """Serve build jobs inside the container namespace until told to exit"""
+    tree = None
+    snapshot_tree = None
+    while True:
+        reap_orphans()
+        message = recv_message(sock)
+        if message is None or message[0] == 'exit':
+            return
+        elif message[0] == 'run':
+            _, context, command = message
+            ret = fork_and_wait(exec_in_namespace, context, command)
+        elif message[0] == 'extract':
+            _, dest_dir = message
+            ret = fork_and_wait(extract_stream, sock, dest_dir)
+        elif message[0] == 'mark':
+            snapshot_tree = scan_tree()
+            ret = True
+        elif message[0] == 'snapshot':
+            new_tree = scan_tree()
+            ret = fork_and_wait(send_snapshot, sock, snapshot_tree or {}, new_tree)
+            snapshot_tree = new_tree
+        elif message[0] == 'scan':
+            new_tree = scan_tree()
+            ret = tree_changes(tree or {}, new_tree)
+            tree = new_tree
+        else:
+            raise RuntimeError('Unknown build job {0!r}'.format(message))
+        send_message(sock, ret)
+
+
+class BuildSession(object):
+    """A container namespace built once and reused for all build steps
+
+    A small agent lives inside the namespace and only forks for each job,
+    instead of every step unsharing namespaces, mapping ids and pivoting
+    root all over again.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.sock = None
+        self.pid = None
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.bytes_transferred = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        parent_sock, agent_sock = socket.socketpair()
+        for sock in (parent_sock, agent_sock):
+            flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+            fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.namespace.user_namespace.start_holder()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            self.namespace.execns(agent_loop, agent_sock)
+        agent_sock.close()
+        self.sock = parent_sock
+        self.pid = pid
+
+    def close(self):
+        if self.pid is None:
+            return
+        try:
+            send_message(self.sock, ('exit',))
+        except socket.error:
+            pass
+        self.sock.close()
+        _, ret = os.waitpid(self.pid, 0)
+        self.pid = None
+        if ret:
+            logger.warning('Build session agent exited with status {0}'.format(ret >> 8))
+
+    def reset_usage(self):
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.bytes_transferred = 0
+
+    def tree_usage(self):
+        """Return files and bytes written to the container since the last call"""
+        send_message(self.sock, ('scan',))
+        usage = recv_message(self.sock)
+        if usage is None:
+            raise RuntimeError('Build session agent died')
+        return usage
+
+    def result(self, what):
+        message = recv_message(self.sock)
+        if message is None:
+            raise RuntimeError('Build session agent died')
+        ret, cpu_user, cpu_system = message
+        self.cpu_user += cpu_user
+        self.cpu_system += cpu_system
+        exitcode = ret >> 8
+        exitsig = ret & 0x7f
+        if exitsig:
+            raise RuntimeError('{0} caught signal {1}'.format(what, exitsig))
+        elif exitcode:
+            raise RuntimeError('{0} exited with status {1}'.format(what, exitcode))
+
+    def discard_result(self):
+        message = recv_message(self.sock)
+        if message is not None:
+            self.cpu_user += message[1]
+            self.cpu_system += message[2]
+
+    def run(self, context, command):
+        # noinspection PyProtectedMember
+        context = context._replace(environ=dict(context.environ))
+        send_message(self.sock, ('run', context, command))
+        self.result('Subprocess')
+
+    def pump(self, rd):
+        try:
+            while True:
+                chunk = os.read(rd, 1 << 16)
+                if not chunk:
+                    break
+                send_frame(self.sock, chunk)
+                self.bytes_transferred += len(chunk)
+        finally:
+            os.close(rd)
+            send_frame(self.sock, '')
+
+    def mark_snapshot(self):
+        """Make the current container tree the base of the next snapshot"""
+        send_message(self.sock, ('mark',))
+        if recv_message(self.sock) is None:
+            raise RuntimeError('Build session agent died')
+
+    def snapshot(self, fp):
+        """Write a tar of what changed since the last snapshot (the whole container if none) to fp"""
+        send_message(self.sock, ('snapshot',))
+        error = None
+        while True:
+            frame = recv_frame(self.sock)
+            if not frame:
+                break
+            if error is None:
+                try:
+                    fp.write(frame)
+                except IOError as exc:
+                    # keep reading, the session has to stay in sync
+                    error = exc
+        self.result('Snapshot')
+        if error is not None:
+            raise error
+
+    def extract(self, dest_dir, build_tar_archive):
+        """Stream a tar archive written by build_tar_archive(fp) into dest_dir"""
+        send_message(self.sock, ('extract', dest_dir))
+        rd, wr = os.pipe()
+        pump = threading.Thread(target=self.pump, args=(rd,))
+        pump.start()
+        archive = os.fdopen(wr, 'w')
+        try:
+            try:
+                build_tar_archive(archive)
+            finally:
+                if not archive.closed:
+                    archive.close()
+                pump.join()
+        except:
+            # the agent replies anyway, the next job must not read it as its own
+            self.discard_result()
+            raise
+        self.result('Extraction')
@@ -0,0 +1,99 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import logging
+import os
+import re
+
+
+logger = logging.getLogger('shoebox.cache_mounts')
+
+CACHE_SHARING_MODES = ('locked', 'shared')
+
+
+class CacheMount(namedtuple('CacheMount', 'target id sharing')):
+    """Persistent directory mounted at target for a single RUN step
+
+    Mounts with the same id share the directory, id defaults to target.
+    'locked' mounts are used by one build at a time, 'shared' ones only
+    keep out exclusive users.
+    """
+
+    def __str__(self):
+        flags = ['type=cache', 'target={0}'.format(self.target)]
+        if self.id != self.target:
+            flags.append('id={0}'.format(self.id))
+        if self.sharing != 'locked':
+            flags.append('sharing={0}'.format(self.sharing))
+        return '--mount={0}'.format(','.join(flags))
+
+
+def parse_cache_mount(spec):
+    options = {}
+    for option in spec.split(','):
+        key, sep, value = option.partition('=')
+        if not sep:
+            raise ValueError('Invalid --mount option {0!r}'.format(option))
+        options[key] = value
+    mount_type = options.pop('type', None)
+    if mount_type != 'cache':
+        raise ValueError('Only --mount=type=cache is supported, not {0!r}'.format(mount_type))
+    try:
+        target = options.pop('target')
+    except KeyError:
+        raise ValueError('--mount=type=cache requires target')
+    mount_id = options.pop('id', target)
+    sharing = options.pop('sharing', 'locked')
+    if sharing not in CACHE_SHARING_MODES:
+        raise ValueError('Unsupported cache sharing mode {0!r}'.format(sharing))
+    if options:
+        raise ValueError('Unsupported --mount options: {0}'.format(', '.join(sorted(options))))
+    return CacheMount(target, mount_id, sharing)
+
+
+def cache_mount_dir(shoebox_dir, mount):
+    # readable but safe for any id, the hash keeps mangled ids apart
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', mount.id.strip('/'))[:64].lstrip('.')
+    return os.path.join(shoebox_dir, 'cache-mounts', '{0}-{1}'.format(
+        name, hashlib.sha256(mount.id).hexdigest()[:12]))
+
+
+@contextmanager
+def locked_cache_mounts(shoebox_dir, mounts):
+    """Lock and yield (host dir, target) pairs for mount_volumes"""
+    # one lock per id, a second flock on the same file would wait for ourselves
+    exclusive = {}
+    for mount in mounts:
+        exclusive[mount.id] = exclusive.get(mount.id, False) or mount.sharing == 'locked'
+    volumes = []
+    locks = {}
+    try:
+        # sorted by id so that concurrent builds lock in the same order
+        for mount in sorted(mounts, key=lambda m: m.id):
+            cache_dir = cache_mount_dir(shoebox_dir, mount)
+            volumes.append((cache_dir, mount.target))
+            if mount.id in locks:
+                continue
+            if not os.path.exists(cache_dir):
+                try:
+                    os.makedirs(cache_dir, mode=0o755)
+                except OSError:
+                    if not os.path.isdir(cache_dir):
+                        raise
+            lock = open(cache_dir + '.lock', 'a')
+            locks[mount.id] = lock
+            if exclusive[mount.id]:
+                mode = fcntl.LOCK_EX
+            else:
+                mode = fcntl.LOCK_SH
+            try:
+                fcntl.flock(lock, mode | fcntl.LOCK_NB)
+            except IOError:
+                logger.info('Waiting for cache {0}'.format(mount.id))
+                fcntl.flock(lock, mode)
+        # parents have to be mounted before nested targets
+        yield sorted(volumes, key=lambda volume: volume[1])
+    finally:
+        for lock in locks.itervalues():
+            lock.close()
@@ -0,0 +1,165 @@
+"""Index of containers, tags and running state in shoebox_dir/catalog.db
+
+The containers directory stays authoritative, the catalog only saves
+listing commands from walking and resolving all of it. It is rebuilt
+from disk when missing or of an older format.
+"""
+from contextlib import contextmanager
+from collections import namedtuple
+import json
+import logging
+import os
+import sqlite3
+
+from shoebox.container import Container, is_container_id
+
+
+logger = logging.getLogger('shoebox.catalog')
+
+# bump when the schema changes, older catalogs get rebuilt
+CATALOG_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE containers (
+    container_id TEXT PRIMARY KEY,
+    parent TEXT,
+    pid INTEGER,
+    ip_address TEXT
+);
+CREATE TABLE tags (
+    tag TEXT PRIMARY KEY,
+    container_id TEXT NOT NULL
+);
+CREATE INDEX tags_container_id ON tags (container_id);
+CREATE INDEX containers_pid ON containers (pid) WHERE pid IS NOT NULL;
+"""
+
+CatalogEntry = namedtuple('CatalogEntry', 'container_id parent pid ip_address tags')
+
+
+class Catalog(object):
+    def __init__(self, shoebox_dir):
+        self.shoebox_dir = os.path.expanduser(shoebox_dir)
+        self.container_dir = os.path.join(self.shoebox_dir, 'containers')
+        self.path = os.path.join(self.shoebox_dir, 'catalog.db')
+
+    @contextmanager
+    def transaction(self, readonly=False):
+        """Yield a connection, committing if the block succeeds
+
+        Writers wait for each other from the start, readonly blocks only
+        share the database with other readers.
+        """
+        if not os.path.exists(self.shoebox_dir):
+            os.makedirs(self.shoebox_dir, mode=0o755)
+        # builds and runs update the catalog concurrently, wait for each other
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.text_factory = str
+        try:
+            conn.execute('BEGIN' if readonly else 'BEGIN IMMEDIATE')
+            try:
+                if readonly and self.version(conn) != CATALOG_VERSION:
+                    # upgrading a read lock fails when a writer waits, start over as one
+                    conn.execute('ROLLBACK')
+                    conn.execute('BEGIN IMMEDIATE')
+                if self.version(conn) != CATALOG_VERSION:
+                    self.rebuild_tables(conn)
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def version(conn):
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def rebuild_tables(self, conn):
+        logger.debug('Rebuilding container catalog {0}'.format(self.path))
+        conn.execute('DROP TABLE IF EXISTS tags')
+        conn.execute('DROP TABLE IF EXISTS containers')
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+
+        if os.path.exists(self.container_dir):
+            names = os.listdir(self.container_dir)
+        else:
+            names = []
+        for name in names:
+            path = os.path.join(self.container_dir, name)
+            if is_container_id(name) and not os.path.islink(path):
+                container = Container(self.shoebox_dir, name)
+                try:
+                    with open(container.metadata_file) as fp:
+                        parent = json.load(fp).get('parent')
+                except (IOError, ValueError):
+                    parent = None
+                conn.execute('INSERT INTO containers VALUES (?, ?, ?, ?)',
+                             (name, parent, container.pid(), container.ip_address()))
+        for name in names:
+            path = os.path.join(self.container_dir, name)
+            if not is_container_id(name) and os.path.islink(path):
+                target = os.path.basename(os.path.realpath(path))
+                conn.execute('INSERT INTO tags SELECT ?, container_id FROM containers WHERE container_id = ?',
+                             (name, target))
+        conn.execute('PRAGMA user_version = {0:d}'.format(CATALOG_VERSION))
+
+    def rebuild(self):
+        with self.transaction() as conn:
+            self.rebuild_tables(conn)
+
+    def add_container(self, container_id, parent=None):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO containers VALUES (?, ?, NULL, NULL)', (container_id, parent))
+
+    def remove_container(self, container_id):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM tags WHERE container_id = ?', (container_id,))
+            conn.execute('DELETE FROM containers WHERE container_id = ?', (container_id,))
+
+    def set_running(self, container_id, pid, ip_address=None):
+        with self.transaction() as conn:
+            conn.execute('UPDATE containers SET pid = ?, ip_address = ? WHERE container_id = ?',
+                         (pid, ip_address, container_id))
+
+    def set_stopped(self, container_id):
+        self.set_running(container_id, None)
+
+    def tag(self, tag, container_id):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO tags VALUES (?, ?)', (tag, container_id))
+
+    def untag(self, tag):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM tags WHERE tag = ?', (tag,))
+
+    def containers(self, running=False):
+        """Return a CatalogEntry for every (running) container"""
+        query = 'SELECT container_id, parent, pid, ip_address FROM containers'
+        if running:
+            query += ' WHERE pid IS NOT NULL'
+        with self.transaction(readonly=True) as conn:
+            rows = conn.execute(query + ' ORDER BY container_id').fetchall()
+            tags = {}
+            for tag, container_id in conn.execute('SELECT tag, container_id FROM tags ORDER BY tag'):
+                tags.setdefault(container_id, []).append(tag)
+        return [CatalogEntry(*row, tags=tags.get(row[0], [])) for row in rows]
+
+    def tags(self, name):
+        """Return the tags of a container, by id or by any of its tags"""
+        with self.transaction(readonly=True) as conn:
+            rows = conn.execute('SELECT tag FROM tags WHERE container_id = '
+                                'COALESCE((SELECT container_id FROM tags WHERE tag = ?), ?) ORDER BY tag',
+                                (name, name)).fetchall()
+        return [tag for tag, in rows]
+
+    def resolve(self, name):
+        """Return the id of the container tagged name, name itself if it isn't a tag"""
+        if is_container_id(name):
+            return name
+        with self.transaction(readonly=True) as conn:
+            row = conn.execute('SELECT container_id FROM tags WHERE tag = ?', (name,)).fetchone()
+        return row[0] if row else name
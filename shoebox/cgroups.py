@@ -0,0 +1,219 @@
+"""Resource limits through a delegated cgroup v2 subtree
+
+Containers get a cgroup below <closest delegated ancestor of our own
+cgroup>/shoebox, e.g. app.slice of user@.service or the scope started by
+systemd-run --user --scope -p Delegate=yes. Nothing is created without
+limits, so runs still work where cgroups are not delegated.
+"""
+from collections import namedtuple
+import errno
+import logging
+import os
+import re
+import time
+
+from shoebox.trace import span
+
+
+logger = logging.getLogger('shoebox.cgroups')
+
+CPU_PERIOD = 100000
+
+# any of them may be None for no limit
+ResourceLimits = namedtuple('ResourceLimits', 'memory cpus cpu_weight io_weight pids_limit')
+NO_LIMITS = ResourceLimits(None, None, None, None, None)
+
+MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_memory(value):
+    """Convert 512m, 2g etc. to bytes"""
+    match = re.match(r'^(\d+)([bkmgt]?)$', value.strip().lower())
+    if not match:
+        raise ValueError('Invalid memory size {0!r}'.format(value))
+    return int(match.group(1)) * MEMORY_UNITS[match.group(2)]
+
+
+def merge_limits(limits, overrides):
+    """Return limits with every limit set in overrides replaced"""
+    # noinspection PyProtectedMember
+    return limits._replace(**dict((k, v) for k, v in overrides._asdict().items() if v is not None))
+
+
+def shares_to_weight(shares):
+    # same conversion as runc, cpu.shares 2..262144 to cpu.weight 1..10000
+    return 1 + ((shares - 2) * 9999) // 262142
+
+
+def weight_to_shares(weight):
+    return 2 + ((weight - 1) * 262142) // 9999
+
+
+def cgroup_files(limits):
+    """Return (controller, file, value) to write for limits"""
+    files = []
+    if limits.memory is not None:
+        files.append(('memory', 'memory.max', str(limits.memory)))
+    if limits.cpus is not None:
+        files.append(('cpu', 'cpu.max', '{0} {1}'.format(int(limits.cpus * CPU_PERIOD), CPU_PERIOD)))
+    if limits.cpu_weight is not None:
+        files.append(('cpu', 'cpu.weight', str(limits.cpu_weight)))
+    if limits.io_weight is not None:
+        files.append(('io', 'io.weight', 'default {0}'.format(limits.io_weight)))
+    if limits.pids_limit is not None:
+        files.append(('pids', 'pids.max', str(limits.pids_limit)))
+    return files
+
+
+def cgroup2_mountpoint():
+    with open('/proc/self/mountinfo') as fp:
+        for line in fp:
+            fields = line.split()
+            # optional fields end with '-', then fstype
+            if fields[fields.index('-') + 1] == 'cgroup2':
+                return fields[4]
+
+
+def is_delegated(path, controllers):
+    """Can we create children of path with controllers enabled in them"""
+    if not os.access(path, os.W_OK) or not os.access(os.path.join(path, 'cgroup.subtree_control'), os.W_OK):
+        return False
+    # listed in the parent's cgroup.subtree_control
+    with open(os.path.join(path, 'cgroup.controllers')) as fp:
+        return controllers <= set(fp.read().split())
+
+
+def delegated_root(controllers):
+    mountpoint = cgroup2_mountpoint()
+    if mountpoint is None:
+        raise RuntimeError('Resource limits need cgroup v2, which is not mounted')
+    own = cgroup_of('self', mountpoint)
+    if own is None:
+        raise RuntimeError('Cannot find own cgroup v2')
+    own = os.path.normpath(own)
+    # our own cgroup has processes, so we can't put children there (unless
+    # it's the root). Only ancestors work, moving processes needs write
+    # access to a common one
+    path = own
+    candidates = [own] if own == mountpoint else []
+    while path != mountpoint:
+        path = os.path.dirname(path)
+        candidates.append(path)
+    for path in candidates:
+        if is_delegated(path, controllers):
+            return path
+    raise RuntimeError('No cgroup above {0} is delegated with {1} controllers, run shoebox in a delegated scope, '
+                       'e.g. systemd-run --user --scope -p Delegate=yes shoebox ...'.format(
+                           own, ', '.join(sorted(controllers))))
+
+
+def cgroup_of(pid, mountpoint=None):
+    """Return the cgroup v2 directory of pid, None if unknown"""
+    mountpoint = mountpoint or cgroup2_mountpoint()
+    if mountpoint is None:
+        return
+    try:
+        with open('/proc/{0}/cgroup'.format(pid)) as fp:
+            for line in fp:
+                hierarchy, _, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0':
+                    return os.path.join(mountpoint, path.lstrip('/'))
+    except IOError:
+        return
+
+
+def join_cgroup_of(pid):
+    """Move the calling process into the cgroup v2 of pid, to share its limits"""
+    path = cgroup_of(pid)
+    if path is None:
+        return
+    try:
+        with open(os.path.join(path, 'cgroup.procs'), 'w') as procs:
+            procs.write(str(os.getpid()))
+    except (IOError, OSError) as exc:
+        logger.debug('Cannot join cgroup of {0}: {1}'.format(pid, exc))
+
+
+class Cgroup(object):
+    """cgroup limiting a container, joined by its namespace before unshare"""
+
+    def __init__(self, name, limits=None):
+        self.name = name
+        self.limits = limits or NO_LIMITS
+        self.path = None
+
+    def __repr__(self):
+        return '{0} {1!r}'.format(self.path or self.name, self.limits)
+
+    def __enter__(self):
+        with span('create_cgroup'):
+            self.create()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.remove()
+
+    def enable_controllers(self, path, controllers):
+        with open(os.path.join(path, 'cgroup.controllers')) as fp:
+            available = fp.read().split()
+        missing = controllers - set(available)
+        if missing:
+            raise RuntimeError('cgroup controllers {0} are not delegated to {1}'.format(
+                ', '.join(sorted(missing)), path))
+        with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as fp:
+            fp.write(' '.join('+' + controller for controller in sorted(controllers)))
+
+    def create(self):
+        files = cgroup_files(self.limits)
+        if not files:
+            return
+        controllers = set(controller for controller, _, _ in files)
+        root = delegated_root(controllers)
+        base = os.path.join(root, 'shoebox')
+        path = os.path.join(base, self.name)
+        try:
+            if not os.path.exists(base):
+                os.mkdir(base)
+            self.enable_controllers(root, controllers)
+            self.enable_controllers(base, controllers)
+            os.mkdir(path)
+        except (IOError, OSError) as exc:
+            raise RuntimeError('Cannot create cgroup {0} for resource limits: {1}'.format(path, exc))
+        self.path = path
+        try:
+            for _, name, value in files:
+                with open(os.path.join(path, name), 'w') as fp:
+                    fp.write(value)
+        except (IOError, OSError) as exc:
+            self.remove()
+            raise RuntimeError('Cannot set {0} to {1}: {2}'.format(name, value, exc))
+        logger.debug('Created cgroup {0!r}'.format(self))
+
+    def join(self):
+        """Move the calling process into the cgroup, children follow"""
+        if self.path is None:
+            return
+        with open(os.path.join(self.path, 'cgroup.procs'), 'w') as fp:
+            fp.write(str(os.getpid()))
+
+    def remove(self):
+        if self.path is None:
+            return
+        kill_file = os.path.join(self.path, 'cgroup.kill')
+        if os.path.exists(kill_file):
+            # stragglers, after the container's pid 1 is gone they can't stay anyway
+            with open(kill_file, 'w') as fp:
+                fp.write('1')
+        for _ in range(100):
+            try:
+                os.rmdir(self.path)
+                break
+            except OSError as exc:
+                if exc.errno != errno.EBUSY:
+                    raise
+                # exiting processes take a moment to leave
+                time.sleep(0.01)
+        else:
+            logger.warning('Cannot remove cgroup {0}, processes left'.format(self.path))
+        self.path = None
+
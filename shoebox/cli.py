@@ -1,5 +1,7 @@
+import functools
 import json
 import logging
+import multiprocessing
 import os
 import sys
 
@@ -7,12 +9,23 @@ import click
 
 from shoebox import utils
 from shoebox.build import build_container
+from shoebox.build_cache import BuildCache
+from shoebox.build_graph import build_graph
+from shoebox.build_profile import BuildProfiler
+from shoebox.catalog import Catalog
+from shoebox.cgroups import Cgroup, NO_LIMITS, ResourceLimits, parse_memory
+from shoebox.commit import commit_container, container_diff
 from shoebox.container import Container, ContainerLink
 from shoebox.dockerfile import parse_dockerfile
+from shoebox.exec_container import exec_container
+from shoebox.mount_namespace import check_tmpfs_size, parse_tmpfs
 from shoebox.networking import PrivateNetwork
+from shoebox.pool import ZygotePool, run_in_pool
 from shoebox.pull import DEFAULT_INDEX, ImageRepository
-from shoebox.rm import remove_container
-from shoebox.run import run_container, load_container, clone_image
+from shoebox.rm import remove_containers
+from shoebox.run import run_container, run_context, load_container, clone_image
+from shoebox.stats import container_stats
+from shoebox.trace import TRACE_FORMATS, start_tracing, write_trace
 from shoebox.user_namespace import UserNamespace
 
 
@@ -42,6 +55,50 @@ def cli(ctx, shoebox_dir, index_url, debug):
         logger.setLevel(logging.INFO)
 
 
+def memory_size(ctx, param, value):
+    if value is None:
+        return
+    try:
+        return parse_memory(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+def tmpfs_spec(ctx, param, value):
+    try:
+        return [parse_tmpfs(spec) for spec in value]
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+def tmpfs_size(ctx, param, value):
+    try:
+        return check_tmpfs_size(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+def limit_options(func):
+    """Add resource limit options, passed as limits=ResourceLimits"""
+    options = [
+        click.option('--memory', '-m', callback=memory_size, help='memory limit (e.g. 512m, 2g)'),
+        click.option('--cpus', help='number of CPUs to use at most', type=click.FLOAT),
+        click.option('--cpu-weight', help='CPU share relative to other containers (1-10000, default 100)',
+                     type=click.IntRange(1, 10000)),
+        click.option('--io-weight', help='I/O share relative to other containers (1-10000, default 100)',
+                     type=click.IntRange(1, 10000)),
+        click.option('--pids-limit', help='maximum number of processes', type=click.IntRange(1)),
+    ]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        kwargs['limits'] = ResourceLimits(*[kwargs.pop(name) for name in ResourceLimits._fields])
+        return func(*args, **kwargs)
+    for option in reversed(options):
+        wrapper = option(wrapper)
+    return wrapper
+
+
 @cli.command()
 @click.argument('image')
 @click.option('--tag', '-t', default='latest', help='image tag (version)')
@@ -80,9 +137,44 @@ def ls(obj, quiet):
 
 
 @cli.command()
+@click.option('--json', 'as_json', is_flag=True, help='print processes as JSON')
 @click.pass_obj
-def ps(obj):
-    utils.ps(obj['shoebox_dir'])
+def ps(obj, as_json):
+    utils.ps(obj['shoebox_dir'], as_json)
+
+
+@cli.command()
+@click.pass_obj
+def reindex(obj):
+    """Rebuild the container catalog from the containers directory"""
+    Catalog(obj['shoebox_dir']).rebuild()
+
+
+@cli.command('prune-cache')
+@click.option('--max-size', default='10g', callback=memory_size, help='size to shrink the build cache to')
+@click.option('--max-age', default=30, type=click.IntRange(0), help='delete snapshots unused for this many days')
+@click.pass_obj
+def prune_cache(obj, max_size, max_age):
+    """Delete old build cache snapshots"""
+    removed, size = BuildCache(obj['shoebox_dir']).prune(max_size, max_age * 86400)
+    print 'Deleted {0} snapshots, {1}'.format(removed, utils.format_size(size))
+
+
+@cli.command()
+@click.argument('container_id', nargs=-1)
+@click.option('--interval', default=1.0, help='seconds between samples', type=click.FLOAT)
+@click.option('--once', is_flag=True, help='print a single sample and exit')
+@click.option('--json', 'as_json', is_flag=True, help='print JSON lines, one per container and sample')
+@click.pass_obj
+def stats(obj, container_id, interval, once, as_json):
+    """Show CPU, memory, I/O, fds and network usage of running containers"""
+    try:
+        container_stats(obj['shoebox_dir'], container_id, max(interval, 0.1), once, as_json)
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
 
 
 @cli.command(name='tag')
@@ -112,21 +204,105 @@ def untag(obj, tag):
 @cli.command()
 @click.argument('base_dir')
 @click.option('--force/--no-force', default=False, help='force download')
+@click.option('--cache/--no-cache', default=True, help='reuse snapshots of unchanged build steps')
+@click.option('--into', help='rebuild into an existing container, copying only changed files')
+@click.option('--profile/--no-profile', default=False, help='log time and I/O spent in every instruction')
+@click.option('--profile-report', type=click.Path(writable=True), help='write build profile as JSON')
 @click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
 @click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
+@limit_options
 @click.pass_obj
-def build(obj, base_dir, force, target_uid, target_gid):
+def build(obj, base_dir, force, cache, into, profile, profile_report, target_uid, target_gid, limits):
     repo = obj['repo']
     shoebox_dir = obj['shoebox_dir']
 
+    if profile_report:
+        profile_report = os.path.abspath(profile_report)
     os.chdir(base_dir)
-    dockerfile = parse_dockerfile(open('Dockerfile').read(), repo=repo)
+    try:
+        dockerfile = parse_dockerfile(open('Dockerfile').read(), repo=repo)
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
     userns = UserNamespace(target_uid, target_gid)
-    container = build_container(os.getcwd(), force, dockerfile, repo, shoebox_dir, userns)
+    profiler = None
+    if profile or profile_report:
+        if not os.path.exists(shoebox_dir):
+            os.makedirs(shoebox_dir)
+        profiler = BuildProfiler(shoebox_dir)
+    try:
+        with Cgroup('build-{0}'.format(os.getpid()), limits) as cgroup:
+            container = build_container(os.getcwd(), force, dockerfile, repo, shoebox_dir, userns, use_cache=cache,
+                                        profiler=profiler, into=into, cgroup=cgroup)
+        if profiler:
+            profiler.log_summary()
+            if profile_report:
+                with open(profile_report, 'w') as fp:
+                    json.dump(profiler.report(), fp, indent=4)
+    finally:
+        if profiler:
+            profiler.close()
 
     print container.container_id
 
 
+@cli.command('build-graph')
+@click.argument('base_dirs', nargs=-1, required=True)
+@click.option('--force/--no-force', default=False, help='force download')
+@click.option('--cache/--no-cache', default=True, help='reuse snapshots of unchanged build steps')
+@click.option('--jobs', '-j', default=multiprocessing.cpu_count(), help='number of concurrent builds', type=click.INT)
+@click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
+@click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
+@limit_options
+@click.pass_obj
+def build_graph_cmd(obj, base_dirs, force, cache, jobs, target_uid, target_gid, limits):
+    """Build DIR[:TAG]... in dependency order, tagging each build"""
+    userns = UserNamespace(target_uid, target_gid)
+    try:
+        with Cgroup('build-{0}'.format(os.getpid()), limits) as cgroup:
+            build_graph(base_dirs, force, obj['repo'], obj['shoebox_dir'], userns, max(jobs, 1), use_cache=cache,
+                        cgroup=cgroup)
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('container_id')
+@click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
+@click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
+@click.pass_obj
+def diff(obj, container_id, target_uid, target_gid):
+    """List files added (A), changed (C) or deleted (D) in a container"""
+    userns = UserNamespace(target_uid, target_gid)
+    try:
+        container_diff(obj['shoebox_dir'], container_id, userns)
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('container_id')
+@click.option('--output', '-o', type=click.Path(file_okay=False),
+              help='directory for the layer (default: image storage)')
+@click.option('--threads', default=multiprocessing.cpu_count(), help='compression threads', type=click.INT)
+@click.option('--level', default=6, help='gzip compression level', type=click.IntRange(1, 9))
+@click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
+@click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
+@click.pass_obj
+def commit(obj, container_id, output, threads, level, target_uid, target_gid):
+    """Save container changes as an image layer, print its id"""
+    userns = UserNamespace(target_uid, target_gid)
+    try:
+        image_id = commit_container(obj['shoebox_dir'], container_id, userns,
+                                    output or obj['repo'].storage_dir, max(threads, 1), level)
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
+    print image_id
+
+
 @cli.command()
 @click.argument('container_id', required=False)
 @click.argument('command', nargs=-1)
@@ -134,21 +310,51 @@ def build(obj, base_dir, force, target_uid, target_gid):
               help='bridge to attach private network (requires lxc installed), None to disable')
 @click.option('--entrypoint', help='override image entrypoint')
 @click.option('--env', '-e', multiple=True, help='extra environment variables')
+@click.option('--ephemeral', is_flag=True, help='keep changes in memory only, they are gone after the run')
+@click.option('--ephemeral-size', default='1g', callback=tmpfs_size,
+              help='size limit of --ephemeral changes (e.g. 512m, 25%)')
 @click.option('--force/--no-force', default=False, help='force download')
 @click.option('--from', 'from_image', help='create new container from image')
 @click.option('--ip', help='private IP address (when using --bridge)')
 @click.option('--link', multiple=True, help='link containers')
+@click.option('--pool', is_flag=True, help='run in a namespace prepared by shoebox pool')
 @click.option('--rm/--no-rm', help='remove container after exit')
 @click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
 @click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
+@click.option('--tmpfs', multiple=True, callback=tmpfs_spec,
+              help='mount a tmpfs at /path[:size], creating /path in the container if missing')
+@click.option('--trace-startup', type=click.Path(writable=True, dir_okay=False),
+              help='write timings of container startup phases to this file')
+@click.option('--trace-format', type=click.Choice(TRACE_FORMATS), default='chrome',
+              help='chrome (for chrome://tracing or Perfetto) or plain json')
 @click.option('--user', '-u', help='user to run as')
 @click.option('--workdir', '-w', help='work directory')
+@limit_options
 @click.pass_obj
-def run(obj, container_id, command, bridge, entrypoint, env, force, from_image, ip, link, rm,
-        target_uid, target_gid, user, workdir):
+def run(obj, container_id, command, bridge, entrypoint, env, ephemeral, ephemeral_size, force, from_image, ip, link,
+        pool, rm, target_uid, target_gid, tmpfs, trace_startup, trace_format, user, workdir, limits):
     shoebox_dir = obj['shoebox_dir']
     repo = obj['repo']
 
+    if pool:
+        unsupported = [option for option, value in (
+            ('--bridge', bridge != 'auto'), ('--ephemeral-size', ephemeral_size != '1g'), ('--force', force),
+            ('--from', from_image), ('--ip', ip), ('--link', link), ('--rm', rm), ('--target-uid', target_uid),
+            ('--target-gid', target_gid), ('--tmpfs', tmpfs), ('--trace-startup', trace_startup),
+            ('resource limits', limits != NO_LIMITS)) if value]
+        if unsupported:
+            obj['logger'].error('Cannot use {0} with --pool, its namespaces are set up already'.format(
+                ', '.join(unsupported)))
+            sys.exit(1)
+        try:
+            container = load_container(container_id, shoebox_dir)
+            context, command = run_context(container, command, entrypoint, user, workdir, env=env)
+            sys.exit(run_in_pool(shoebox_dir, Catalog(shoebox_dir).resolve(container.container_id),
+                                 context, command))
+        except RuntimeError as exc:
+            obj['logger'].error(exc)
+            sys.exit(1)
+
     if bridge != 'None' and ip is not None:
         private_net = PrivateNetwork(bridge, ip)
     else:
@@ -171,7 +377,51 @@ def run(obj, container_id, command, bridge, entrypoint, env, force, from_image,
     else:
         container = clone_image(force, from_image, repo, shoebox_dir, userns)
 
-    run_container(container, userns, shoebox_dir, command, entrypoint, user, workdir, rm, private_net, links, env)
+    if trace_startup:
+        trace_startup = os.path.abspath(trace_startup)
+        start_tracing()
+    try:
+        run_container(container, userns, shoebox_dir, command, entrypoint, user, workdir, rm, private_net, links, env,
+                      limits, ephemeral_size if ephemeral else None, tmpfs)
+    finally:
+        if trace_startup:
+            write_trace(trace_startup, trace_format)
+
+
+@cli.command(name='exec')
+@click.argument('container_id')
+@click.argument('command', nargs=-1, required=True)
+@click.option('--env', '-e', multiple=True, help='extra environment variables')
+@click.option('--user', '-u', help='user to run as')
+@click.option('--workdir', '-w', help='work directory')
+@click.pass_obj
+def exec_command(obj, container_id, command, env, user, workdir):
+    """Run a command in a running container"""
+    try:
+        sys.exit(exec_container(obj['shoebox_dir'], container_id, command, user, workdir, env))
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('container_id')
+@click.option('--size', default=2, type=click.IntRange(1), help='parked namespaces to keep ready')
+@click.option('--max-size', default=16, type=click.IntRange(1), help='most namespaces at a time, parked or running')
+@click.option('--ephemeral-size', default='1g', callback=tmpfs_size, help='size limit of changes of each run')
+@click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
+@click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
+@click.pass_obj
+def pool(obj, container_id, size, max_size, ephemeral_size, target_uid, target_gid):
+    """Keep namespaces of a container ready for run --pool"""
+    shoebox_dir = obj['shoebox_dir']
+    userns = UserNamespace(target_uid, target_gid)
+    try:
+        ZygotePool(shoebox_dir, load_container(container_id, shoebox_dir), userns, size, max_size,
+                   ephemeral_size).serve()
+    except RuntimeError as exc:
+        obj['logger'].error(exc)
+        sys.exit(1)
 
 
 @cli.command()
@@ -179,9 +429,9 @@ def run(obj, container_id, command, bridge, entrypoint, env, force, from_image,
 @click.option('--target-uid', '-U', help='UID inside container (default: use newuidmap)', type=click.INT)
 @click.option('--target-gid', '-G', help='GID inside container (default: use newgidmap)', type=click.INT)
 @click.option('--volumes/--no-volumes', '-v', help='Also remove container volumes')
+@click.option('--background', is_flag=True, help='return at once, delete files in the background')
 @click.pass_obj
-def rm(obj, container_id, target_uid, target_gid, volumes):
-    shoebox_dir = obj['shoebox_repo']
+def rm(obj, container_id, target_uid, target_gid, volumes, background):
+    shoebox_dir = obj['shoebox_dir']
     userns = UserNamespace(target_uid, target_gid)
-    for container in container_id:
-        remove_container(shoebox_dir, container, userns, volumes)
+    remove_containers(shoebox_dir, container_id, userns, volumes, background)
@@ -0,0 +1,234 @@
+"""Turn the overlay upper dir of a container into an image layer
+
+Overlayfs marks deleted files with 0/0 character devices and directories
+replacing a lower one with an opaque xattr, image layers use .wh.<name>
+and .wh..wh..opq entries for the same.
+
+trusted.* xattrs can only be read by root outside any user namespace,
+so opaque directories are looked up before entering the container's
+namespace. Without root, only user.overlay.opaque can be seen.
+"""
+from collections import namedtuple
+import json
+import logging
+import multiprocessing
+import os
+import stat
+import sys
+import tarfile
+
+from shoebox.build_cache import SnapshotTarFile
+from shoebox.build_manifest import BuildManifest
+from shoebox.dockerfile import to_docker_metadata
+from shoebox.libc import lgetxattr
+from shoebox.mount_namespace import FilesystemNamespace
+from shoebox.namespaces import ContainerNamespace
+from shoebox.parallel_gzip import ParallelGzipWriter
+from shoebox.run import load_container
+
+
+logger = logging.getLogger('shoebox.commit')
+
+OPAQUE_XATTRS = ('trusted.overlay.opaque', 'user.overlay.opaque')
+OPAQUE_MARKER = '.wh..wh..opq'
+
+Change = namedtuple('Change', 'kind path opaque')
+
+
+def is_whiteout(st):
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def is_opaque(path):
+    return any(lgetxattr(path, name) == 'y' for name in OPAQUE_XATTRS)
+
+
+def can_read_trusted_xattrs():
+    if os.geteuid() != 0:
+        return False
+    try:
+        # the initial user namespace maps all ids to themselves
+        with open('/proc/self/uid_map') as fp:
+            return fp.read().split() == ['0', '0', '4294967295']
+    except IOError:
+        return False
+
+
+def find_opaque_dirs(delta_dir):
+    """Return paths of opaque directories in delta_dir, None if we can't tell"""
+    if not can_read_trusted_xattrs():
+        return None
+    opaque = set()
+    for dirpath, dirnames, _ in os.walk(delta_dir):
+        for name in dirnames:
+            full_path = os.path.join(dirpath, name)
+            if not os.path.islink(full_path) and is_opaque(full_path):
+                opaque.add('/' + os.path.relpath(full_path, delta_dir))
+    return opaque
+
+
+class OpaqueCheck(object):
+    """Tell opaque directories, from find_opaque_dirs() or from user.* xattrs only"""
+
+    def __init__(self, opaque_dirs):
+        self.opaque_dirs = opaque_dirs
+        self.warned = False
+
+    def __call__(self, delta_dir, path):
+        if self.opaque_dirs is not None:
+            return path in self.opaque_dirs
+        if is_opaque(delta_dir + path):
+            return True
+        if not self.warned:
+            logger.warning('Cannot read trusted.overlay.opaque without root, directories replaced as a whole '
+                           '(e.g. rm -r and mkdir) keep what lower layers had in them')
+            self.warned = True
+        return False
+
+
+def scan_delta(delta_dir, base_dir, opaque_check=None):
+    """Yield a Change for everything in delta_dir, parents first
+
+    kind is A (added), C (changed) or D (deleted), like docker diff.
+    Only changed directories can be opaque.
+    """
+    opaque_check = opaque_check or OpaqueCheck(None)
+    for dirpath, dirnames, filenames in os.walk(delta_dir):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            full_path = os.path.join(dirpath, name)
+            path = '/' + os.path.relpath(full_path, delta_dir)
+            st = os.lstat(full_path)
+            if is_whiteout(st):
+                yield Change('D', path, False)
+                continue
+            kind = 'C' if os.path.lexists(base_dir + path) else 'A'
+            opaque = kind == 'C' and stat.S_ISDIR(st.st_mode) and opaque_check(delta_dir, path)
+            yield Change(kind, path, opaque)
+
+
+def scan_base(delta_dir, base_dir, opaque_check):
+    """Yield paths in base_dir that delta_dir neither hides nor replaces"""
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        dirnames.sort()
+        directory = '/' + os.path.relpath(dirpath, base_dir).lstrip('.')
+        descend = []
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(directory, name)
+            upper = delta_dir + path
+            if not os.path.lexists(upper):
+                yield path
+                if name in dirnames:
+                    descend.append(name)
+            elif name in dirnames and not os.path.islink(upper) and os.path.isdir(upper) and \
+                    not opaque_check(delta_dir, path):
+                # merged directory, delta has some of its contents
+                descend.append(name)
+        dirnames[:] = descend
+
+
+def print_diff(delta_dir, base_dir):
+    for change in scan_delta(delta_dir, base_dir, OpaqueCheck(set())):
+        print change.kind, change.path
+    sys.stdout.flush()
+
+
+def write_layer(fp, delta_dir, base_dir, opaque_dirs=None, full=False):
+    """Write the changes in delta_dir as a layer on top of base_dir
+
+    With full, write the whole merged tree as a layer without a parent.
+    """
+    opaque_check = OpaqueCheck(opaque_dirs)
+    tar = SnapshotTarFile.open(fileobj=fp, mode='w|')
+    for change in scan_delta(delta_dir, base_dir, opaque_check):
+        arcname = change.path.lstrip('/')
+        if change.kind == 'D':
+            if not full:
+                directory, base = os.path.split(arcname)
+                tar.addfile(tarfile.TarInfo(os.path.join(directory, '.wh.' + base)))
+            continue
+        tar.add(delta_dir + change.path, arcname=arcname, recursive=False)
+        if change.opaque and not full:
+            # ahead of the directory contents, which it must not hide
+            tar.addfile(tarfile.TarInfo(os.path.join(arcname, OPAQUE_MARKER)))
+    if full:
+        for path in scan_base(delta_dir, base_dir, opaque_check):
+            tar.add(base_dir + path, arcname=path.lstrip('/'), recursive=False)
+    tar.close()
+    fp.close()
+
+
+def runtime_namespace(container, userns):
+    # base and delta are owned by container users, look at them from inside
+    return ContainerNamespace(FilesystemNamespace(container.runtime_dir), userns)
+
+
+def container_diff(shoebox_dir, container_id, userns):
+    container = load_container(container_id, shoebox_dir)
+    if not os.path.exists(container.target_delta):
+        return
+    runtime_namespace(container, userns).run(print_diff, '/delta', '/base')
+
+
+def commit_container(shoebox_dir, container_id, userns, output_dir, threads=None, level=6):
+    """Write the changes of a container as a gzipped layer plus its metadata
+
+    Files are named <image id> and <image id>.json, as for images pulled
+    into the repository. Returns the image id.
+    """
+    container = load_container(container_id, shoebox_dir)
+    if not os.path.exists(container.target_delta):
+        os.makedirs(container.target_delta, mode=0o755)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, mode=0o755)
+
+    image_id = os.urandom(32).encode('hex')
+    layer_path = os.path.join(output_dir, image_id)
+    tmp_path = '{0}.{1}.tmp'.format(layer_path, os.getpid())
+    threads = threads or multiprocessing.cpu_count()
+    logger.info('Committing {0} as {1}'.format(container.container_id, image_id))
+
+    with open(container.metadata_file) as fp:
+        parent = json.load(fp).get('parent')
+    manifest = BuildManifest(container)
+    # build steps went into base, which is not the parent image any more
+    full = parent is None or (manifest.load() and bool(manifest.steps))
+    if full:
+        logger.info('Base of {0} is not its parent image, committing all of it as a single layer'.format(
+            container.container_id))
+        parent = None
+    opaque_dirs = find_opaque_dirs(container.target_delta)
+
+    userns.start_holder()
+    rpipe, wpipe = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rpipe)
+        runtime_namespace(container, userns).execns(
+            write_layer, os.fdopen(wpipe, 'w'), '/delta', '/base', opaque_dirs, full)
+    os.close(wpipe)
+    size = 0
+    try:
+        with os.fdopen(rpipe) as layer, open(tmp_path, 'wb') as fp:
+            gz = ParallelGzipWriter(fp, threads, level)
+            while True:
+                chunk = layer.read(1 << 20)
+                if not chunk:
+                    break
+                size += len(chunk)
+                gz.write(chunk)
+            gz.close()
+    finally:
+        _, ret = os.waitpid(pid, 0)
+    if ret:
+        os.unlink(tmp_path)
+        raise RuntimeError('Scanning changes of {0} failed'.format(container.container_id))
+    os.rename(tmp_path, layer_path)
+
+    metadata = to_docker_metadata(image_id, container.metadata)
+    metadata['parent'] = parent
+    metadata['container'] = container.container_id
+    metadata['Size'] = size
+    with open(layer_path + '.json', 'w') as fp:
+        json.dump(metadata, fp)
+    return image_id
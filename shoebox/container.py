@@ -1,11 +1,16 @@
 import json
+import marshal
 import os
 import re
 
-from shoebox.dockerfile import from_docker_metadata, to_docker_metadata
+from shoebox.dockerfile import to_docker_metadata, compact_docker_metadata, from_compact_metadata
 from shoebox.mount_namespace import FilesystemNamespace
 
 
+# bump when the compact metadata format changes
+METADATA_CACHE_VERSION = 2
+
+
 def mangle_volume_name(vol):
     return vol.strip('/').replace('_', '__').replace('/', '_')
 
@@ -17,11 +22,15 @@ def is_container_id(container_id):
 class Container(object):
     def __init__(self, shoebox_dir, container_id):
         self.container_id = container_id
+        self.shoebox_dir = shoebox_dir
         self.container_base_dir = os.path.join(shoebox_dir, 'containers')
         self.runtime_dir = os.path.join(shoebox_dir, 'containers', container_id)
         self.metadata_file = os.path.join(self.runtime_dir, 'metadata.json')
+        self.metadata_cache_file = os.path.join(self.runtime_dir, 'metadata.cache')
+        self.build_manifest_file = os.path.join(self.runtime_dir, 'build-manifest.json')
         self.target_base = os.path.join(self.runtime_dir, 'base')
         self.target_delta = os.path.join(self.runtime_dir, 'delta')
+        self.target_ephemeral = os.path.join(self.runtime_dir, 'ephemeral')
         self.target_root = os.path.join(self.runtime_dir, 'root')
         self.volume_root = os.path.join(self.runtime_dir, 'volumes')
         self.pidfile = os.path.join(self.runtime_dir, 'pid')
@@ -29,12 +38,43 @@ class Container(object):
         self.metadata = None
 
     def load_metadata(self):
-        self.metadata = from_docker_metadata(json.load(open(self.metadata_file)))
+        compact = self.load_metadata_cache()
+        if compact is None:
+            compact = compact_docker_metadata(json.load(open(self.metadata_file)))
+            self.save_metadata_cache(compact)
+        self.metadata = from_compact_metadata(compact)
 
     def save_metadata(self, metadata):
         self.metadata = metadata
+        docker_metadata = to_docker_metadata(self.container_id, metadata)
         with open(self.metadata_file, 'w') as fp:
-            json.dump(to_docker_metadata(self.container_id, metadata), fp, indent=4)
+            json.dump(docker_metadata, fp, indent=4)
+        self.save_metadata_cache(compact_docker_metadata(docker_metadata))
+
+    def metadata_stamp(self):
+        st = os.stat(self.metadata_file)
+        return st.st_size, st.st_mtime
+
+    def load_metadata_cache(self):
+        """Return compact metadata if the cache is still valid for metadata.json"""
+        try:
+            with open(self.metadata_cache_file, 'rb') as fp:
+                version, stamp, compact = marshal.load(fp)
+            if version == METADATA_CACHE_VERSION and stamp == self.metadata_stamp():
+                return compact
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+    def save_metadata_cache(self, compact):
+        tmp_file = '{0}.{1}.tmp'.format(self.metadata_cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as fp:
+                marshal.dump((METADATA_CACHE_VERSION, self.metadata_stamp(), compact), fp)
+            os.rename(tmp_file, self.metadata_cache_file)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
 
     def volumes(self):
         volumes = []
@@ -47,9 +87,21 @@ class Container(object):
             volumes.append((target, vol))
         return volumes
 
-    def filesystem(self):
-        layers = [self.target_base, self.target_delta]
-        return FilesystemNamespace(self.target_root, layers, self.volumes(), True)
+    def filesystem(self, ephemeral_size=None, tmpfs=None):
+        """Return the FilesystemNamespace to run the container in
+
+        With ephemeral_size (a tmpfs size, '' for the default), changes go
+        to a tmpfs instead of delta and are gone after the run. tmpfs is a
+        list of (path, size) for extra tmpfs mounts.
+        """
+        if ephemeral_size is None:
+            layers = [self.target_base, self.target_delta]
+        else:
+            if os.path.exists(self.target_delta) and os.listdir(self.target_delta):
+                # single lower layer only, changes from earlier runs would be hidden
+                raise RuntimeError('{0} has changes, cannot run it ephemeral'.format(self.container_id))
+            layers = [self.target_base, self.target_ephemeral]
+        return FilesystemNamespace(self.target_root, layers, self.volumes(), True, tmpfs, ephemeral_size)
 
     def build_filesystem(self):
         return FilesystemNamespace(self.target_base)
@@ -80,14 +132,9 @@ class Container(object):
                 os.unlink(p)
 
     def tags(self):
-        for tag in os.listdir(self.container_base_dir):
-            tag_path = os.path.join(self.container_base_dir, tag)
-            if not is_container_id(tag) and os.path.islink(tag_path):
-                target = os.readlink(tag_path)
-                if not target.startswith('/'):
-                    target = os.path.abspath(os.path.join(self.container_base_dir, target))
-                if target == self.runtime_dir:
-                    yield tag
+        # catalog imports us
+        from shoebox.catalog import Catalog
+        return Catalog(self.shoebox_dir).tags(self.container_id)
 
 
 class ContainerLink(object):
@@ -4,7 +4,12 @@ import logging
 
 import os
 
-from shoebox.tar import CopyFiles, DownloadFiles, detect_tar_format, UnpackArchive
+from shoebox.build_cache import content_hash
+from shoebox.cache_mounts import locked_cache_mounts
+from shoebox.mount_namespace import FilesystemNamespace
+from shoebox.namespaces import ContainerNamespace
+from shoebox.tar import AddSources, CopyFiles, DownloadFiles, detect_tar_format, UnpackArchive
+from shoebox.trace import mark
 
 
 logger = logging.getLogger('shoebox.exec_commands')
@@ -75,24 +80,84 @@ def exec_in_namespace(context, command):
             os._exit(1)
 
     os.chdir(context.workdir)
-    os.execvpe(command[0], command, context.environ)
+    mark('exec')
+    os.execvpe(command[0], command, dict(context.environ))
+
+
+def run_extractor(exec_context, extractor):
+    staged = None
+    if exec_context.prefetcher is not None:
+        staged = exec_context.prefetcher.take(extractor.staging_key())
+    if staged is not None:
+        try:
+            extractor.run_staged(staged, exec_context.session)
+        finally:
+            os.unlink(staged)
+    elif exec_context.session is None:
+        extractor.run()
+    else:
+        extractor.run_in_session(exec_context.session)
 
 
-class RunCommand(namedtuple('RunCommand', 'command context')):
+class RunCommand(namedtuple('RunCommand', 'command context mounts')):
     def execute(self, exec_context):
         logger.info('RUN {0}'.format(self.command))
-        exec_context.namespace.run(exec_in_namespace, self.context, self.command)
+        if self.mounts:
+            # the cache directories are mounted for this step only,
+            # so it cannot use the shared build session
+            with locked_cache_mounts(exec_context.shoebox_dir, self.mounts) as volumes:
+                fs = FilesystemNamespace(exec_context.namespace.filesystem.target, volumes=volumes)
+                namespace = ContainerNamespace(fs, exec_context.namespace.user_namespace,
+                                               cgroup=exec_context.namespace.cgroup)
+                namespace.run(exec_in_namespace, self.context, self.command)
+        elif exec_context.session is None:
+            exec_context.namespace.run(exec_in_namespace, self.context, self.command)
+        else:
+            exec_context.session.run(self.context, self.command)
+
+    # noinspection PyUnusedLocal
+    def cache_key(self, basedir, stage_keys):
+        key = ['RUN', self.command, dict(self.context.environ), self.context.user, self.context.workdir]
+        if self.mounts:
+            # cache contents are not part of the image, only where they are mounted
+            key.append(sorted(mount.target for mount in self.mounts))
+        return key
 
 
-class CopyCommand(namedtuple('CopyCommand', 'src_paths dst_path')):
+class CopyCommand(namedtuple('CopyCommand', 'src_paths dst_path from_stage')):
     def execute(self, exec_context):
+        if self.from_stage is not None:
+            try:
+                stage_dir = exec_context.stage_dirs[self.from_stage]
+            except KeyError:
+                raise RuntimeError('Unknown build stage {0}'.format(self.from_stage))
+            if len(self.src_paths) > 1 and not self.dst_path.endswith('/'):
+                raise RuntimeError('With multiple source files target must be a directory (end with /)')
+            logger.info('COPY --from={0} {1} -> {2}'.format(self.from_stage, self.src_paths, self.dst_path))
+            run_extractor(exec_context, CopyFiles(exec_context.namespace, self.dst_path, stage_dir, self.src_paths))
+            return
         if exec_context.basedir is None:
             logger.warning('Skipping COPY {0} -> {1} -- no base directory'.format(self.src_paths, self.dst_path))
             return
         if len(self.src_paths) > 1 and not self.dst_path.endswith('/'):
             raise RuntimeError('With multiple source files target must be a directory (end with /)')
         logger.info('COPY {0} -> {1}'.format(self.src_paths, self.dst_path))
-        CopyFiles(exec_context.namespace, self.dst_path, exec_context.basedir, self.src_paths).run()
+        run_extractor(exec_context, CopyFiles(
+                exec_context.namespace, self.dst_path, exec_context.basedir, self.src_paths))
+
+    def prefetch_extractors(self, exec_context):
+        """Extractors whose archives can be built before the step runs"""
+        # earlier stages may still be building
+        if self.from_stage is not None or exec_context.basedir is None:
+            return []
+        if len(self.src_paths) > 1 and not self.dst_path.endswith('/'):
+            return []
+        return [CopyFiles(exec_context.namespace, self.dst_path, exec_context.basedir, self.src_paths)]
+
+    def cache_key(self, basedir, stage_keys):
+        if self.from_stage is not None:
+            return ['COPY', self.src_paths, self.dst_path, self.from_stage, stage_keys[self.from_stage]]
+        return ['COPY', self.src_paths, self.dst_path, content_hash(basedir, self.src_paths)]
 
 
 def src_type(path):
@@ -106,20 +171,22 @@ def src_type(path):
 
 
 class AddCommand(namedtuple('AddCommand', 'src_paths dst_path')):
-    def handle_item(self, namespace, basedir, path):
+    def handle_item(self, exec_context, path):
+        namespace = exec_context.namespace
+        basedir = exec_context.basedir
         item_type = src_type(path)
         if item_type == 'url':
             basedir = basedir or os.getcwd()
             logger.info('Downloading {0} -> {1}'.format(path, self.dst_path))
-            DownloadFiles(namespace, self.dst_path, basedir, [path]).run()
+            run_extractor(exec_context, DownloadFiles(namespace, self.dst_path, basedir, [path]))
         elif item_type == 'tar':
             if not basedir:
                 logger.warning('Skipping ADD {0} -> {1} -- no base directory'.format(path, self.dst_path))
             logger.info('Extracting {0} -> {1}'.format(path, self.dst_path))
-            UnpackArchive(namespace, self.dst_path, basedir, path).run()
+            run_extractor(exec_context, UnpackArchive(namespace, self.dst_path, basedir, path))
         else:
             logger.info('Copying {0} -> {1}'.format(path, self.dst_path))
-            CopyFiles(namespace, self.dst_path, basedir, [path]).run()
+            run_extractor(exec_context, CopyFiles(namespace, self.dst_path, basedir, [path]))
 
     def execute(self, exec_context):
         if len(self.src_paths) > 1 and not self.dst_path.endswith('/'):
@@ -130,8 +197,43 @@ class AddCommand(namedtuple('AddCommand', 'src_paths dst_path')):
                 logger.warning('Skipping ADD {0} -> {1} -- no base directory'.format(self.src_paths, self.dst_path))
                 return
             logger.info('Copying {0} -> {1}'.format(self.src_paths, self.dst_path))
-            CopyFiles(exec_context.namespace, self.dst_path, exec_context.basedir, self.src_paths).run()
+            run_extractor(exec_context, CopyFiles(
+                exec_context.namespace, self.dst_path, exec_context.basedir, self.src_paths))
+        elif len(self.src_paths) > 1 and exec_context.basedir is not None:
+            # everything in one stream, instead of a namespace for every item
+            logger.info('Adding {0} -> {1}'.format(self.src_paths, self.dst_path))
+            run_extractor(exec_context, self.add_sources(exec_context))
         else:
             # slow path, handle one item at a time
             for src in self.src_paths:
-                self.handle_item(exec_context.namespace, exec_context.basedir, src)
+                self.handle_item(exec_context, src)
+
+    def add_sources(self, exec_context):
+        items = [(src_type(src), src) for src in self.src_paths]
+        return AddSources(exec_context.namespace, self.dst_path, exec_context.basedir, items)
+
+    def prefetch_extractors(self, exec_context):
+        """Extractors whose archives can be built before the step runs"""
+        namespace = exec_context.namespace
+        basedir = exec_context.basedir
+        if len(self.src_paths) > 1 and not self.dst_path.endswith('/'):
+            return []
+        if all(src_type(src) == 'file' for src in self.src_paths):
+            if basedir is None:
+                return []
+            return [CopyFiles(namespace, self.dst_path, basedir, self.src_paths)]
+        if len(self.src_paths) > 1 and basedir is not None:
+            return [self.add_sources(exec_context)]
+        extractors = []
+        for path in self.src_paths:
+            item_type = src_type(path)
+            if item_type == 'url':
+                extractors.append(DownloadFiles(namespace, self.dst_path, basedir or os.getcwd(), [path]))
+            elif item_type == 'file':
+                extractors.append(CopyFiles(namespace, self.dst_path, basedir, [path]))
+            # archives are local already, nothing to gain
+        return extractors
+
+    # noinspection PyUnusedLocal
+    def cache_key(self, basedir, stage_keys):
+        return ['ADD', self.src_paths, self.dst_path, content_hash(basedir, self.src_paths)]
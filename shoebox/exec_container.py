@@ -0,0 +1,86 @@
+"""Run another command in a running container, joining its namespaces"""
+import logging
+import os
+
+from shoebox.capabilities import drop_caps
+from shoebox.cgroups import join_cgroup_of
+from shoebox.exec_commands import exec_in_namespace
+from shoebox.libc import setns, CLONE_NEWUSER, CLONE_NEWNS, CLONE_NEWIPC, CLONE_NEWUTS, CLONE_NEWPID, CLONE_NEWNET
+from shoebox.proc import ProcessTree, scan_processes
+from shoebox.run import load_container, run_context
+
+
+logger = logging.getLogger('shoebox.exec')
+
+# user first, it gives us the capabilities to join the others
+NAMESPACES = [
+    ('user', CLONE_NEWUSER),
+    ('ipc', CLONE_NEWIPC),
+    ('uts', CLONE_NEWUTS),
+    ('net', CLONE_NEWNET),
+    ('pid', CLONE_NEWPID),
+    ('mnt', CLONE_NEWNS),
+]
+
+
+def container_init(pid):
+    """Return the pid of the first process inside the pid namespace below pid (the pidfile of run)"""
+    tree = ProcessTree(scan_processes(with_cmdline=False))
+    root = tree.processes.get(pid)
+    if root is None:
+        return
+    inside = [(depth, info.pid) for depth, info in tree.subtree(pid) if info.pidns not in (None, root.pidns)]
+    if inside:
+        return min(inside)[1]
+
+
+def enter_namespaces(pid):
+    """Join the namespaces of pid that differ from ours, pid ones apply to children only"""
+    fds = []
+    try:
+        # opened up front, /proc is another one after joining the mount namespace
+        for name, flag in NAMESPACES:
+            path = '/proc/{0}/ns/{1}'.format(pid, name)
+            if os.readlink(path) != os.readlink('/proc/self/ns/{0}'.format(name)):
+                fds.append((os.open(path, os.O_RDONLY), flag))
+        for fd, flag in fds:
+            setns(fd, flag)
+    finally:
+        for fd, _ in fds:
+            os.close(fd)
+
+
+def exec_container(shoebox_dir, container_id, command, user=None, workdir=None, env=None):
+    """Run command in the namespaces of a running container, return its exit status"""
+    container = load_container(container_id, shoebox_dir)
+    run_pid = container.pid()
+    init_pid = container_init(run_pid) if run_pid else None
+    if init_pid is None:
+        raise RuntimeError('Container {0} is not running'.format(container_id))
+    # like docker exec, no entrypoint
+    context, command = run_context(container, command, '', user, workdir, env=env)
+
+    pid = os.fork()
+    if pid:
+        _, ret = os.waitpid(pid, 0)
+        if ret & 0x7f:
+            return 128 + (ret & 0x7f)
+        return ret >> 8
+
+    exitcode = 1
+    # noinspection PyBroadException
+    try:
+        join_cgroup_of(init_pid)
+        enter_namespaces(init_pid)
+        drop_caps()
+        # the first child is in the container's pid namespace
+        child = os.fork()
+        if child == 0:
+            exec_in_namespace(context, command)
+        _, ret = os.waitpid(child, 0)
+        exitcode = 128 + (ret & 0x7f) if ret & 0x7f else ret >> 8
+    except:
+        logger.exception('Cannot exec {0} in {1}'.format(command, container_id))
+    finally:
+        # noinspection PyProtectedMember
+        os._exit(exitcode)
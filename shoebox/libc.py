@@ -1,4 +1,6 @@
-from ctypes import CDLL
+from ctypes import CDLL, POINTER, Structure, byref, c_int, c_long, c_size_t, c_uint32, c_uint64, c_void_p, cast, \
+    create_string_buffer, pointer, sizeof
+import struct
 
 try:
     libc = CDLL('libc.so.6')
@@ -19,6 +21,34 @@ MS_MGC_VAL = 0xC0ED0000
 # sys/mount.h
 MNT_DETACH = 2
 
+# new mount API (Linux 5.2+), numbered alike on all architectures
+SYS_OPEN_TREE = 428
+SYS_MOVE_MOUNT = 429
+SYS_FSOPEN = 430
+SYS_FSCONFIG = 431
+SYS_FSMOUNT = 432
+SYS_MOUNT_SETATTR = 442
+
+AT_FDCWD = -100
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+OPEN_TREE_CLONE = 1
+OPEN_TREE_CLOEXEC = 0o2000000
+FSOPEN_CLOEXEC = 1
+FSMOUNT_CLOEXEC = 1
+FSCONFIG_SET_STRING = 1
+FSCONFIG_CMD_CREATE = 6
+MOVE_MOUNT_F_EMPTY_PATH = 4
+MOUNT_ATTR_RDONLY = 1
+MOUNT_ATTR_NOSUID = 2
+MOUNT_ATTR_NODEV = 4
+MOUNT_ATTR_NOEXEC = 8
+
+
+class MountAttr(Structure):
+    _fields_ = [('attr_set', c_uint64), ('attr_clr', c_uint64), ('propagation', c_uint64), ('userns_fd', c_uint64)]
+
+
 # linux/sched.h
 CLONE_NEWNS = 0x00020000
 CLONE_NEWUTS = 0x04000000
@@ -27,6 +57,45 @@ CLONE_NEWNET = 0x40000000
 CLONE_NEWUSER = 0x10000000
 CLONE_NEWPID = 0x20000000
 
+# linux/time.h
+CLOCK_MONOTONIC = 1
+
+# linux/prctl.h
+PR_SET_PDEATHSIG = 1
+
+
+class Timespec(Structure):
+    _fields_ = [('tv_sec', c_long), ('tv_nsec', c_long)]
+
+
+# sys/socket.h, Python 2 has no sendmsg to pass fds
+SOL_SOCKET = 1
+SCM_RIGHTS = 1
+
+
+class Iovec(Structure):
+    _fields_ = [('iov_base', c_void_p), ('iov_len', c_size_t)]
+
+
+class Msghdr(Structure):
+    _fields_ = [
+        ('msg_name', c_void_p),
+        ('msg_namelen', c_uint32),
+        ('msg_iov', POINTER(Iovec)),
+        ('msg_iovlen', c_size_t),
+        ('msg_control', c_void_p),
+        ('msg_controllen', c_size_t),
+        ('msg_flags', c_int),
+    ]
+
+
+# struct cmsghdr is cmsg_len (size_t), cmsg_level and cmsg_type (int)
+CMSG_HEADER = struct.Struct('={0}ii'.format('Q' if sizeof(c_size_t) == 8 else 'I'))
+
+
+def cmsg_align(length):
+    return (length + sizeof(c_size_t) - 1) & ~(sizeof(c_size_t) - 1)
+
 
 def mount(device, target, fstype, flags, options):
     if libc is None:
@@ -71,6 +140,133 @@ def umount(path):
         raise OSError('Failed to unmount {0}'.format(path))
 
 
+def fsopen(fstype):
+    """Return a filesystem context fd for fstype, to configure with fsconfig()"""
+    if libc is None:
+        raise NotImplementedError()
+    fd = libc.syscall(SYS_FSOPEN, fstype.encode('utf-8'), FSOPEN_CLOEXEC)
+    if fd < 0:
+        raise OSError('Failed to open filesystem context for {0}'.format(fstype))
+    return fd
+
+
+def fsconfig(fs_fd, key=None, value=None, cmd=FSCONFIG_SET_STRING):
+    if libc is None:
+        raise NotImplementedError()
+    if key is not None:
+        key = key.encode('utf-8')
+    if value is not None:
+        value = value.encode('utf-8')
+    if libc.syscall(SYS_FSCONFIG, fs_fd, cmd, key, value, 0) < 0:
+        raise OSError('Failed to configure filesystem {0}={1}'.format(key, value))
+
+
+def fsmount(fs_fd, attr_flags=0):
+    """Return a detached mount of the filesystem created in fs_fd"""
+    if libc is None:
+        raise NotImplementedError()
+    fd = libc.syscall(SYS_FSMOUNT, fs_fd, FSMOUNT_CLOEXEC, attr_flags)
+    if fd < 0:
+        raise OSError('Failed to create detached mount')
+    return fd
+
+
+def open_tree(path, dir_fd=AT_FDCWD, recursive=False):
+    """Return a detached copy of the mount at path, like a bind mount not attached anywhere yet"""
+    if libc is None:
+        raise NotImplementedError()
+    flags = OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC
+    if recursive:
+        flags |= AT_RECURSIVE
+    fd = libc.syscall(SYS_OPEN_TREE, dir_fd, path.encode('utf-8'), flags)
+    if fd < 0:
+        raise OSError('Failed to clone mount tree {0}'.format(path))
+    return fd
+
+
+def mount_setattr(tree_fd, attr_set, recursive=False):
+    if libc is None:
+        raise NotImplementedError()
+    attr = MountAttr(attr_set, 0, 0, 0)
+    flags = AT_EMPTY_PATH
+    if recursive:
+        flags |= AT_RECURSIVE
+    if libc.syscall(SYS_MOUNT_SETATTR, tree_fd, '', flags, byref(attr), sizeof(attr)) < 0:
+        raise OSError('Failed to set mount attributes {0:x}'.format(attr_set))
+
+
+def move_mount(tree_fd, target):
+    """Attach a detached mount tree at target"""
+    if libc is None:
+        raise NotImplementedError()
+    target = target.encode('utf-8')
+    if libc.syscall(SYS_MOVE_MOUNT, tree_fd, '', AT_FDCWD, target, MOVE_MOUNT_F_EMPTY_PATH) < 0:
+        raise OSError('Failed to attach mount at {0}'.format(target))
+
+
+def lgetxattr(path, name):
+    """Return the value of extended attribute name or None if it's not set"""
+    if libc is None:
+        raise NotImplementedError()
+    path = path.encode('utf-8')
+    name = name.encode('utf-8')
+    buf = create_string_buffer(256)
+    size = libc.lgetxattr(path, name, buf, len(buf))
+    if size < 0:
+        return None
+    return buf.raw[:size]
+
+
+def clock_gettime(clock_id=CLOCK_MONOTONIC):
+    """Return clock_id in seconds, by default a clock never going backwards"""
+    if libc is None:
+        raise NotImplementedError()
+    ts = Timespec()
+    if libc.clock_gettime(clock_id, byref(ts)) != 0:
+        raise OSError('Failed to read clock {0}'.format(clock_id))
+    return ts.tv_sec + ts.tv_nsec / 1e9
+
+
+def send_fds(sock_fd, data, fds):
+    """Send data (at least a byte) over a unix socket, passing fds along"""
+    if libc is None:
+        raise NotImplementedError()
+    buf = create_string_buffer(data, len(data))
+    iov = Iovec(cast(buf, c_void_p), len(data))
+    fd_data = struct.pack('{0}i'.format(len(fds)), *fds)
+    cmsg_len = cmsg_align(CMSG_HEADER.size) + len(fd_data)
+    control_data = CMSG_HEADER.pack(cmsg_len, SOL_SOCKET, SCM_RIGHTS).ljust(cmsg_align(CMSG_HEADER.size), '\0')
+    control = create_string_buffer(control_data + fd_data, cmsg_align(cmsg_len))
+    msg = Msghdr(None, 0, pointer(iov), 1, cast(control, c_void_p), len(control), 0)
+    if libc.sendmsg(sock_fd, byref(msg), 0) != len(data):
+        raise OSError('Failed to send fds {0}'.format(fds))
+
+
+def recv_fds(sock_fd, size, max_fds):
+    """Receive up to size bytes and the fds sent along, return (data, fds)"""
+    if libc is None:
+        raise NotImplementedError()
+    buf = create_string_buffer(size)
+    iov = Iovec(cast(buf, c_void_p), size)
+    control = create_string_buffer(cmsg_align(cmsg_align(CMSG_HEADER.size) + 4 * max_fds))
+    msg = Msghdr(None, 0, pointer(iov), 1, cast(control, c_void_p), len(control), 0)
+    received = libc.recvmsg(sock_fd, byref(msg), 0)
+    if received < 0:
+        raise OSError('Failed to receive fds')
+    fds = []
+    offset = 0
+    while offset + CMSG_HEADER.size <= msg.msg_controllen:
+        cmsg_len, level, cmsg_type = CMSG_HEADER.unpack_from(control.raw, offset)
+        if cmsg_len < CMSG_HEADER.size:
+            break
+        data_offset = offset + cmsg_align(CMSG_HEADER.size)
+        if level == SOL_SOCKET and cmsg_type == SCM_RIGHTS:
+            count = (offset + cmsg_len - data_offset) // 4
+            fds.extend(struct.unpack_from('{0}i'.format(count), control.raw, data_offset))
+        offset += cmsg_align(cmsg_len)
+    return buf.raw[:received], fds
+
+
 def unshare(flags):
     if libc is None:
         raise NotImplementedError()
@@ -79,6 +275,22 @@ def unshare(flags):
         raise OSError('Failed to unshare {0:x}'.format(flags))
 
 
+def setns(fd, nstype):
+    if libc is None:
+        raise NotImplementedError()
+    if libc.setns(fd, nstype) != 0:
+        # errno gets clobbered so that's all we know
+        raise OSError('Failed to setns {0:x}'.format(nstype))
+
+
+def set_parent_death_signal(signum):
+    """Have the kernel send signum when the parent exits, cleared by setuid to another user"""
+    if libc is None:
+        raise NotImplementedError()
+    if libc.prctl(PR_SET_PDEATHSIG, signum, 0, 0, 0) != 0:
+        raise OSError('Failed to set parent death signal {0}'.format(signum))
+
+
 def sethostname(hostname):
     if libc is None:
         raise NotImplementedError()
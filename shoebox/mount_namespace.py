@@ -1,14 +1,60 @@
+import errno
 import logging
 import os
+import re
+import signal
 import socket
 import stat
 import tempfile
 
-from shoebox.libc import mount, bind_mount, pivot_root, MS_NOEXEC, MS_NOSUID, MS_NODEV, umount
+from shoebox.libc import mount, bind_mount, pivot_root, MS_NOEXEC, MS_NOSUID, MS_NODEV, umount, fsopen, fsconfig, \
+    fsmount, open_tree, mount_setattr, move_mount, AT_FDCWD, FSCONFIG_CMD_CREATE, MOUNT_ATTR_RDONLY, \
+    MOUNT_ATTR_NOEXEC, MOUNT_ATTR_NODEV, MOUNT_ATTR_NOSUID, set_parent_death_signal
+from shoebox.trace import mark, span
 
 
 logger = logging.getLogger('shoebox')
 
+_new_mount_api = None
+
+
+def new_mount_api():
+    """Check once whether fsopen() and friends work here (Linux 5.2+)"""
+    global _new_mount_api
+    if _new_mount_api is None:
+        try:
+            os.close(fsopen('tmpfs'))
+            _new_mount_api = True
+        except (OSError, NotImplementedError):
+            logger.debug('No new mount API, mounting the old way')
+            _new_mount_api = False
+    return _new_mount_api
+
+
+def detached_tmpfs(options, attr_flags):
+    """Return a tmpfs mount not attached anywhere, gone when the fd is closed"""
+    fs_fd = fsopen('tmpfs')
+    try:
+        for option in options:
+            key, _, value = option.partition('=')
+            fsconfig(fs_fd, key, value)
+        fsconfig(fs_fd, cmd=FSCONFIG_CMD_CREATE)
+        return fsmount(fs_fd, attr_flags)
+    finally:
+        os.close(fs_fd)
+
+
+def attach_clone(path, target, dir_fd=AT_FDCWD, attr_flags=0):
+    """Bind path (relative to dir_fd, without submounts) at target with attr_flags, in one move"""
+    tree_fd = open_tree(path, dir_fd)
+    try:
+        if attr_flags:
+            # before attaching, so target is never writable
+            mount_setattr(tree_fd, attr_flags)
+        move_mount(tree_fd, target)
+    finally:
+        os.close(tree_fd)
+
 
 def makedev(target_dir_func, name):
     target = target_dir_func(name)
@@ -21,7 +67,37 @@ def makedev(target_dir_func, name):
         bind_mount(name, target)
 
 
-def mount_root_fs(target, overlayfs_layers):
+def check_tmpfs_size(size):
+    """Raise ValueError unless size is like 64m or 10%"""
+    if not re.match(r'^\d+[kmgKMG%]?$', size):
+        raise ValueError('Invalid tmpfs size {0!r}'.format(size))
+    return size
+
+
+def parse_tmpfs(spec):
+    """Split /path[:size] of --tmpfs"""
+    path, _, size = spec.partition(':')
+    if not path.startswith('/'):
+        raise ValueError('tmpfs path must be absolute, not {0!r}'.format(path))
+    return path, size and check_tmpfs_size(size) or None
+
+
+def tmpfs_options(size, mode=None):
+    options = []
+    if size:
+        options.append('size={0}'.format(size))
+    if mode is not None:
+        options.append('mode={0:o}'.format(mode))
+    return ','.join(options) or None
+
+
+def mount_root_fs(target, overlayfs_layers, upper_tmpfs=None):
+    """Mount the layers at target
+
+    With upper_tmpfs (a size, '' for the default), the upper layer is a
+    mount point for a tmpfs holding all changes, which disappears with
+    the mount namespace.
+    """
     if overlayfs_layers is None:
         overlayfs_layers = []
 
@@ -33,6 +109,10 @@ def mount_root_fs(target, overlayfs_layers):
             if not os.path.exists(layer):
                 os.makedirs(layer)
         lower, upper = overlayfs_layers
+        if upper_tmpfs is not None:
+            mount('tmpfs', upper, 'tmpfs', MS_NODEV | MS_NOSUID, tmpfs_options(upper_tmpfs))
+            upper = os.path.join(upper, 'upper')
+            os.mkdir(upper, 0o755)
         mount('overlayfs', target, 'overlayfs', 0, 'lowerdir={0},upperdir={1}'.format(lower, upper))
     else:
         # make target a mount point, for pivot_root
@@ -47,6 +127,19 @@ def mount_volumes(target_dir_func, volumes):
         bind_mount(volume_source, real_target, rec=True)
 
 
+def mount_tmpfs(target_dir_func, tmpfs):
+    """Mount a tmpfs at each path, size
+
+    Missing mount points are created like those of volumes, so they stay
+    in the container's changes unless those are on a tmpfs too.
+    """
+    for path, size in tmpfs:
+        target = target_dir_func(path)
+        if not os.path.exists(target):
+            os.makedirs(target, 0o755)
+        mount('tmpfs', target, 'tmpfs', MS_NODEV | MS_NOSUID, tmpfs_options(size, 0o1777))
+
+
 def mount_devices(target_dir_func):
     devpts = target_dir_func('/dev/pts')
     ptmx = target_dir_func('/dev/ptmx')
@@ -85,6 +178,13 @@ def mount_procfs(target_dir_func):
 
 def mount_sysfs(target_dir_func):
     target_sys = target_dir_func('/sys')
+    if new_mount_api():
+        try:
+            # just sysfs like the bind mount below, not the cgroup fs etc. mounted on it
+            attach_clone('/sys', target_sys, attr_flags=MOUNT_ATTR_RDONLY)
+            return
+        except OSError:
+            logger.debug('Failed to clone sysfs, trying bind mount')
     try:
         bind_mount('/sys', target_sys)
         bind_mount(target_sys, target_sys, readonly=True)
@@ -92,7 +192,36 @@ def mount_sysfs(target_dir_func):
         logger.debug('Failed to mount sysfs, probably not owned by us')
 
 
+def etc_files():
+    files = [(etc_path, open(etc_path).read()) for etc_path in ('/etc/resolv.conf', '/etc/hosts')]
+    files.append(('/etc/hostname', socket.gethostname() + '\n'))
+    return files
+
+
+def attach_etc_files(target_dir_func):
+    """Fill a detached tmpfs and attach each file from it, nothing shows up in the root meanwhile"""
+    tmpfs_fd = detached_tmpfs(['size=1m'], MOUNT_ATTR_NOEXEC | MOUNT_ATTR_NODEV | MOUNT_ATTR_NOSUID)
+    try:
+        for path, content in etc_files():
+            name = os.path.basename(path)
+            with open('/proc/self/fd/{0}/{1}'.format(tmpfs_fd, name), 'w') as fp:
+                fp.write(content)
+            target = target_dir_func(path)
+            if not os.path.exists(target):
+                open(target, 'w').close()
+            attach_clone(name, target, dir_fd=tmpfs_fd)
+    finally:
+        os.close(tmpfs_fd)
+
+
 def mount_etc_files(target_dir_func):
+    if new_mount_api():
+        try:
+            attach_etc_files(target_dir_func)
+            return
+        except OSError:
+            # older kernels can't clone from a detached mount
+            logger.debug('Failed to attach /etc files from a detached tmpfs, using a temporary mount')
     tmpfs = tempfile.mkdtemp(prefix='.etc', dir=target_dir_func('/'))
     mount('tmpfs', tmpfs, 'tmpfs', MS_NOEXEC | MS_NODEV | MS_NOSUID, 'size=1m')
 
@@ -105,12 +234,9 @@ def mount_etc_files(target_dir_func):
             open(target, 'w').close()
         bind_mount(tmpfile, target)
 
-    for etc_path in ('/etc/resolv.conf', '/etc/hosts'):
-        etc_content = open(etc_path).read()
+    for etc_path, etc_content in etc_files():
         write_and_mount_file(etc_path, etc_content)
 
-    write_and_mount_file('/etc/hostname', socket.gethostname() + '\n')
-
     umount(tmpfs)
     os.rmdir(tmpfs)
 
@@ -125,14 +251,17 @@ def pivot_namespace_root(target):
 
 
 class FilesystemNamespace(object):
-    def __init__(self, target, layers=None, volumes=None, special_fs=False):
+    def __init__(self, target, layers=None, volumes=None, special_fs=False, tmpfs=None, upper_tmpfs=None):
         self.target = target
         self.layers = layers
         self.volumes = volumes
         self.special_fs = special_fs
+        self.tmpfs = tmpfs
+        self.upper_tmpfs = upper_tmpfs
 
     def __repr__(self):
-        return '{0} + {1} -> {2} (special_fs: {3})'.format(self.layers, self.volumes, self.target, self.special_fs)
+        return '{0} + {1} + tmpfs {2} -> {3} (special_fs: {4})'.format(
+            self.layers, self.volumes, self.tmpfs, self.target, self.special_fs)
 
     def target_subdir(self, path):
         return os.path.join(self.target, path.lstrip('/'))
@@ -145,9 +274,18 @@ class FilesystemNamespace(object):
                 raise RuntimeError('{0} does not exist'.format(self.target))
 
     def build(self):
+        mark('fork_filesystem')
         pid = os.fork()
         if pid:
-            _, ret = os.waitpid(pid, 0)
+            # we only wait for pid 1 of the new pid namespace, take all of it down with us
+            signal.signal(signal.SIGTERM, lambda signum, frame: os.kill(pid, signal.SIGKILL))
+            while True:
+                try:
+                    _, ret = os.waitpid(pid, 0)
+                    break
+                except OSError as exc:
+                    if exc.errno != errno.EINTR:
+                        raise
             exitcode = ret >> 8
             sig = ret & 0x7f
             if sig:
@@ -155,17 +293,29 @@ class FilesystemNamespace(object):
             # noinspection PyProtectedMember
             os._exit(exitcode)
 
-        mount_root_fs(self.target, self.layers)
+        # and if we're killed outright
+        set_parent_death_signal(signal.SIGKILL)
+        with span('mount_root_fs'):
+            mount_root_fs(self.target, self.layers, self.upper_tmpfs)
         if self.volumes:
-            mount_volumes(self.target_subdir, self.volumes)
+            with span('mount_volumes'):
+                mount_volumes(self.target_subdir, self.volumes)
+        if self.tmpfs:
+            with span('mount_tmpfs'):
+                mount_tmpfs(self.target_subdir, self.tmpfs)
 
         if self.special_fs:
             if os.geteuid() == 0:
-                mount_devices(self.target_subdir)
+                with span('mount_devices'):
+                    mount_devices(self.target_subdir)
             else:
                 logger.warning('Cannot mount devpts when not mapping to root, expect TTY malfunction')
-            mount_procfs(self.target_subdir)
-            mount_sysfs(self.target_subdir)
-            mount_etc_files(self.target_subdir)
-        pivot_namespace_root(self.target)
+            with span('mount_procfs'):
+                mount_procfs(self.target_subdir)
+            with span('mount_sysfs'):
+                mount_sysfs(self.target_subdir)
+            with span('mount_etc_files'):
+                mount_etc_files(self.target_subdir)
+        with span('pivot_namespace_root'):
+            pivot_namespace_root(self.target)
 
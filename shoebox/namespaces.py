@@ -3,8 +3,9 @@ import logging
 import os
 
 from shoebox.capabilities import drop_caps
-from shoebox.libc import unshare, sethostname, CLONE_NEWUSER, CLONE_NEWNS, CLONE_NEWIPC, CLONE_NEWUTS, CLONE_NEWPID, \
+from shoebox.libc import unshare, sethostname, CLONE_NEWNS, CLONE_NEWIPC, CLONE_NEWUTS, CLONE_NEWPID, \
     CLONE_NEWNET
+from shoebox.trace import span
 from shoebox.user_namespace import UserNamespace
 
 
@@ -12,7 +13,7 @@ logger = logging.getLogger('shoebox')
 
 
 class ContainerNamespace(object):
-    def __init__(self, filesystem, user_namespace=None, private_net=None, hostname=None, links=None):
+    def __init__(self, filesystem, user_namespace=None, private_net=None, hostname=None, links=None, cgroup=None):
         self.filesystem = filesystem
         if user_namespace is None:
             self.user_namespace = UserNamespace(None, None)
@@ -21,6 +22,7 @@ class ContainerNamespace(object):
         self.private_net = private_net
         self.hostname = hostname
         self.links = links
+        self.cgroup = cgroup
 
     def __repr__(self):
         return 'FS: {0!r}, USER: {1!r}, NET: {2!r}'.format(self.filesystem, self.user_namespace, self.private_net)
@@ -73,29 +75,35 @@ ff02::2 ip6-allrouters
     def build(self):
         self.filesystem.check_root_dir()
         resolvconf = self.etc_resolv_conf()
+        if self.cgroup is not None:
+            self.cgroup.join()
 
-        with self.user_namespace.setup_userns():
-            namespaces = CLONE_NEWUSER | CLONE_NEWNS | CLONE_NEWIPC | CLONE_NEWUTS | CLONE_NEWPID
+        with self.user_namespace.setup_userns() as userns_flags:
+            namespaces = userns_flags | CLONE_NEWNS | CLONE_NEWIPC | CLONE_NEWUTS | CLONE_NEWPID
             if self.private_net:
                 namespaces |= CLONE_NEWNET
                 with self.private_net.setup_netns():
-                    unshare(namespaces)
+                    with span('unshare'):
+                        unshare(namespaces)
             else:
-                unshare(namespaces)
+                with span('unshare'):
+                    unshare(namespaces)
 
         if self.hostname:
             sethostname(self.hostname)
 
         self.filesystem.build()
         if self.filesystem.special_fs:
-            with open('/etc/hosts', 'w') as hosts:
-                print >> hosts, self.etc_hosts()
+            with span('write_etc_files'):
+                with open('/etc/hosts', 'w') as hosts:
+                    print >> hosts, self.etc_hosts()
 
-            with open('/etc/resolv.conf', 'w') as resolv:
-                print >> resolv, resolvconf
+                with open('/etc/resolv.conf', 'w') as resolv:
+                    print >> resolv, resolvconf
 
-        drop_caps()
-        os.setgroups([os.getgid()])
+        with span('drop_caps'):
+            drop_caps()
+            os.setgroups([os.getgid()])
 
     def execns(self, ns_func, *args, **kwargs):
         exitcode = 1
@@ -111,6 +119,8 @@ ff02::2 ip6-allrouters
             os._exit(exitcode)
 
     def run(self, ns_func, *args, **kwargs):
+        # in the parent, so later namespaces from here join the same one
+        self.user_namespace.start_holder()
         pid = os.fork()
         if pid:
             _, ret = os.waitpid(pid, 0)
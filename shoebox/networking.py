@@ -8,6 +8,7 @@ try:
 except ImportError:
     pyroute2 = None
 from shoebox.namespace_utils import spawn_helper
+from shoebox.trace import span
 
 
 def detect_bridge():
@@ -68,12 +69,15 @@ class PrivateNetwork(object):
         if self.bridge:
             if pyroute2 is None:
                 raise NotImplementedError()
-            netns_helper = spawn_helper('netns', self.init_net_interface, os.getpid())
+            with span('spawn_netns_helper'):
+                netns_helper = spawn_helper('netns', self.init_net_interface, os.getpid())
         else:
             netns_helper = None  # make PyCharm happy
 
         yield
 
         if self.bridge:
-            netns_helper.wait()
-            self.set_ip_address()
\ No newline at end of file
+            with span('netns_helper'):
+                netns_helper.wait()
+            with span('set_ip_address'):
+                self.set_ip_address()
\ No newline at end of file
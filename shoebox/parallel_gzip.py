@@ -0,0 +1,67 @@
+"""gzip compression spread over threads
+
+Input is cut into blocks which are deflated independently (zlib releases
+the GIL while compressing) and joined into a single gzip member, the way
+pigz does it. Every block but the last ends with a sync flush so the raw
+deflate streams can simply be concatenated.
+"""
+from multiprocessing.pool import ThreadPool
+import struct
+import time
+import zlib
+
+
+BLOCK_SIZE = 1 << 20
+
+
+def deflate_block(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    def __init__(self, fileobj, threads, level=6, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = []
+        self.buf = []
+        self.buf_size = 0
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.closed = False
+        # no name, mtime of now, unknown OS
+        self.fileobj.write('\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + '\x00\xff')
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= self.block_size:
+            self.submit(False)
+
+    def submit(self, last):
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buf_size = 0
+        while len(data) > self.block_size:
+            self.pending.append(self.pool.apply_async(deflate_block, (data[:self.block_size], self.level, False)))
+            data = data[self.block_size:]
+        self.pending.append(self.pool.apply_async(deflate_block, (data, self.level, last)))
+        # keep memory bounded, write out blocks in order as they finish
+        while len(self.pending) > 2 * self.threads or (last and self.pending):
+            self.fileobj.write(self.pending.pop(0).get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.submit(True)
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
@@ -0,0 +1,233 @@
+"""Immutable collections sharing structure with their predecessors
+
+Dockerfile evaluation derives a new state from the previous one at every
+directive. Copying whole lists/dicts there makes evaluation quadratic,
+so each new version only records the change and shares the rest.
+"""
+from collections import Mapping, Sequence, Set
+
+
+class PersistentList(Sequence):
+    __slots__ = ('_prev', '_item', '_len', '_items')
+
+    def __init__(self, items=()):
+        self._prev = None
+        self._item = None
+        self._items = tuple(items)
+        self._len = len(self._items)
+
+    @classmethod
+    def wrap(cls, items):
+        if isinstance(items, cls):
+            return items
+        return cls(items)
+
+    def append(self, item):
+        """Return a new list with item appended, sharing everything else"""
+        new = PersistentList.__new__(PersistentList)
+        new._prev = self
+        new._item = item
+        new._len = self._len + 1
+        new._items = None
+        return new
+
+    def materialize(self):
+        if self._items is None:
+            tail = []
+            node = self
+            while node._items is None:
+                tail.append(node._item)
+                node = node._prev
+            tail.reverse()
+            self._items = node._items + tuple(tail)
+            self._prev = None
+        return self._items
+
+    def __getitem__(self, item):
+        return self.materialize()[item]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+BITS = 5
+MASK = (1 << BITS) - 1
+
+
+def bit_index(bitmap, bit):
+    return bin(bitmap & (bit - 1)).count('1')
+
+
+class MapNode(object):
+    """Trie node, children are MapNodes, (hash, key, value) leaves or Collisions"""
+    __slots__ = ('bitmap', 'children')
+
+    def __init__(self, bitmap, children):
+        self.bitmap = bitmap
+        self.children = children
+
+
+class Collision(object):
+    """Keys sharing a whole hash"""
+    __slots__ = ('hash', 'items')
+
+    def __init__(self, key_hash, items):
+        self.hash = key_hash
+        self.items = items
+
+
+def key_hash(key):
+    return hash(key) & 0xffffffff
+
+
+def child_hash(child):
+    return child.hash if isinstance(child, Collision) else child[0]
+
+
+def merge_children(a, b, shift):
+    """Node holding leaves/collisions a and b, whose hashes differ"""
+    bit_a = 1 << ((child_hash(a) >> shift) & MASK)
+    bit_b = 1 << ((child_hash(b) >> shift) & MASK)
+    if bit_a == bit_b:
+        return MapNode(bit_a, (merge_children(a, b, shift + BITS),))
+    if bit_a < bit_b:
+        return MapNode(bit_a | bit_b, (a, b))
+    return MapNode(bit_a | bit_b, (b, a))
+
+
+def node_set(node, h, key, value, shift):
+    """Return (new node, whether key is new), copying only the path to key"""
+    bit = 1 << ((h >> shift) & MASK)
+    index = bit_index(node.bitmap, bit)
+    if not node.bitmap & bit:
+        children = node.children[:index] + ((h, key, value),) + node.children[index:]
+        return MapNode(node.bitmap | bit, children), True
+
+    child = node.children[index]
+    added = False
+    if isinstance(child, MapNode):
+        child, added = node_set(child, h, key, value, shift + BITS)
+    elif isinstance(child, Collision):
+        if child.hash == h:
+            items = tuple((k, v) for k, v in child.items if k != key)
+            added = len(items) == len(child.items)
+            child = Collision(h, items + ((key, value),))
+        else:
+            child, added = merge_children(child, (h, key, value), shift + BITS), True
+    elif child[1] == key:
+        child = (h, key, value)
+    elif child[0] == h:
+        child, added = Collision(h, ((child[1], child[2]), (key, value))), True
+    else:
+        child, added = merge_children(child, (h, key, value), shift + BITS), True
+    return MapNode(node.bitmap, node.children[:index] + (child,) + node.children[index + 1:]), added
+
+
+def node_items(node):
+    for child in node.children:
+        if isinstance(child, MapNode):
+            for item in node_items(child):
+                yield item
+        elif isinstance(child, Collision):
+            for item in child.items:
+                yield item
+        else:
+            yield child[1], child[2]
+
+
+class PersistentMap(Mapping):
+    """Hash array mapped trie, updates copy the O(log n) nodes on the path to the key"""
+    __slots__ = ('_root', '_len')
+
+    def __init__(self, items=()):
+        self._root = MapNode(0, ())
+        self._len = 0
+        if isinstance(items, Mapping):
+            items = items.iteritems()
+        for key, value in items:
+            self._root, added = node_set(self._root, key_hash(key), key, value, 0)
+            self._len += added
+
+    @classmethod
+    def wrap(cls, items):
+        if isinstance(items, cls):
+            return items
+        return cls(items)
+
+    def set(self, key, value):
+        """Return a new mapping with key set to value, sharing everything else"""
+        new = self.__class__.__new__(self.__class__)
+        new._root, added = node_set(self._root, key_hash(key), key, value, 0)
+        new._len = self._len + added
+        return new
+
+    def __getitem__(self, key):
+        h = key_hash(key)
+        node = self._root
+        shift = 0
+        while True:
+            bit = 1 << ((h >> shift) & MASK)
+            if not node.bitmap & bit:
+                raise KeyError(key)
+            child = node.children[bit_index(node.bitmap, bit)]
+            if isinstance(child, MapNode):
+                node = child
+                shift += BITS
+            elif isinstance(child, Collision):
+                for k, v in child.items:
+                    if k == key:
+                        return v
+                raise KeyError(key)
+            elif child[1] == key:
+                return child[2]
+            else:
+                raise KeyError(key)
+
+    def iteritems(self):
+        return node_items(self._root)
+
+    def __iter__(self):
+        return (key for key, _ in node_items(self._root))
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class PersistentSet(Set):
+    __slots__ = ('_map',)
+
+    def __init__(self, items=()):
+        self._map = PersistentMap((item, True) for item in items)
+
+    @classmethod
+    def wrap(cls, items):
+        if isinstance(items, cls):
+            return items
+        return cls(items)
+
+    def add(self, item):
+        """Return a new set with item added, sharing everything else"""
+        new = PersistentSet.__new__(PersistentSet)
+        new._map = self._map.set(item, True)
+        return new
+
+    def __contains__(self, item):
+        return item in self._map
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __len__(self):
+        return len(self._map)
+
+    def __repr__(self):
+        return repr(set(self._map))
@@ -0,0 +1,313 @@
+"""Pre-built container namespaces, waiting for a command to exec
+
+A pool daemon keeps zygotes of one container parked: each has gone
+through ContainerNamespace.build (user and mount namespaces, mounts,
+pivot_root, dropped capabilities) and blocks on a control socket.
+Clients connect to the daemon's unix socket and pass their stdio fds
+and what to run, which the daemon hands to a parked zygote to exec.
+
+Zygotes share the container, so their changes go to a tmpfs each
+(like run --ephemeral) and the container must not have any in delta.
+Each one gets a cgroup with the container's resource limits.
+"""
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import time
+
+from shoebox.build_session import recv_message, send_message
+from shoebox.catalog import Catalog
+from shoebox.cgroups import Cgroup
+from shoebox.dockerfile import RunContext
+from shoebox.exec_commands import exec_in_namespace
+from shoebox.libc import recv_fds, send_fds
+from shoebox.namespaces import ContainerNamespace
+
+
+logger = logging.getLogger('shoebox.pool')
+
+READY = 'R'
+# between zygotes failing before they're ready
+RESPAWN_DELAY = 1.0
+
+
+def pool_socket_path(shoebox_dir, container_id):
+    # unix socket paths are short, a prefix of the id will do
+    return os.path.join(shoebox_dir, 'pools', '{0}.sock'.format(container_id[:16]))
+
+
+def exit_status(ret):
+    if ret & 0x7f:
+        return 128 + (ret & 0x7f)
+    return ret >> 8
+
+
+def zygote_main(control):
+    """Park until the daemon sends a request, then exec it"""
+    control.sendall(READY)
+    data, fds = recv_fds(control.fileno(), 1, 3)
+    if not data:
+        # pool shutting down
+        return
+    request = recv_message(control)
+    control.close()
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+    for fd in fds:
+        if fd > 2:
+            os.close(fd)
+    context = RunContext(environ=request['environ'], user=request['user'], workdir=request['workdir'])
+    exec_in_namespace(context, request['command'])
+
+
+class ZygotePool(object):
+    """Keep size zygotes parked, more while clients wait, never over max_size"""
+
+    def __init__(self, shoebox_dir, container, userns, size, max_size, ephemeral_size):
+        self.shoebox_dir = shoebox_dir
+        self.container = container
+        self.container_id = Catalog(shoebox_dir).resolve(container.container_id)
+        self.size = size
+        self.max_size = max(max_size, size)
+        self.userns = userns
+        # raises if the container has changes, before any zygote forks
+        self.filesystem = container.filesystem(ephemeral_size)
+        self.socket_path = pool_socket_path(shoebox_dir, self.container_id)
+        self.listener = None
+        # zygote pid -> control socket
+        self.controls = {}
+        # zygote pid -> Cgroup
+        self.cgroups = {}
+        self.starting = set()
+        self.parked = []
+        # zygote pid -> client socket
+        self.running = {}
+        # (client socket, fds, request)
+        self.queue = []
+        self.last_failure = 0
+        self.spawned = 0
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def spawn(self):
+        self.spawned += 1
+        cgroup = Cgroup('pool-{0}-{1}-{2}'.format(self.container_id[:12], os.getpid(), self.spawned),
+                        self.container.metadata.limits)
+        cgroup.create()
+        namespace = ContainerNamespace(self.filesystem, self.userns, hostname=self.container.metadata.hostname,
+                                       cgroup=cgroup)
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            # don't keep client connections or other zygotes open
+            for sock in [self.listener] + self.controls.values() + self.running.values():
+                sock.close()
+            for client, fds, _ in self.queue:
+                client.close()
+                for fd in fds:
+                    os.close(fd)
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            namespace.execns(zygote_main, child_sock)
+        child_sock.close()
+        self.controls[pid] = parent_sock
+        self.cgroups[pid] = cgroup
+        self.starting.add(pid)
+
+    def refill(self):
+        if time.time() - self.last_failure < RESPAWN_DELAY:
+            return
+        while (len(self.parked) + len(self.starting) < self.size + len(self.queue) and
+               len(self.parked) + len(self.starting) + len(self.running) < self.max_size):
+            self.spawn()
+
+    def dispatch(self):
+        while self.queue and self.parked:
+            client, fds, request = self.queue.pop(0)
+            pid = self.parked.pop(0)
+            try:
+                send_fds(self.controls[pid].fileno(), 'x', fds)
+                send_message(self.controls[pid], request)
+                self.running[pid] = client
+            except (OSError, socket.error):
+                logger.exception('Cannot hand request to zygote {0}'.format(pid))
+                client.close()
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def accept(self):
+        client, _ = self.listener.accept()
+        try:
+            data, fds = recv_fds(client.fileno(), 1, 3)
+            request = recv_message(client) if data else None
+        except (OSError, EOFError, socket.error):
+            logger.debug('Bad pool request', exc_info=True)
+            request = None
+            fds = []
+        if request is None or len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            client.close()
+            return
+        self.queue.append((client, fds, request))
+
+    def reap(self):
+        while True:
+            try:
+                pid, ret = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            control = self.controls.pop(pid, None)
+            if control is not None:
+                control.close()
+            if pid in self.cgroups:
+                self.cgroups.pop(pid).remove()
+            if pid in self.running:
+                client = self.running.pop(pid)
+                try:
+                    send_message(client, exit_status(ret))
+                except socket.error:
+                    pass
+                client.close()
+            elif pid in self.starting or pid in self.parked:
+                logger.error('Zygote {0} exited with status {1} before use'.format(pid, exit_status(ret)))
+                self.starting.discard(pid)
+                if pid in self.parked:
+                    self.parked.remove(pid)
+                self.last_failure = time.time()
+
+    def ready(self, pid):
+        self.starting.discard(pid)
+        if self.controls[pid].recv(1) == READY:
+            self.parked.append(pid)
+
+    def client_gone(self, pid):
+        # nobody is waiting for the result any more
+        logger.debug('Client of zygote {0} went away, killing it'.format(pid))
+        self.kill(pid)
+
+    @staticmethod
+    def kill(pid):
+        """Kill a zygote and everything in its pid namespace
+
+        pid only waits for pid 1 of the namespace, SIGTERM makes it
+        SIGKILL that one, which the kernel follows up on for the rest.
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def serve(self):
+        # zygotes join it instead of mapping ids each
+        self.userns.start_holder()
+        if not os.path.exists(os.path.dirname(self.socket_path)):
+            os.makedirs(os.path.dirname(self.socket_path), mode=0o700)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen(64)
+
+        def wakeup(signum, frame):
+            os.write(self.wakeup_w, 'x')
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+
+        signal.signal(signal.SIGCHLD, wakeup)
+        signal.signal(signal.SIGTERM, stop)
+        catalog = Catalog(self.shoebox_dir)
+        catalog.set_running(self.container_id, os.getpid())
+        logger.info('Pool for {0} listening on {1}'.format(self.container_id, self.socket_path))
+        try:
+            while True:
+                self.reap()
+                self.refill()
+                self.dispatch()
+                waiting = dict((control.fileno(), pid) for pid, control in self.controls.items()
+                               if pid in self.starting)
+                clients = dict((client.fileno(), pid) for pid, client in self.running.items())
+                try:
+                    readable, _, _ = select.select(
+                        [self.listener.fileno(), self.wakeup_r] + waiting.keys() + clients.keys(), [], [],
+                        RESPAWN_DELAY)
+                except select.error as exc:
+                    if exc.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd in readable:
+                    if fd == self.listener.fileno():
+                        self.accept()
+                    elif fd == self.wakeup_r:
+                        os.read(self.wakeup_r, 64)
+                    elif fd in waiting:
+                        self.ready(waiting[fd])
+                    elif fd in clients:
+                        self.client_gone(clients[fd])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+            catalog.set_stopped(self.container_id)
+
+    def close(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self.listener.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        for client, fds, _ in self.queue:
+            client.close()
+            for fd in fds:
+                os.close(fd)
+        for pid, control in self.controls.items():
+            control.close()
+            if pid not in self.running:
+                # parked and starting zygotes, running ones finish their job
+                self.kill(pid)
+        for pid in self.controls:
+            try:
+                _, ret = os.waitpid(pid, 0)
+            except OSError:
+                continue
+            if pid in self.running:
+                send_message(self.running[pid], exit_status(ret))
+                self.running[pid].close()
+        for cgroup in self.cgroups.values():
+            cgroup.remove()
+
+
+def run_in_pool(shoebox_dir, container_id, context, command):
+    """Run command in a zygote of the pool for container_id, return its exit status"""
+    path = pool_socket_path(shoebox_dir, container_id)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        raise RuntimeError('No pool running for {0}, start one with shoebox pool'.format(container_id))
+    try:
+        send_fds(sock.fileno(), 'x', [0, 1, 2])
+        send_message(sock, {
+            'command': command,
+            'environ': dict(context.environ),
+            'user': context.user,
+            'workdir': context.workdir,
+        })
+        status = recv_message(sock)
+    finally:
+        sock.close()
+    if status is None:
+        raise RuntimeError('Pool for {0} went away'.format(container_id))
+    return status
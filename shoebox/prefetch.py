@@ -0,0 +1,124 @@
+import fcntl
+import logging
+import os
+import shutil
+import signal
+import tempfile
+
+
+logger = logging.getLogger('shoebox.prefetch')
+
+
+class Prefetcher(object):
+    """Run jobs in a forked worker ahead of the time they're needed
+
+    jobs is a list of (key, func, args). Each func returns the path of a
+    file it produced. The worker runs them in order, but never more than
+    lookahead jobs past the last one taken. If a job fails the caller
+    gets None and should just do the work itself, so errors still come
+    up at the right build step.
+    """
+
+    def __init__(self, jobs, lookahead=4, staging_dir=None):
+        self.keys = [key for key, _, _ in jobs]
+        self.jobs = jobs
+        self.lookahead = lookahead
+        self.staging_dir = staging_dir
+        self.taken = 0
+        self.results = {}
+        self.pid = None
+        self.token_fd = None
+        self.result_fp = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if not self.jobs:
+            return
+        token_r, token_w = os.pipe()
+        result_r, result_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(token_w)
+            os.close(result_r)
+            exitcode = 1
+            # noinspection PyBroadException
+            try:
+                self.worker(token_r, os.fdopen(result_w, 'w'))
+                exitcode = 0
+            except:
+                logger.exception('Prefetch worker failed')
+            finally:
+                # noinspection PyProtectedMember
+                os._exit(exitcode)
+        os.close(token_r)
+        os.close(result_w)
+        # keep them out of build steps exec'd later
+        for fd in (token_w, result_r):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.pid = pid
+        self.token_fd = token_w
+        self.result_fp = os.fdopen(result_r)
+
+    def worker(self, token_fd, result_fp):
+        taken = 0
+        for i, (key, func, args) in enumerate(self.jobs):
+            while i >= taken + self.lookahead:
+                tokens = os.read(token_fd, 64)
+                if not tokens:
+                    # nobody is waiting for results any more
+                    return
+                taken += len(tokens)
+            # noinspection PyBroadException
+            try:
+                path = func(*args)
+                print >> result_fp, '{0}\tok\t{1}'.format(i, path)
+            except:
+                logger.debug('Prefetching {0!r} failed'.format(key), exc_info=True)
+                print >> result_fp, '{0}\terror\t'.format(i)
+            result_fp.flush()
+
+    def take(self, key):
+        """Wait for the next job with key, return its path or None"""
+        try:
+            index = self.keys.index(key, self.taken)
+        except ValueError:
+            return
+        if self.pid is None:
+            return
+        # let the worker move on, jobs skipped over count as taken too
+        os.write(self.token_fd, 'x' * (index + 1 - self.taken))
+        self.taken = index + 1
+        while index not in self.results:
+            line = self.result_fp.readline()
+            if not line:
+                return
+            i, status, path = line.rstrip('\n').split('\t')
+            self.results[int(i)] = path if status == 'ok' else None
+        return self.results.pop(index)
+
+    def close(self):
+        if self.pid is not None:
+            os.close(self.token_fd)
+            self.result_fp.close()
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            os.waitpid(self.pid, 0)
+            self.pid = None
+        if self.staging_dir is not None and os.path.exists(self.staging_dir):
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+def stage_archive(extractor, staging_dir):
+    """Write what extractor would extract to a file, return its path"""
+    fd, path = tempfile.mkstemp(suffix='.tar', dir=staging_dir)
+    with os.fdopen(fd, 'w') as fp:
+        extractor.build_tar_archive(fp)
+    return path
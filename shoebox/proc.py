@@ -0,0 +1,154 @@
+"""Read the process table from /proc in a single pass"""
+from collections import namedtuple
+import os
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# cpu_time and start_time in seconds, start_time since boot
+ProcessInfo = namedtuple('ProcessInfo', 'pid ppid name cmdline state rss cpu_time start_time pidns')
+
+
+def uptime(proc_dir='/proc'):
+    with open(os.path.join(proc_dir, 'uptime')) as fp:
+        return float(fp.read().split()[0])
+
+
+def read_process(pid, proc_dir='/proc', with_cmdline=True):
+    """Return ProcessInfo for pid, None if it's gone
+
+    Without with_cmdline, cmdline is left empty to save a read.
+    """
+    base = os.path.join(proc_dir, str(pid))
+    try:
+        with open(os.path.join(base, 'stat')) as fp:
+            stat = fp.read()
+        if with_cmdline:
+            with open(os.path.join(base, 'cmdline')) as fp:
+                cmdline = fp.read().rstrip('\0').split('\0')
+        else:
+            cmdline = ['']
+        try:
+            pidns = os.readlink(os.path.join(base, 'ns', 'pid'))
+        except OSError:
+            # other users' processes
+            pidns = None
+    except (IOError, OSError):
+        return
+    # comm may contain spaces and parentheses, it ends at the last ')'
+    head, _, tail = stat.rpartition(')')
+    name = head.partition('(')[2]
+    fields = tail.split()
+    # fields[0] is field 3 (state) in proc(5)
+    utime, stime = int(fields[11]), int(fields[12])
+    return ProcessInfo(
+        pid=int(pid),
+        ppid=int(fields[1]),
+        name=name,
+        cmdline=cmdline if cmdline != [''] else [],
+        state=fields[0],
+        rss=int(fields[21]) * PAGE_SIZE,
+        cpu_time=float(utime + stime) / CLOCK_TICKS,
+        start_time=float(fields[19]) / CLOCK_TICKS,
+        pidns=pidns)
+
+
+def scan_processes(proc_dir='/proc', with_cmdline=True):
+    """Return {pid: ProcessInfo} for all processes"""
+    processes = {}
+    for name in os.listdir(proc_dir):
+        if name.isdigit():
+            info = read_process(name, proc_dir, with_cmdline)
+            if info is not None:
+                processes[info.pid] = info
+    return processes
+
+
+def read_children(pid, proc_dir='/proc'):
+    """Return child pids of pid, None if the kernel doesn't list them"""
+    children = []
+    try:
+        tasks = os.listdir(os.path.join(proc_dir, str(pid), 'task'))
+    except OSError:
+        return children
+    for tid in tasks:
+        try:
+            with open(os.path.join(proc_dir, str(pid), 'task', tid, 'children')) as fp:
+                children.extend(int(child) for child in fp.read().split())
+        except IOError:
+            # CONFIG_PROC_CHILDREN, or the task is gone
+            if not os.path.exists(os.path.join(proc_dir, str(pid), 'task', tid)):
+                continue
+            return
+    return children
+
+
+def scan_subtree(pid, proc_dir='/proc', with_cmdline=True):
+    """Return {pid: ProcessInfo} for pid and its descendants, without reading every process"""
+    processes = {}
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        info = read_process(current, proc_dir, with_cmdline)
+        if info is None:
+            continue
+        processes[current] = info
+        children = read_children(current, proc_dir)
+        if children is None:
+            tree = ProcessTree(scan_processes(proc_dir, with_cmdline))
+            return dict((info.pid, info) for _, info in tree.subtree(pid))
+        stack.extend(children)
+    return processes
+
+
+class ProcessTree(object):
+    def __init__(self, processes):
+        self.processes = processes
+        self.children = {}
+        for info in processes.values():
+            self.children.setdefault(info.ppid, []).append(info.pid)
+        for pids in self.children.values():
+            pids.sort()
+
+    def subtree(self, pid):
+        """Yield (depth, ProcessInfo) for pid and its descendants, depth first"""
+        stack = [(0, pid)]
+        while stack:
+            depth, pid = stack.pop()
+            info = self.processes.get(pid)
+            if info is None:
+                continue
+            yield depth, info
+            stack.extend((depth + 1, child) for child in reversed(self.children.get(pid, [])))
+
+    def container_processes(self, pid):
+        """Return (depth, ProcessInfo) of everything running in the container of pid
+
+        That's the subtree of pid (the pidfile of run), plus processes which
+        joined its pid namespace from elsewhere, as separate subtrees.
+        """
+        result = list(self.subtree(pid))
+        seen = set(info.pid for _, info in result)
+        root = self.processes.get(pid)
+        namespaces = set(info.pidns for _, info in result if info.pidns is not None) - {root and root.pidns}
+        for other in sorted(self.processes):
+            info = self.processes[other]
+            if other in seen or info.pidns not in namespaces:
+                continue
+            # topmost process of a subtree in the namespace, but not below pid
+            if self.processes.get(info.ppid) and self.processes[info.ppid].pidns in namespaces:
+                continue
+            for depth, child in self.subtree(other):
+                if child.pid not in seen:
+                    seen.add(child.pid)
+                    result.append((depth, child))
+        return result
+
+
+def cpu_percent(info, now):
+    """Average CPU usage over the lifetime of a process, like ps(1)"""
+    elapsed = now - info.start_time
+    if elapsed <= 0:
+        return 0.0
+    return 100.0 * info.cpu_time / elapsed
@@ -7,6 +7,7 @@ import requests
 from shoebox import tar
 from shoebox.mount_namespace import FilesystemNamespace
 from shoebox.namespaces import ContainerNamespace
+from shoebox.prefetch import Prefetcher
 
 
 DEFAULT_INDEX = 'https://index.docker.io'
@@ -98,7 +99,9 @@ class ImageRepository(object):
 
         if not os.path.exists(self.storage_dir):
             os.makedirs(self.storage_dir, mode=0o755)
-        with open(path, 'w') as fp:
+        # an interrupted download must not look like a finished one
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as fp:
             self.logger.info('Downloading image: {0}'.format(image_id))
             image = self.image_layer(image_id)
             resp_size = image.headers.get('Content-Length')
@@ -113,6 +116,7 @@ class ImageRepository(object):
                     self.progress_logger.info(progress_format.format(downloaded >> 10))
                     fp.write(chunk)
                     fp.flush()
+        os.rename(tmp_path, path)
 
         return path
 
@@ -131,11 +135,15 @@ class ImageRepository(object):
         if not os.path.exists(target_dir):
             os.makedirs(target_dir, mode=0o755)
 
-        for image_id in reversed(self.ancestors(image_id)):
-            layer = self.download_image(image_id, force=force_download)
-            fs = FilesystemNamespace(target_dir)
-            namespace = ContainerNamespace(fs)
-            tar.ExtractTarFile(namespace, '/', layer).run()
+        layer_ids = list(reversed(self.ancestors(image_id)))
+        # download the next layers while extracting this one
+        jobs = [(layer_id, self.download_image, (layer_id, force_download)) for layer_id in layer_ids]
+        with Prefetcher(jobs, lookahead=2) as prefetcher:
+            for layer_id in layer_ids:
+                layer = prefetcher.take(layer_id) or self.download_image(layer_id, force=force_download)
+                fs = FilesystemNamespace(target_dir)
+                namespace = ContainerNamespace(fs)
+                tar.ExtractTarFile(namespace, '/', layer).run()
 
         self.logger.debug('Unpacked {0} in {1}'.format(image_id, target_dir))
         return target_dir
@@ -1,8 +1,12 @@
-import logging
-import shutil
+import binascii
 import errno
+import fcntl
+import logging
+import multiprocessing
 import os
+import shutil
 
+from shoebox.catalog import Catalog
 from shoebox.mount_namespace import FilesystemNamespace
 from shoebox.namespaces import ContainerNamespace
 
@@ -10,41 +14,157 @@ from shoebox.namespaces import ContainerNamespace
 logger = logging.getLogger('shoebox.rm')
 
 
-def rm_layer(namespace):
-    namespace.run(shutil.rmtree, '/', ignore_errors=True)
+def trash_dir(shoebox_dir):
+    return os.path.join(shoebox_dir, 'trash')
+
 
+def move_to_trash(shoebox_dir, container_id, volumes=False):
+    """Move a container out of the way in one rename, return where to
 
-def remove_container(shoebox_dir, container_id, userns, volumes=False):
+    Unless volumes is set, they are moved back into an otherwise empty
+    runtime dir, like removing the rest of a container always did.
+    """
     runtime_dir = os.path.join(shoebox_dir, 'containers', container_id)
-    target_base = os.path.join(runtime_dir, 'base')
-    target_delta = os.path.join(runtime_dir, 'delta')
-    target_root = os.path.join(runtime_dir, 'root')
-    volume_root = os.path.join(runtime_dir, 'volumes')
-    metadata_file = os.path.join(runtime_dir, 'metadata.json')
-
-    if os.path.exists(target_root):
-        os.rmdir(target_root)
-    directories = [target_base, target_delta]
-    if volumes:
-        directories.append(volume_root)
-    else:
-        if os.path.exists(volume_root):
-            logger.info('Preserving volumes in {0}'.format(volume_root))
-    for directory in directories:
-        if os.path.exists(directory):
-            fs = FilesystemNamespace(directory)
-            namespace = ContainerNamespace(fs, userns)
-            logger.debug('Removing {0}'.format(directory))
-            rm_layer(namespace)
-            os.rmdir(directory)
-    if os.path.exists(metadata_file):
-        os.unlink(metadata_file)
+    if not os.path.isdir(runtime_dir):
+        logger.warning('No container {0}'.format(container_id))
+        return
+    # don't move the tag symlink, but what it points to
+    container_id = Catalog(shoebox_dir).resolve(container_id)
+    runtime_dir = os.path.join(shoebox_dir, 'containers', container_id)
+
+    trash = trash_dir(shoebox_dir)
+    if not os.path.exists(trash):
+        try:
+            os.makedirs(trash, mode=0o755)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+    path = os.path.join(trash, '{0}.{1}'.format(container_id, binascii.hexlify(os.urandom(4))))
+    os.rename(runtime_dir, path)
+
+    volume_root = os.path.join(path, 'volumes')
+    if not volumes and os.path.exists(volume_root):
+        os.mkdir(runtime_dir, 0o755)
+        os.rename(volume_root, os.path.join(runtime_dir, 'volumes'))
+        logger.info('Preserving volumes in {0}'.format(os.path.join(runtime_dir, 'volumes')))
+
+    Catalog(shoebox_dir).remove_container(container_id)
+    logger.info('Removed {0}'.format(container_id))
+    return path
+
 
+def delete_trees(paths, jobs):
+    """Delete paths with jobs forked workers, inside the namespace"""
+    # one level below base, delta etc. splits most trees well enough
+    work = []
+    for path in paths:
+        for layer in sorted(os.listdir(path)):
+            layer_path = os.path.join(path, layer)
+            if os.path.isdir(layer_path) and not os.path.islink(layer_path):
+                work.extend(os.path.join(layer_path, name) for name in os.listdir(layer_path))
+    pids = []
+    for i in range(min(jobs, len(work))):
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 1
+            # noinspection PyBroadException
+            try:
+                for item in work[i::jobs]:
+                    if os.path.isdir(item) and not os.path.islink(item):
+                        shutil.rmtree(item, ignore_errors=True)
+                    else:
+                        os.unlink(item)
+                exitcode = 0
+            except:
+                logger.exception('Deleting trash failed')
+            finally:
+                # noinspection PyProtectedMember
+                os._exit(exitcode)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def reap_trash(shoebox_dir, userns, jobs=None, wait=True):
+    """Delete everything in the trash, in one namespace per batch
+
+    Only one reaper runs at a time. Without wait, return at once if
+    another one is busy, it will pick up what's in the trash as well.
+    """
+    trash = trash_dir(shoebox_dir)
+    if not os.path.exists(trash):
+        return
+    jobs = jobs or multiprocessing.cpu_count()
+    with open(os.path.join(shoebox_dir, 'trash.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except IOError:
+            return
+        failed = set()
+        while True:
+            names = sorted(set(os.listdir(trash)) - failed)
+            if not names:
+                break
+            logger.debug('Deleting {0} trees from {1}'.format(len(names), trash))
+            namespace = ContainerNamespace(FilesystemNamespace(trash), userns)
+            try:
+                namespace.run(delete_trees, ['/' + name for name in names], jobs)
+            except RuntimeError as exc:
+                logger.warning('Deleting trash failed: {0}'.format(exc))
+            for name in names:
+                if os.path.lexists(os.path.join(trash, name)):
+                    logger.warning('Cannot delete {0}'.format(os.path.join(trash, name)))
+                    failed.add(name)
+    # a reaper giving up on the lock just before we released it left its trees
+    if not wait and set(os.listdir(trash)) - failed:
+        reap_trash(shoebox_dir, userns, jobs, wait)
+
+
+def start_reaper(shoebox_dir, userns):
+    """Reap the trash in a detached process"""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    exitcode = 1
+    # noinspection PyBroadException
     try:
-        os.rmdir(runtime_dir)
-        logger.info('Removed {0}'.format(container_id))
-    except OSError as exc:
-        if exc.errno == errno.ENOTEMPTY:
-            logger.info('{0} not empty, not removing'.format(runtime_dir))
-        else:
-            raise
+        os.setsid()
+        if os.fork() == 0:
+            # don't hold the caller's pipes open, e.g. out=$(shoebox run --rm ...) would wait for us
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            keep = set([0, 1, 2])
+            if userns.holder:
+                keep.update((userns.holder.ns_fd, userns.holder.hold_fd))
+            for fd in os.listdir('/proc/self/fd'):
+                if int(fd) not in keep:
+                    try:
+                        os.close(int(fd))
+                    except OSError:
+                        pass
+            reap_trash(shoebox_dir, userns, wait=False)
+        exitcode = 0
+    except:
+        logger.exception('Reaping trash failed')
+    finally:
+        # noinspection PyProtectedMember
+        os._exit(exitcode)
+
+
+def remove_containers(shoebox_dir, container_ids, userns, volumes=False, background=False):
+    """Remove containers, deleting their files in one go or in the background"""
+    moved = [move_to_trash(shoebox_dir, container_id, volumes) for container_id in container_ids]
+    if not any(moved):
+        return
+    if background:
+        start_reaper(shoebox_dir, userns)
+    else:
+        reap_trash(shoebox_dir, userns)
+
+
+def remove_container(shoebox_dir, container_id, userns, volumes=False, background=False):
+    remove_containers(shoebox_dir, [container_id], userns, volumes, background)
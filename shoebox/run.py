@@ -1,11 +1,14 @@
 import os
 
 from shoebox.build import build_container
+from shoebox.catalog import Catalog
+from shoebox.cgroups import Cgroup, merge_limits
 from shoebox.container import Container
 from shoebox.dockerfile import inherit_docker_metadata
 from shoebox.exec_commands import exec_in_namespace
 from shoebox.namespaces import ContainerNamespace
 from shoebox.rm import remove_container
+from shoebox.trace import mark, span
 
 
 def load_container(container_id, shoebox_dir):
@@ -34,15 +37,15 @@ def clone_image(force, from_image, repo, shoebox_dir, userns):
     return container
 
 
-def run_container(container, userns, shoebox_dir, command, entrypoint, user=None, workdir=None,
-                  rm=False, private_net=None, links=None, env=None):
-    namespace = ContainerNamespace(
-        container.filesystem(), userns, private_net, hostname=container.metadata.hostname, links=links)
-
+def run_context(container, command, entrypoint, user=None, workdir=None, links=None, env=None):
+    """Return the RunContext and full command line to run in container"""
     if entrypoint is None:
         entrypoint = container.metadata.entrypoint or []
-    else:
+    elif entrypoint:
         entrypoint = [entrypoint]
+    else:
+        # --entrypoint '' drops the image's entrypoint
+        entrypoint = []
 
     if not command:
         command = container.metadata.command or []
@@ -59,13 +62,13 @@ def run_container(container, userns, shoebox_dir, command, entrypoint, user=None
         # noinspection PyProtectedMember
         context = context._replace(workdir=workdir)
 
-    environ = context.environ
+    environ = dict(context.environ)
     if 'TERM' in os.environ:
         environ['TERM'] = os.environ['TERM']
     if 'LANG' in os.environ:
         environ['LANG'] = os.environ['LANG']
 
-    for l in links:
+    for l in links or []:
         environ.update(l.environ())
 
     if env:
@@ -73,12 +76,43 @@ def run_container(container, userns, shoebox_dir, command, entrypoint, user=None
             k, v = var.split('=', 1)
             environ[k] = v
 
-    container.write_pidfile()
-    if private_net and private_net.ip_address:
-        container.write_ip_address(private_net.ip_address)
+    # noinspection PyProtectedMember
+    context = context._replace(environ=environ)
+    return context, command
+
+
+def run_container(container, userns, shoebox_dir, command, entrypoint, user=None, workdir=None,
+                  rm=False, private_net=None, links=None, env=None, limits=None, ephemeral_size=None, tmpfs=None):
+    # the catalog knows containers by id, not by the tag they were run as
+    container_id = Catalog(shoebox_dir).resolve(container.container_id)
+    if limits is not None:
+        # remembered for later runs of the container
+        merged = merge_limits(container.metadata.limits, limits)
+        if merged != container.metadata.limits:
+            # noinspection PyProtectedMember
+            metadata = container.metadata._replace(limits=merged)
+            Container(shoebox_dir, container_id).save_metadata(metadata)
+            container.metadata = metadata
+    cgroup = Cgroup('run-{0}-{1}'.format(container_id[:12], os.getpid()), container.metadata.limits)
+    namespace = ContainerNamespace(
+        container.filesystem(ephemeral_size, tmpfs), userns, private_net, hostname=container.metadata.hostname,
+        links=links, cgroup=cgroup)
+    context, command = run_context(container, command, entrypoint, user, workdir, links, env)
+
+    catalog = Catalog(shoebox_dir)
+    with span('register_run'):
+        container.write_pidfile()
+        ip_address = None
+        if private_net and private_net.ip_address:
+            ip_address = private_net.ip_address
+            container.write_ip_address(ip_address)
+        catalog.set_running(container_id, os.getpid(), ip_address)
     try:
-        namespace.run(exec_in_namespace, context, command)
+        with cgroup:
+            mark('fork_namespace')
+            namespace.run(exec_in_namespace, context, command)
         if rm:
-            remove_container(shoebox_dir, container.container_id, userns, False)
+            remove_container(shoebox_dir, container_id, userns, False, background=True)
     finally:
         container.cleanup_runtime_files()
+        catalog.set_stopped(container_id)
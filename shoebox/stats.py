@@ -0,0 +1,308 @@
+"""Resource usage of running containers, sampled from their cgroups and /proc"""
+from collections import namedtuple
+import json
+import logging
+import os
+import sys
+import time
+
+from shoebox.catalog import Catalog
+from shoebox.cgroups import cgroup2_mountpoint, cgroup_of
+from shoebox.proc import read_process, scan_subtree, uptime
+from shoebox.utils import format_size
+
+
+logger = logging.getLogger('shoebox.stats')
+
+# byte counters are totals over the live processes, *_rate per second
+ContainerStats = namedtuple('ContainerStats', 'container_id tags pids cpu_percent rss fds read_bytes write_bytes '
+                                              'read_rate write_rate net_rx net_tx net_rx_rate net_tx_rate')
+
+
+def read_io(pid):
+    """Return (read_bytes, write_bytes) of pid, (0, 0) if not readable"""
+    read_bytes = write_bytes = 0
+    try:
+        with open('/proc/{0}/io'.format(pid)) as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                if key == 'read_bytes':
+                    read_bytes = int(value)
+                elif key == 'write_bytes':
+                    write_bytes = int(value)
+    except (IOError, ValueError):
+        pass
+    return read_bytes, write_bytes
+
+
+def count_fds(pid):
+    try:
+        return len(os.listdir('/proc/{0}/fd'.format(pid)))
+    except OSError:
+        return 0
+
+
+def net_namespace(pid):
+    try:
+        return os.readlink('/proc/{0}/ns/net'.format(pid))
+    except OSError:
+        return
+
+
+def read_net_dev(pid):
+    """Return (rx_bytes, tx_bytes) over all interfaces but lo in the netns of pid"""
+    rx = tx = 0
+    try:
+        with open('/proc/{0}/net/dev'.format(pid)) as fp:
+            # two header lines
+            for line in fp.readlines()[2:]:
+                interface, _, counters = line.partition(':')
+                if interface.strip() == 'lo':
+                    continue
+                counters = counters.split()
+                rx += int(counters[0])
+                tx += int(counters[8])
+    except (IOError, IndexError, ValueError):
+        return
+    return rx, tx
+
+
+def read_cgroup_file(path, name):
+    try:
+        with open(os.path.join(path, name)) as fp:
+            return fp.read()
+    except IOError:
+        # controller not enabled there, or the cgroup is gone
+        return
+
+
+def read_cgroup_counters(path):
+    """Return (cpu_time, memory, read_bytes, write_bytes, pids) of a cgroup
+
+    Each is None unless the cgroup accounts for it, which for all but
+    CPU time depends on the controllers enabled for its limits.
+    """
+    cpu_time = memory = read_bytes = write_bytes = pids = None
+    cpu_stat = read_cgroup_file(path, 'cpu.stat')
+    for line in (cpu_stat or '').splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'usage_usec':
+            cpu_time = int(value) / 1e6
+    value = read_cgroup_file(path, 'memory.current')
+    if value:
+        memory = int(value)
+    io_stat = read_cgroup_file(path, 'io.stat')
+    if io_stat is not None:
+        read_bytes = write_bytes = 0
+        # one line per device: MAJ:MIN rbytes=.. wbytes=.. rios=..
+        for line in io_stat.splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition('=')
+                if key == 'rbytes':
+                    read_bytes += int(value)
+                elif key == 'wbytes':
+                    write_bytes += int(value)
+    value = read_cgroup_file(path, 'pids.current')
+    if value:
+        pids = int(value)
+    return cpu_time, memory, read_bytes, write_bytes, pids
+
+
+def container_cgroups(pid, processes, mountpoint):
+    """Return the cgroups of the namespaces pid forked (one for run, one per zygote of a pool)
+
+    Only containers with resource limits have one.
+    """
+    if mountpoint is None:
+        return []
+    own = cgroup_of(pid, mountpoint)
+    cgroups = set()
+    for info in processes.values():
+        if info.ppid == pid:
+            path = cgroup_of(info.pid, mountpoint)
+            if path is not None and path != own:
+                cgroups.add(path)
+    return sorted(cgroups)
+
+
+def container_processes(pid, mountpoint):
+    """Return ({pid: ProcessInfo}, cgroups) of the container run by pid
+
+    That's the subtree of pid, plus processes exec joined into its cgroups.
+    """
+    processes = scan_subtree(pid, with_cmdline=False)
+    cgroups = container_cgroups(pid, processes, mountpoint)
+    for path in cgroups:
+        for other in (read_cgroup_file(path, 'cgroup.procs') or '').split():
+            if int(other) not in processes:
+                info = read_process(other, with_cmdline=False)
+                if info is not None:
+                    processes[info.pid] = info
+    return processes, cgroups
+
+
+def rate(current, previous, interval):
+    if previous is None or not interval:
+        return 0.0
+    return max(current - previous, 0) / interval
+
+
+class StatsCollector(object):
+    """Turn consecutive samples into per-container usage
+
+    Only the process subtrees of running containers are read. CPU time,
+    memory, block I/O and pid counts come from the container's cgroups
+    where those account for them, including processes that already
+    exited. Otherwise they are summed over the processes, comparing
+    counters per (pid, start time) so exiting and reused pids don't
+    show up as negative usage.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.last_time = None
+        self.process_counters = {}
+        self.cgroup_counters = {}
+        self.net_counters = {}
+        self.mountpoint = cgroup2_mountpoint()
+
+    def cgroup_deltas(self, path, counters):
+        previous = self.cgroup_counters.get(path)
+        if previous is None:
+            if self.last_time is None:
+                return 0.0, 0, 0
+            # a pool zygote created since the last sample
+            previous = (0.0, 0, 0)
+        return tuple(max((value or 0) - (old or 0), 0) for value, old in zip(counters, previous))
+
+    def sample(self):
+        now = uptime()
+        interval = now - self.last_time if self.last_time is not None else None
+        process_counters = {}
+        cgroup_counters = {}
+        net_counters = {}
+        results = []
+        for entry in self.entries:
+            processes, cgroups = container_processes(entry.pid, self.mountpoint)
+            if not processes:
+                continue
+            cpu = read_delta = write_delta = 0.0
+            rss = fds = read_bytes = write_bytes = 0
+            host_net = net_namespace(entry.pid)
+            net = None
+            for info in processes.values():
+                key = (info.pid, info.start_time)
+                counters = (info.cpu_time,) + read_io(info.pid)
+                process_counters[key] = counters
+                previous = self.process_counters.get(key)
+                if previous is None and self.last_time is not None and info.start_time >= self.last_time:
+                    # started since the last sample, all of its usage is new
+                    previous = (0.0, 0, 0)
+                if previous is not None:
+                    cpu += max(counters[0] - previous[0], 0)
+                    read_delta += max(counters[1] - previous[1], 0)
+                    write_delta += max(counters[2] - previous[2], 0)
+                rss += info.rss
+                fds += count_fds(info.pid)
+                read_bytes += counters[1]
+                write_bytes += counters[2]
+                if net is None and net_namespace(info.pid) not in (None, host_net):
+                    net = read_net_dev(info.pid)
+            pids = len(processes)
+
+            if cgroups:
+                counters = [read_cgroup_counters(path) for path in cgroups]
+                cpu_times, memory, read_totals, write_totals, pid_counts = zip(*counters)
+                deltas = []
+                for path, values in zip(cgroups, counters):
+                    cgroup_counters[path] = (values[0], values[2], values[3])
+                    deltas.append(self.cgroup_deltas(path, cgroup_counters[path]))
+                if None not in cpu_times:
+                    cpu = sum(delta[0] for delta in deltas)
+                if None not in memory:
+                    rss = sum(memory)
+                if None not in read_totals:
+                    read_bytes, write_bytes = sum(read_totals), sum(write_totals)
+                    read_delta = sum(delta[1] for delta in deltas)
+                    write_delta = sum(delta[2] for delta in deltas)
+                if None not in pid_counts:
+                    pids = sum(pid_counts)
+
+            net_rx, net_tx = net or (None, None)
+            previous_net = self.net_counters.get(entry.container_id, (None, None))
+            net_counters[entry.container_id] = (net_rx, net_tx)
+            results.append(ContainerStats(
+                container_id=entry.container_id,
+                tags=entry.tags,
+                pids=pids,
+                cpu_percent=100.0 * cpu / interval if interval else 0.0,
+                rss=rss,
+                fds=fds,
+                read_bytes=read_bytes,
+                write_bytes=write_bytes,
+                read_rate=read_delta / interval if interval else 0.0,
+                write_rate=write_delta / interval if interval else 0.0,
+                net_rx=net_rx,
+                net_tx=net_tx,
+                net_rx_rate=rate(net_rx, previous_net[0], interval) if net else None,
+                net_tx_rate=rate(net_tx, previous_net[1], interval) if net else None))
+        self.last_time = now
+        self.process_counters = process_counters
+        self.cgroup_counters = cgroup_counters
+        self.net_counters = net_counters
+        return results
+
+
+def running_containers(shoebox_dir, names):
+    """Return catalog entries of running containers, by id or tag, all without names"""
+    entries = Catalog(shoebox_dir).containers(running=True)
+    if not names:
+        return entries
+    selected = []
+    for name in names:
+        matches = [entry for entry in entries if name == entry.container_id or name in entry.tags]
+        if not matches:
+            raise RuntimeError('Container {0} is not running'.format(name))
+        selected.extend(matches)
+    return selected
+
+
+def print_stats(results, as_json):
+    if as_json:
+        for stats in results:
+            print json.dumps(stats._asdict())
+        sys.stdout.flush()
+        return
+    if sys.stdout.isatty():
+        # redraw in place
+        sys.stdout.write('\033[2J\033[H')
+    row = '{0:<14} {1:>6} {2:>8} {3:>5} {4:>5} {5:>17} {6:>17}'
+    print row.format('CONTAINER', 'CPU %', 'MEM', 'PIDS', 'FDS', 'BLOCK I/O', 'NET I/O')
+    for stats in results:
+        if stats.net_rx is None:
+            net = '-'
+        else:
+            net = '{0} / {1}'.format(format_size(stats.net_rx), format_size(stats.net_tx))
+        print row.format(
+            stats.tags[0] if stats.tags else stats.container_id[:12],
+            '{0:.1f}'.format(stats.cpu_percent), format_size(stats.rss), stats.pids, stats.fds,
+            '{0} / {1}'.format(format_size(stats.read_bytes), format_size(stats.write_bytes)), net)
+    sys.stdout.flush()
+
+
+def container_stats(shoebox_dir, names, interval=1.0, once=False, as_json=False):
+    """Print usage of the named (or all) running containers every interval seconds
+
+    With once, print a single sample, which still takes two of them
+    to tell CPU usage.
+    """
+    collector = StatsCollector(running_containers(shoebox_dir, names))
+    collector.sample()
+    while True:
+        time.sleep(interval)
+        print_stats(collector.sample(), as_json)
+        if once:
+            return
+        if not names:
+            # pick up containers started meanwhile, the catalog is cheap to ask
+            collector.entries = running_containers(shoebox_dir, names)
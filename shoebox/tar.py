@@ -1,4 +1,5 @@
 import copy
+import functools
 import logging
 import shutil
 import tarfile
@@ -27,6 +28,13 @@ TARBALL_EXTENSIONS = {
     '.txz': 'xz',
 }
 
+# not exposed by the os module in python 2
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+SPARSE_CHUNK = 1 << 16
+ZERO_CHUNK = '\0' * SPARSE_CHUNK
+
 
 def detect_tar_format(path):
     """Check if this is a tar archive and detect compression method
@@ -47,6 +55,108 @@ def detect_tar_format(path):
             return fmt
 
 
+def data_regions(fd, size):
+    """Yield (offset, length) of data regions in a file, skipping holes
+
+    Falls back to a single region spanning the whole file when
+    the filesystem does not support SEEK_DATA/SEEK_HOLE.
+    """
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as exc:
+                if exc.errno == errno.ENXIO:
+                    # nothing but a hole until EOF
+                    break
+                elif exc.errno == errno.EINVAL:
+                    yield offset, size - offset
+                    break
+                raise
+            if data >= size:
+                break
+            hole = min(os.lseek(fd, data, SEEK_HOLE), size)
+            yield data, hole - data
+            offset = hole
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+
+def copy_punching_holes(src, dst, length):
+    """Copy length bytes, seeking over all-zero chunks instead of writing them
+
+    The caller is responsible for truncating dst to its final size
+    so that a trailing hole is not lost.
+    """
+    while length > 0:
+        buf = src.read(min(length, SPARSE_CHUNK))
+        if not buf:
+            raise tarfile.ReadError('unexpected end of data')
+        length -= len(buf)
+        if buf == ZERO_CHUNK[:len(buf)]:
+            dst.seek(len(buf), os.SEEK_CUR)
+        else:
+            dst.write(buf)
+
+
+def read_sparse_map(fp):
+    """Read the GNU sparse 1.0 map stored in front of member data"""
+    buf = fp.read(tarfile.BLOCKSIZE)
+    fields = buf.split('\n')
+    while len(fields) < 2 or len(fields) <= 1 + 2 * int(fields[0]):
+        block = fp.read(tarfile.BLOCKSIZE)
+        if not block:
+            raise tarfile.ReadError('truncated sparse map')
+        buf += block
+        fields = buf.split('\n')
+    count = int(fields[0])
+    numbers = [int(f) for f in fields[1:1 + 2 * count]]
+    return zip(numbers[::2], numbers[1::2])
+
+
+def pax_sparse_info(tarinfo):
+    """Return (sparse map, real size) for PAX sparse members, (None, None) otherwise
+
+    The map is the string 'map' for format 1.0, where it's stored
+    in the data blocks rather than in the header.
+    """
+    headers = getattr(tarinfo, 'pax_headers', None)
+    if not headers:
+        return None, None
+    if headers.get('GNU.sparse.major') == '1' and headers.get('GNU.sparse.minor') == '0':
+        return 'map', int(headers['GNU.sparse.realsize'])
+    elif 'GNU.sparse.map' in headers:
+        numbers = [int(n) for n in headers['GNU.sparse.map'].split(',') if n]
+        return zip(numbers[::2], numbers[1::2]), int(headers['GNU.sparse.size'])
+    return None, None
+
+
+class PackedSparseFile(object):
+    """Data of a PAX sparse member, only the regions in the map, read by real file offset
+
+    Just enough of a file for add_sparse(), which seeks to each region in
+    order and reads it.
+    """
+
+    def __init__(self, fp, sparse_map):
+        self.fp = fp
+        self.base = fp.tell()
+        self.positions = {}
+        position = 0
+        for offset, length in sparse_map:
+            self.positions.setdefault(offset, position)
+            position += length
+        self.end = position
+
+    def seek(self, offset):
+        # add_sparse() appends an empty region at the end if the map has none
+        self.fp.seek(self.base + self.positions.get(offset, self.end))
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+
 class ContainerTarFile(tarfile.TarFile):
     def gettarinfo(self, name=None, arcname=None, fileobj=None):
         tarinfo = super(ContainerTarFile, self).gettarinfo(name, arcname, fileobj)
@@ -56,12 +166,93 @@ class ContainerTarFile(tarfile.TarFile):
         tarinfo.gname = 'root'
         return tarinfo
 
+    def next(self):
+        tarinfo = super(ContainerTarFile, self).next()
+        if tarinfo is not None and 'GNU.sparse.name' in tarinfo.pax_headers:
+            tarinfo.name = tarinfo.pax_headers['GNU.sparse.name']
+        return tarinfo
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is None or not tarinfo.isreg() or not hasattr(fileobj, 'fileno'):
+            return super(ContainerTarFile, self).addfile(tarinfo, fileobj)
+
+        regions = list(data_regions(fileobj.fileno(), tarinfo.size))
+        data_size = sum(length for _, length in regions)
+        if data_size + tarfile.BLOCKSIZE >= tarinfo.size:
+            return super(ContainerTarFile, self).addfile(tarinfo, fileobj)
+
+        self.add_sparse(tarinfo, fileobj, regions, data_size)
+
+    def add_sparse(self, tarinfo, fileobj, regions, data_size):
+        """Store a file with holes in GNU sparse 1.0 (PAX) format"""
+        if not regions or sum(regions[-1]) < tarinfo.size:
+            # GNU tar marks the real file end with an empty region
+            regions.append((tarinfo.size, 0))
+
+        sparse_map = [str(len(regions))]
+        for offset, length in regions:
+            sparse_map.extend((str(offset), str(length)))
+        sparse_map = '\n'.join(sparse_map) + '\n'
+        sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+
+        sparse_info = copy.copy(tarinfo)
+        directory, base = os.path.split(tarinfo.name)
+        sparse_info.name = os.path.join(directory, 'GNUSparseFile.0', base)
+        sparse_info.size = len(sparse_map) + data_size
+        sparse_info.pax_headers = dict(tarinfo.pax_headers)
+        sparse_info.pax_headers.update({
+            u'GNU.sparse.major': u'1',
+            u'GNU.sparse.minor': u'0',
+            u'GNU.sparse.name': tarinfo.name.decode(self.encoding, self.errors),
+            u'GNU.sparse.realsize': unicode(tarinfo.size),
+        })
+
+        buf = sparse_info.tobuf(tarfile.PAX_FORMAT, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.fileobj.write(sparse_map)
+        for offset, length in regions:
+            fileobj.seek(offset)
+            tarfile.copyfileobj(fileobj, self.fileobj, length)
+        blocks, remainder = divmod(sparse_info.size, tarfile.BLOCKSIZE)
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += len(buf) + blocks * tarfile.BLOCKSIZE
+        self.members.append(tarinfo)
+
+    def makefile(self, tarinfo, targetpath):
+        """Extract a regular file, keeping (or punching) holes where the data is zero"""
+        sparse_map, real_size = pax_sparse_info(tarinfo)
+        source = self.extractfile(tarinfo)
+        try:
+            with open(targetpath, 'wb') as target:
+                if sparse_map is None:
+                    real_size = tarinfo.size
+                    copy_punching_holes(source, target, real_size)
+                else:
+                    if sparse_map == 'map':
+                        sparse_map = read_sparse_map(source)
+                    for offset, length in sparse_map:
+                        target.seek(offset)
+                        copy_punching_holes(source, target, length)
+                target.truncate(real_size)
+        finally:
+            source.close()
+
     def _extract_member(self, tarinfo, targetpath):
         directory, base = os.path.split(targetpath)
-        if base.startswith('.wh.'):
+        if base == '.wh..wh..opq':
+            # opaque directory, hides whatever lower layers put into it
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+        elif base.startswith('.wh.'):
             whiteout = os.path.join(directory, base[len('.wh.'):])
-            if os.path.exists(whiteout):
-                if os.path.isdir(whiteout):
+            if os.path.lexists(whiteout):
+                if os.path.isdir(whiteout) and not os.path.islink(whiteout):
                     shutil.rmtree(whiteout)
                 else:
                     os.unlink(whiteout)
@@ -106,6 +297,12 @@ class ContainerTarFile(tarfile.TarFile):
         self.close()
 
 
+def copy_archive(path, archive):
+    with open(path) as fp:
+        shutil.copyfileobj(fp, archive)
+    archive.close()
+
+
 class ExtractTarBase(object):
     def __init__(self, namespace, dest_dir):
         self.namespace = namespace
@@ -142,6 +339,7 @@ class ExtractTarBase(object):
 
     def run(self):
         self.pre_setup()
+        self.namespace.user_namespace.start_holder()
         pid = os.fork()
         if pid:
             try:
@@ -209,12 +407,30 @@ class ExtractNamespacedTar(ExtractTarBase):
         finally:
             archive.close()
 
+    def run_in_session(self, session):
+        """Extract through a running BuildSession instead of a fresh namespace"""
+        session.extract(self.dest_dir, self.build_tar_archive)
+
+    def staging_key(self):
+        """Identify what this extracts, for archives staged ahead of time"""
+        return type(self).__name__, self.dest_dir, self.src_dir
+
+    def run_staged(self, path, session=None):
+        """Extract an archive build_tar_archive() wrote to path earlier"""
+        if session is None:
+            ExtractTarFile(self.namespace, self.dest_dir, path).run()
+        else:
+            session.extract(self.dest_dir, functools.partial(copy_archive, path))
+
 
 class UnpackArchive(ExtractNamespacedTar):
     def __init__(self, namespace, dest_dir, src_dir, archive_path):
         super(UnpackArchive, self).__init__(namespace, dest_dir, src_dir)
         self.archive_path = archive_path
 
+    def staging_key(self):
+        return super(UnpackArchive, self).staging_key() + (self.archive_path,)
+
     def build_tar_archive(self, archive):
         fmt = detect_tar_format(self.archive_path)
         tar_pipe = archive
@@ -248,6 +464,9 @@ class CopyFiles(ExtractNamespacedTar):
         self.members = members
         self.target_basename = target_basename
 
+    def staging_key(self):
+        return super(CopyFiles, self).staging_key() + (tuple(self.members), self.target_basename)
+
     def add(self, tar, member):
         if self.target_basename:
             tar.add(member, arcname=self.target_basename)
@@ -268,22 +487,132 @@ class CopyFiles(ExtractNamespacedTar):
         self.src_namespace().run(tar_add)
 
 
+def add_url(tar, url, basename=None):
+    """Download url into tar, named after the last path component by default"""
+    logger.info('Downloading {0}'.format(url))
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    parsed = urlparse.urlparse(url)
+    if not basename:
+        basename = os.path.basename(parsed.path.rstrip('/'))
+    tarinfo = tarfile.TarInfo(name=basename)
+    try:
+        size = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        size = None
+    tarinfo.size = size
+    tarinfo.mtime = int(time.time())
+    response.raw.decode_content = True
+    tar.addfile(tarinfo, fileobj=response.raw)
+
+
 class DownloadFiles(CopyFiles):
     def add(self, tar, member):
-        logger.info('Downloading {0}'.format(member))
-        response = requests.get(member, stream=True)
-        response.raise_for_status()
-        parsed = urlparse.urlparse(member)
-        if self.target_basename:
-            basename = self.target_basename
-        else:
-            basename = os.path.basename(parsed.path.rstrip('/'))
-        tarinfo = tarfile.TarInfo(name=basename)
+        add_url(tar, member, self.target_basename)
+
+
+class SyncFiles(ExtractNamespacedTar):
+    """Transfer single files (not whole trees) and whiteouts for removed ones
+
+    files is a list of (source path, archive name) pairs, removed a list of
+    archive names to delete from dest_dir.
+    """
+
+    def __init__(self, namespace, dest_dir, src_dir, files, removed):
+        super(SyncFiles, self).__init__(namespace, dest_dir, src_dir)
+        self.files = files
+        self.removed = removed
+
+    def build_tar_archive(self, archive):
+        tar = ContainerTarFile.open(fileobj=archive, mode='w|')
+
+        def tar_add():
+            for arcname in self.removed:
+                directory, base = os.path.split(arcname)
+                tar.addfile(tarfile.TarInfo(os.path.join(directory, '.wh.' + base)))
+            for src, arcname in self.files:
+                tar.add(src, arcname=arcname, recursive=False)
+            tar.close()
+            archive.close()
+
+        self.src_namespace().run(tar_add)
+
+
+class AddSources(ExtractNamespacedTar):
+    """Copy files, download URLs and unpack archives into dest_dir in one go
+
+    items is a list of (type, path) as returned by src_type(), all of them
+    are written, in order, to a single stream from a single namespace.
+    """
+
+    def __init__(self, namespace, dest_dir, src_dir, items):
+        super(AddSources, self).__init__(namespace, dest_dir, src_dir)
+        self.items = items
+
+    def staging_key(self):
+        return super(AddSources, self).staging_key() + (tuple(self.items),)
+
+    @staticmethod
+    def add_archive(tar, fileobj):
+        src = ContainerTarFile.open(fileobj=fileobj, mode='r|*')
+        for member in src:
+            sparse_map, real_size = pax_sparse_info(member)
+            if sparse_map is not None:
+                data = src.extractfile(member)
+                if sparse_map == 'map':
+                    sparse_map = read_sparse_map(data)
+                member = copy.copy(member)
+                member.size = real_size
+                member.pax_headers = dict((k, v) for k, v in member.pax_headers.items()
+                                          if not k.startswith('GNU.sparse.'))
+                tar.add_sparse(member, PackedSparseFile(data, sparse_map), list(sparse_map),
+                               sum(length for _, length in sparse_map))
+            elif member.issparse():
+                # old GNU format, extractfile() reads it by real offset
+                # noinspection PyProtectedMember
+                regions = [(chunk.offset, chunk.size) for chunk in member.sparse
+                           if isinstance(chunk, tarfile._data)]
+                data = src.extractfile(member)
+                member = copy.copy(member)
+                member.type = tarfile.REGTYPE
+                tar.add_sparse(member, data, regions, sum(length for _, length in regions))
+            elif member.isreg():
+                tar.addfile(member, src.extractfile(member))
+            else:
+                tar.addfile(member)
+        src.close()
+
+    def build_tar_archive(self, archive):
+        # the build context does not necessarily have xzcat, run it out here
+        xz_pipes = {}
         try:
-            size = int(response.headers['Content-Length'])
-        except (KeyError, ValueError):
-            size = None
-        tarinfo.size = size
-        tarinfo.mtime = int(time.time())
-        response.raw.decode_content = True
-        tar.addfile(tarinfo, fileobj=response.raw)
+            for item_type, path in self.items:
+                if item_type == 'tar' and detect_tar_format(os.path.join(self.src_dir, path)) == 'xz':
+                    logger.info('Unpacking xz archive {0}'.format(path))
+                    xz_pipes[path] = subprocess.Popen(
+                        ['xzcat', os.path.join(self.src_dir, path)], stdout=subprocess.PIPE)
+
+            tar = ContainerTarFile.open(fileobj=archive, mode='w|')
+
+            def tar_add():
+                for item_type, path in self.items:
+                    if item_type == 'url':
+                        add_url(tar, path)
+                    elif item_type == 'tar':
+                        if path in xz_pipes:
+                            self.add_archive(tar, xz_pipes[path].stdout)
+                        else:
+                            with open(path, 'rb') as fp:
+                                self.add_archive(tar, fp)
+                    elif os.path.isdir(path):
+                        tar.add(path, arcname='.')
+                    else:
+                        tar.add(path, arcname=os.path.basename(path))
+                tar.close()
+                archive.close()
+
+            self.src_namespace().run(tar_add)
+        finally:
+            for xz in xz_pipes.values():
+                xz.stdout.close()
+                xz.wait()
@@ -0,0 +1,119 @@
+"""Timing of container startup, across all the processes it forks
+
+Spans are appended as JSON lines to an unlinked temporary file. Its fd
+is inherited by every fork and closed on exec, so the namespace helpers
+and children all write to the same trace without any coordination.
+Without start_tracing(), span() does nothing.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+from shoebox.libc import clock_gettime
+
+
+logger = logging.getLogger('shoebox.trace')
+
+TRACE_FORMATS = ('chrome', 'json')
+
+_trace_fd = None
+
+
+def start_tracing():
+    global _trace_fd
+    fp = tempfile.TemporaryFile(prefix='shoebox-trace')
+    fd = os.dup(fp.fileno())
+    fp.close()
+    # every process appends whole lines, the shared offset doesn't matter
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_APPEND)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    _trace_fd = fd
+
+
+def record(name, start, end):
+    if _trace_fd is None:
+        return
+    line = json.dumps({'name': name, 'pid': os.getpid(), 'start': start, 'end': end}) + '\n'
+    try:
+        os.write(_trace_fd, line)
+    except OSError:
+        logger.debug('Cannot record span {0}'.format(name), exc_info=True)
+
+
+@contextmanager
+def span(name):
+    """Record how long the block takes, also when it raises"""
+    if _trace_fd is None:
+        yield
+        return
+    start = clock_gettime()
+    try:
+        yield
+    finally:
+        record(name, start, clock_gettime())
+
+
+def mark(name):
+    """Record an instant, e.g. right before exec"""
+    if _trace_fd is not None:
+        now = clock_gettime()
+        record(name, now, now)
+
+
+def stop_tracing():
+    """Return all spans recorded so far, ordered by start"""
+    global _trace_fd
+    if _trace_fd is None:
+        return []
+    os.lseek(_trace_fd, 0, os.SEEK_SET)
+    chunks = []
+    while True:
+        chunk = os.read(_trace_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(_trace_fd)
+    _trace_fd = None
+    return sorted((json.loads(line) for line in ''.join(chunks).splitlines() if line),
+                  key=lambda s: (s['start'], -s['end']))
+
+
+def format_trace(spans, trace_format):
+    """Return spans as a Chrome trace (chrome://tracing, Perfetto) or plain JSON
+
+    Times are relative to the first span, in microseconds for Chrome and
+    seconds for JSON.
+    """
+    origin = spans[0]['start'] if spans else 0
+    if trace_format == 'chrome':
+        events = []
+        for s in spans:
+            event = {
+                'name': s['name'],
+                'ph': 'X' if s['end'] > s['start'] else 'i',
+                'ts': (s['start'] - origin) * 1e6,
+                'pid': s['pid'],
+                'tid': s['pid'],
+            }
+            if event['ph'] == 'X':
+                event['dur'] = (s['end'] - s['start']) * 1e6
+            else:
+                event['s'] = 'p'
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    return [{
+        'name': s['name'],
+        'pid': s['pid'],
+        'start': s['start'] - origin,
+        'duration': s['end'] - s['start'],
+    } for s in spans]
+
+
+def write_trace(path, trace_format):
+    spans = stop_tracing()
+    with open(path, 'w') as fp:
+        json.dump(format_trace(spans, trace_format), fp, indent=2)
+    logger.info('Wrote {0} startup spans to {1}'.format(len(spans), path))
@@ -1,15 +1,25 @@
+from collections import namedtuple
 from contextlib import contextmanager
+import fcntl
 import getpass
 import itertools
 import logging
 import os
 import subprocess
 
+from shoebox.libc import CLONE_NEWUSER, setns, unshare
 from shoebox.namespace_utils import spawn_helper
+from shoebox.trace import span
 
 
 logger = logging.getLogger('shoebox')
 
+# holder process owning a user namespace, ns_fd is its /proc/<pid>/ns/user
+# and the holder exits when the last copy of hold_fd is closed
+UserNamespaceHolder = namedtuple('UserNamespaceHolder', 'pid ns_fd hold_fd')
+
+_id_maps = {}
+
 
 def load_id_map(path, base_id):
     username = getpass.getuser()
@@ -42,6 +52,18 @@ def load_id_map(path, base_id):
         lower_id += id_count
 
 
+def cached_id_map(path, base_id):
+    """Return the flattened id map for newuidmap/newgidmap, parsing path once"""
+    key = (path, base_id)
+    if key not in _id_maps:
+        _id_maps[key] = list(itertools.chain(*load_id_map(path, base_id)))
+    return _id_maps[key]
+
+
+def set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
 def apply_id_maps(pid, uid_map, gid_map):
     subprocess.check_call(['newuidmap', str(pid)] + [str(uid) for uid in uid_map])
     subprocess.check_call(['newgidmap', str(pid)] + [str(gid) for gid in gid_map])
@@ -56,14 +78,85 @@ class UserNamespace(object):
     def __init__(self, target_uid=None, target_gid=None):
         self.target_uid = target_uid
         self.target_gid = target_gid
+        # None: not started yet, False: cannot start one
+        self.holder = None
 
     def __repr__(self):
         return 'uid:{0} gid:{1}'.format(self.target_uid, self.target_gid)
 
+    def start_holder(self):
+        """Create the user namespace once, in a process that keeps it around
+
+        Namespaces built later join it with setns() instead of mapping ids
+        with newuidmap/newgidmap again. Call before forking, so the children
+        share the holder.
+        """
+        if self.holder is not None:
+            return
+        self.holder = False
+        if (self.target_uid is None) != (self.target_gid is None):
+            # map_ids() complains in the namespace itself
+            return
+        ready_rd, ready_wr = os.pipe()
+        hold_rd, hold_wr = os.pipe()
+        with span('start_userns_holder'):
+            pid = os.fork()
+            if pid == 0:
+                exitcode = 1
+                # noinspection PyBroadException
+                try:
+                    # don't hold on to pipes and sockets of whoever forked us first
+                    for fd in os.listdir('/proc/self/fd'):
+                        if int(fd) > 2 and int(fd) not in (ready_wr, hold_rd):
+                            try:
+                                os.close(int(fd))
+                            except OSError:
+                                pass
+                    with self.map_ids():
+                        unshare(CLONE_NEWUSER)
+                    os.write(ready_wr, 'R')
+                    os.close(ready_wr)
+                    # until the owner and all its children are gone
+                    os.read(hold_rd, 1)
+                    exitcode = 0
+                except:
+                    # building the namespace without the holder reports it properly
+                    logger.debug('User namespace holder failed', exc_info=True)
+                finally:
+                    # noinspection PyProtectedMember
+                    os._exit(exitcode)
+            os.close(ready_wr)
+            os.close(hold_rd)
+            # containers must not keep the holder alive
+            set_cloexec(hold_wr)
+            ready = os.read(ready_rd, 1)
+            os.close(ready_rd)
+            if not ready:
+                os.close(hold_wr)
+                os.waitpid(pid, 0)
+                logger.debug('Cannot start user namespace holder, mapping ids for every namespace')
+                return
+            ns_fd = os.open('/proc/{0}/ns/user'.format(pid), os.O_RDONLY)
+            set_cloexec(ns_fd)
+        self.holder = UserNamespaceHolder(pid, ns_fd, hold_wr)
+        logger.debug('User namespace {0!r} held by {1}'.format(self, pid))
+
     @contextmanager
     def setup_userns(self):
-        uid_map = list(itertools.chain(*load_id_map('/etc/subuid', os.getuid())))
-        gid_map = list(itertools.chain(*load_id_map('/etc/subgid', os.getgid())))
+        """Get into the user namespace, yield the unshare flags still needed for it"""
+        if self.holder:
+            with span('setns_userns'):
+                setns(self.holder.ns_fd, CLONE_NEWUSER)
+            yield 0
+            return
+        with self.map_ids():
+            yield CLONE_NEWUSER
+
+    @contextmanager
+    def map_ids(self):
+        """Map ids of the user namespace unshared inside the block"""
+        uid_map = cached_id_map('/etc/subuid', os.getuid())
+        gid_map = cached_id_map('/etc/subgid', os.getgid())
         uid, gid = os.getuid(), os.getgid()
 
         if not uid_map or not gid_map:
@@ -72,18 +165,21 @@ class UserNamespace(object):
         idmap_helper = None
 
         if self.target_uid is None and self.target_gid is None:
-            idmap_helper = spawn_helper('idmap', apply_id_maps, os.getpid(), uid_map, gid_map)
+            with span('spawn_idmap_helper'):
+                idmap_helper = spawn_helper('idmap', apply_id_maps, os.getpid(), uid_map, gid_map)
         elif self.target_uid is None or self.target_gid is None:
             raise RuntimeError('If either of target uid/gid is present both are required')
 
         yield
 
         if idmap_helper:
-            try:
-                idmap_helper.wait()
-            except subprocess.CalledProcessError:
-                logger.warning('UID/GID helper failed to run, mapping root directly')
+            with span('idmap_helper'):
+                try:
+                    idmap_helper.wait()
+                except subprocess.CalledProcessError:
+                    logger.warning('UID/GID helper failed to run, mapping root directly')
 
         if self.target_uid is not None:
-            single_id_map('uid', self.target_uid, uid)
-            single_id_map('gid', self.target_gid, gid)
+            with span('single_id_map'):
+                single_id_map('uid', self.target_uid, uid)
+                single_id_map('gid', self.target_gid, gid)
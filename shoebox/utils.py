@@ -1,45 +1,74 @@
+import json
 import os
-import subprocess
+import sys
 
-from shoebox.container import Container, is_container_id
+from shoebox.catalog import Catalog
+from shoebox.container import is_container_id
+from shoebox.proc import ProcessTree, cpu_percent, scan_processes, uptime
 
 
 def ls(shoebox_dir, quiet):
-    shoebox_dir = os.path.expanduser(shoebox_dir)
-    container_dir = os.path.join(shoebox_dir, 'containers')
-    for container_id in os.listdir(container_dir):
-        if is_container_id(container_id):
-            if quiet:
-                print container_id
-                continue
-            print 'container id:', container_id
-            container = Container(shoebox_dir, container_id)
-            tags = list(container.tags())
-            if tags:
-                print '  tags:', ' '.join(tags)
-
-
-def ps(shoebox_dir):
-    shoebox_dir = os.path.expanduser(shoebox_dir)
-    container_dir = os.path.join(shoebox_dir, 'containers')
-    for container_id in os.listdir(container_dir):
-        if not is_container_id(container_id):
+    for entry in Catalog(shoebox_dir).containers():
+        if quiet:
+            print entry.container_id
             continue
-        container = Container(shoebox_dir, container_id)
-        pid = container.pid()
-        if not pid:
+        print 'container id:', entry.container_id
+        if entry.tags:
+            print '  tags:', ' '.join(entry.tags)
+
+
+def format_size(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    return '{0:.0f}{1}'.format(size, unit) if unit == 'B' else '{0:.1f}{1}'.format(size, unit)
+
+
+def ps(shoebox_dir, as_json=False):
+    # one pass over /proc for all containers instead of a pstree each
+    tree = ProcessTree(scan_processes())
+    now = uptime()
+    containers = []
+    for entry in Catalog(shoebox_dir).containers(running=True):
+        processes = tree.container_processes(entry.pid)
+        if not processes:
+            # run was killed before it could clean up
             continue
-        print container_id
-        ip = container.ip_address()
-        if ip:
-            print '  ip address:', ip
-        tags = list(container.tags())
-        if tags:
-            print '  tags:', ' '.join(tags)
-        print '  process tree:'
-        pstree = subprocess.check_output(['pstree', '-ap', str(pid)])
-        for line in pstree.splitlines():
-            print '    ' + line
+        containers.append((entry, processes))
+
+    if as_json:
+        json.dump([{
+            'container_id': entry.container_id,
+            'tags': entry.tags,
+            'ip_address': entry.ip_address,
+            'pid': entry.pid,
+            'processes': [{
+                'pid': info.pid,
+                'ppid': info.ppid,
+                'name': info.name,
+                'cmdline': info.cmdline,
+                'state': info.state,
+                'rss': info.rss,
+                'cpu_time': info.cpu_time,
+                'cpu_percent': round(cpu_percent(info, now), 1),
+            } for _, info in processes],
+        } for entry, processes in containers], sys.stdout, indent=4)
+        print
+        return
+
+    for entry, processes in containers:
+        print entry.container_id
+        if entry.ip_address:
+            print '  ip address:', entry.ip_address
+        if entry.tags:
+            print '  tags:', ' '.join(entry.tags)
+        print '  processes:'
+        print '    {0:>7} {1:>7} {2:>5} {3}'.format('PID', 'RSS', '%CPU', 'COMMAND')
+        for depth, info in processes:
+            print '    {0:>7} {1:>7} {2:>5.1f} {3}{4}'.format(
+                info.pid, format_size(info.rss), cpu_percent(info, now), '  ' * depth,
+                ' '.join(info.cmdline) or '[{0}]'.format(info.name))
         print
 
 
@@ -66,6 +95,7 @@ def tag_container(shoebox_dir, container_id, tag, force):
             os.unlink(tag_path)
 
     os.symlink(container_id, tag_path)
+    Catalog(shoebox_dir).tag(tag, container_id)
 
 
 def untag(shoebox_dir, tag):
@@ -79,3 +109,4 @@ def untag(shoebox_dir, tag):
 
     if os.path.islink(tag_path):
         os.unlink(tag_path)
+    Catalog(shoebox_dir).untag(tag)
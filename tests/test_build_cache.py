@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from shoebox.build_cache import write_delta
+from shoebox.build_session import scan_tree
+from shoebox.tar import ContainerTarFile
+
+
+def write_file(path, data):
+    with open(path, 'w') as fp:
+        fp.write(data)
+
+
+def read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(path, root)
+            if os.path.islink(path):
+                tree[rel_path] = ('link', os.readlink(path))
+            elif os.path.isdir(path):
+                tree[rel_path] = ('dir', None)
+            else:
+                with open(path) as fp:
+                    tree[rel_path] = ('file', fp.read())
+    return tree
+
+
+class DeltaTest(unittest.TestCase):
+    """Replaying a delta over the old tree gives the new one"""
+
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dest)
+
+    def replay(self, old_tree):
+        fp = StringIO()
+        fp.close = lambda: None
+        write_delta(fp, old_tree, scan_tree(self.src), self.src)
+        fp.seek(0)
+        ContainerTarFile.open(fileobj=fp, mode='r|').extractall(self.dest)
+        self.assertEqual(read_tree(self.src), read_tree(self.dest))
+
+    def test_changes(self):
+        os.makedirs(os.path.join(self.src, 'etc/conf.d'))
+        write_file(os.path.join(self.src, 'etc/conf.d/a'), 'a')
+        write_file(os.path.join(self.src, 'etc/hosts'), 'hosts')
+        write_file(os.path.join(self.src, 'was_file'), 'file')
+        os.makedirs(os.path.join(self.src, 'was_dir/sub'))
+        write_file(os.path.join(self.src, 'was_dir/sub/b'), 'b')
+        os.symlink('etc/hosts', os.path.join(self.src, 'link'))
+        self.replay({})
+        old_tree = scan_tree(self.src)
+
+        write_file(os.path.join(self.src, 'etc/hosts'), 'changed hosts')
+        os.unlink(os.path.join(self.src, 'etc/conf.d/a'))
+        os.unlink(os.path.join(self.src, 'was_file'))
+        os.makedirs(os.path.join(self.src, 'was_file'))
+        write_file(os.path.join(self.src, 'was_file/c'), 'c')
+        shutil.rmtree(os.path.join(self.src, 'was_dir'))
+        write_file(os.path.join(self.src, 'was_dir'), 'now a file')
+        os.unlink(os.path.join(self.src, 'link'))
+        os.symlink('was_dir', os.path.join(self.src, 'link'))
+        self.replay(old_tree)
@@ -0,0 +1,60 @@
+import os
+import shutil
+import socket
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from shoebox.build_session import BuildSession, agent_loop
+
+
+def add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, StringIO(data))
+
+
+class ExtractTest(unittest.TestCase):
+    """The session stays in sync when building an archive fails"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        parent_sock, agent_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            try:
+                agent_loop(agent_sock)
+            finally:
+                # noinspection PyProtectedMember
+                os._exit(0)
+        agent_sock.close()
+        self.session = BuildSession(None)
+        self.session.sock = parent_sock
+        self.session.pid = pid
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp)
+
+    def test_failed_archive(self):
+        def broken(fp):
+            tar = tarfile.open(fileobj=fp, mode='w|')
+            add_file(tar, 'partial', 'x' * 10000)
+            raise IOError('source went away')
+
+        def good(fp):
+            tar = tarfile.open(fileobj=fp, mode='w|')
+            add_file(tar, 'file', 'data')
+            tar.close()
+
+        with self.assertRaises(IOError):
+            self.session.extract(self.tmp, broken)
+        self.session.extract(self.tmp, good)
+        with open(os.path.join(self.tmp, 'file')) as fp:
+            self.assertEqual('data', fp.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
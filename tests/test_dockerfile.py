@@ -0,0 +1,39 @@
+import glob
+import os
+import unittest
+
+from shoebox.dockerfile import empty_dockerfile, fast_parser, parse_stanzas, strip_whitespace_after_continuations
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'dockerfiles')
+
+
+def parse(text, fast):
+    """Return the stanzas and the evaluated Dockerfile, or the error raised"""
+    try:
+        with fast_parser(fast):
+            stanzas = parse_stanzas(strip_whitespace_after_continuations(text))
+        evaluated = empty_dockerfile(None)
+        for directive in stanzas:
+            evaluated = directive.evaluate(evaluated)
+        # noinspection PyProtectedMember
+        return repr(stanzas), repr(evaluated._asdict())
+    except Exception as exc:
+        return 'error', exc.__class__.__name__
+
+
+class FastParserTest(unittest.TestCase):
+    """The hand-written parser must produce the same stanzas as the grammar"""
+
+    def test_corpus(self):
+        paths = sorted(glob.glob(os.path.join(CORPUS, '*.Dockerfile')))
+        self.assertTrue(paths)
+        for path in paths:
+            with open(path) as fp:
+                text = fp.read().decode('utf-8')
+            slow = parse(text, False)
+            self.assertNotEqual('error', slow[0], '{0}: {1}'.format(os.path.basename(path), slow[1]))
+            self.assertEqual(slow, parse(text, True), os.path.basename(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import random
+import unittest
+
+from shoebox.persistent import PersistentMap
+
+
+class Key(object):
+    """Keys with a handful of hashes, colliding in part or all of them"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return [1, 2, 33, 1025, 1 << 31, (1 << 32) + 1, -1][self.value % 7]
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and other.value == self.value
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class PersistentMapTest(unittest.TestCase):
+    def test_versions(self):
+        rand = random.Random(1)
+        expected = {}
+        current = PersistentMap()
+        versions = []
+        for _ in range(2000):
+            key = rand.choice([rand.randint(0, 100), 'k{0}'.format(rand.randint(0, 100)), Key(rand.randint(0, 40))])
+            value = rand.random()
+            expected[key] = value
+            current = current.set(key, value)
+            versions.append((current, dict(expected)))
+
+        # older versions are untouched by later updates
+        for mapping, items in versions[::37]:
+            self.assertEqual(len(items), len(mapping))
+            self.assertEqual(items, dict(mapping.iteritems()))
+            for key, value in items.items():
+                self.assertEqual(value, mapping[key])
+            self.assertNotIn('missing', mapping)
+            self.assertNotIn(Key(99), mapping)
+
+    def test_wrap(self):
+        items = {'PATH': '/bin', 'HOME': '/root'}
+        mapping = PersistentMap.wrap(items)
+        self.assertEqual(items, mapping)
+        self.assertIs(mapping, PersistentMap.wrap(mapping))
+        self.assertEqual(dict(items, HOME='/home'), mapping.set('HOME', '/home'))
+        self.assertEqual('/root', mapping['HOME'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from shoebox.tar import AddSources, ContainerTarFile, data_regions, pax_sparse_info
+
+SIZE = 20 << 20
+DATA = [(10 << 20, 'hello'), (SIZE - 3, 'end')]
+
+
+def has_gnu_tar():
+    try:
+        return 'GNU tar' in subprocess.check_output(['tar', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+@unittest.skipUnless(has_gnu_tar(), 'needs GNU tar to write sparse archives')
+class AddArchiveSparseTest(unittest.TestCase):
+    """ADD of an archive keeps sparse members sparse, whatever format they came in"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        sparse = os.path.join(self.tmp, 'sparse')
+        with open(sparse, 'wb') as fp:
+            fp.truncate(SIZE)
+            for offset, data in DATA:
+                fp.seek(offset)
+                fp.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def roundtrip(self, *tar_args):
+        archive = os.path.join(self.tmp, 'in.tar')
+        subprocess.check_call(['tar', '-cSf', archive] + list(tar_args) + ['-C', self.tmp, 'sparse'])
+        output = os.path.join(self.tmp, 'out.tar')
+        with open(output, 'wb') as out_fp:
+            tar = ContainerTarFile.open(fileobj=out_fp, mode='w|')
+            with open(archive, 'rb') as in_fp:
+                AddSources.add_archive(tar, in_fp)
+            tar.close()
+
+        with open(output, 'rb') as fp:
+            members = list(ContainerTarFile.open(fileobj=fp, mode='r|'))
+        self.assertEqual(['sparse'], [m.name for m in members])
+        sparse_map, real_size = pax_sparse_info(members[0])
+        self.assertEqual('map', sparse_map)
+        self.assertEqual(SIZE, real_size)
+        # far less than the file, the holes are not stored
+        self.assertLess(os.path.getsize(output), 64 << 10)
+
+        dest = os.path.join(self.tmp, 'dest')
+        os.mkdir(dest)
+        with open(output, 'rb') as fp:
+            ContainerTarFile.open(fileobj=fp, mode='r|').extractall(dest)
+        extracted = os.path.join(dest, 'sparse')
+        self.assertEqual(SIZE, os.path.getsize(extracted))
+        with open(extracted, 'rb') as fp:
+            for offset, data in DATA:
+                fp.seek(offset)
+                self.assertEqual(data, fp.read(len(data)))
+            fp.seek(0)
+            self.assertEqual('\0' * 4096, fp.read(4096))
+            self.assertLess(sum(length for _, length in data_regions(fp.fileno(), SIZE)), SIZE)
+
+    def test_gnu_sparse(self):
+        self.roundtrip('--format=gnu')
+
+    def test_pax_sparse_0_1(self):
+        self.roundtrip('--format=pax', '--sparse-version=0.1')
+
+    def test_pax_sparse_1_0(self):
+        self.roundtrip('--format=pax', '--sparse-version=1.0')
+
+
+if __name__ == '__main__':
+    unittest.main()